@@ -0,0 +1,225 @@
+"""
+Delivery backplane between server processes.
+
+Each process only knows the sockets connected to it. Anything that has to reach
+sockets in other processes (message pushes, cache invalidations) is published
+as an envelope on the backplane, and every other process hands it to the
+handler registered for its kind.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+
+import psycopg2
+import psycopg2.extensions
+import tornado.ioloop
+
+import db_pool
+import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+# "memory" only reaches the current process, "postgres" reaches every process using the database
+BACKPLANE = os.getenv("BACKPLANE")
+NOTIFY_CHANNEL = os.getenv("BACKPLANE_CHANNEL", "twaddle_backplane")
+
+# NOTIFY payloads are capped at 8000 bytes, keep some room
+MAX_NOTIFY_PAYLOAD = 7900
+
+# Seconds between attempts to re-establish a lost LISTEN connection
+RECONNECT_DELAY = 2.0
+
+
+def process_id() -> str:
+    # Looked up on every call, forked workers get their own
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Backplane:
+    def __init__(self, origin: str | None = None):
+        # Envelopes published with our own origin are ignored; defaults to this process
+        self.origin = origin
+        self.handlers: dict[str, Callable[[dict], Any]] = {}
+
+    def get_origin(self) -> str:
+        return self.origin or process_id()
+
+    def on(self, kind: str, handler: Callable[[dict], Any]) -> None:
+        """
+        Register the handler for envelopes of a kind published by other processes
+        :param kind: envelope kind
+        :param handler: called with the envelope
+        """
+        self.handlers[kind] = handler
+
+    def _dispatch(self, envelope: dict) -> None:
+        if envelope.get("origin") == self.get_origin():
+            return
+        handler = self.handlers.get(envelope.get("kind"))
+        if handler is None:
+            LOGGER.warning("No backplane handler for %s", envelope.get("kind"))
+            return
+        try:
+            res = handler(envelope)
+            if asyncio.iscoroutine(res):
+                asyncio.ensure_future(res)
+        except Exception:
+            LOGGER.exception("Backplane handler for %s failed", envelope.get("kind"))
+            metrics.errors.inc("backplane")
+
+    def publish(self, kind: str, **data) -> None:
+        """
+        Publish an envelope to all other processes. Never waits for delivery.
+        :param kind: envelope kind
+        :param data: envelope contents, must be JSONable
+        """
+        self._publish({"kind": kind, "origin": self.get_origin(), **data})
+
+    @abstractmethod
+    def _publish(self, envelope: dict) -> None:
+        pass
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+
+class InMemoryBackplane(Backplane):
+    """
+    Connects backplane instances within one process; a single instance is a no-op.
+    Tests can create several instances with different origins to stand in for processes.
+    """
+    instances: list['InMemoryBackplane'] = []
+
+    def start(self) -> None:
+        InMemoryBackplane.instances.append(self)
+
+    def stop(self) -> None:
+        if self in InMemoryBackplane.instances:
+            InMemoryBackplane.instances.remove(self)
+
+    def _publish(self, envelope: dict) -> None:
+        loop = asyncio.get_event_loop()
+        for instance in InMemoryBackplane.instances:
+            if instance is not self:
+                loop.call_soon(instance._dispatch, envelope)
+
+
+class PostgresBackplane(Backplane):
+    """
+    Backplane over Postgres LISTEN/NOTIFY.
+    Listens on a dedicated connection watched by the IOLoop, and publishes through the shared pool.
+    Envelopes are published one at a time, by a single thread, so other processes get them in the order
+    they were published (e.g. two pushes to the same user).
+    """
+
+    def __init__(self, channel: str = NOTIFY_CHANNEL, origin: str | None = None):
+        super().__init__(origin)
+        self.channel = channel
+        self.conn: psycopg2.extensions.connection | None = None
+        self._stopped = False
+        # Created on first publish, so that forked workers don't inherit the parent's thread
+        self._publisher: ThreadPoolExecutor | None = None
+
+    def start(self) -> None:
+        self._stopped = False
+        try:
+            self.conn = db_pool.connect()
+            self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with self.conn.cursor() as crsr:
+                crsr.execute(f"LISTEN {self.channel}")
+        except psycopg2.Error:
+            LOGGER.exception("Could not LISTEN for backplane notifications, retrying")
+            self._schedule_reconnect()
+            return
+
+        tornado.ioloop.IOLoop.current().add_handler(self.conn.fileno(), self._on_readable,
+                                                    tornado.ioloop.IOLoop.READ)
+        LOGGER.info("Listening for backplane notifications on %s", self.channel)
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._close_listener()
+
+    def _close_listener(self) -> None:
+        if self.conn is None:
+            return
+        try:
+            tornado.ioloop.IOLoop.current().remove_handler(self.conn.fileno())
+        except (ValueError, psycopg2.Error):
+            pass
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+        self.conn = None
+
+    def _schedule_reconnect(self) -> None:
+        if not self._stopped:
+            tornado.ioloop.IOLoop.current().call_later(RECONNECT_DELAY, self.start)
+
+    def _on_readable(self, fd, events) -> None:
+        try:
+            self.conn.poll()
+        except psycopg2.Error:
+            LOGGER.exception("Lost the backplane connection, reconnecting")
+            self._close_listener()
+            self._schedule_reconnect()
+            return
+
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            try:
+                envelope = json.loads(notify.payload)
+            except ValueError:
+                LOGGER.warning("Dropping malformed backplane notification")
+                continue
+            self._dispatch(envelope)
+
+    def _publish(self, envelope: dict) -> None:
+        payload = json.dumps(envelope)
+        if len(payload.encode()) > MAX_NOTIFY_PAYLOAD and envelope.get("frame") is not None:
+            # Receivers rebuild a missing frame from the rest of the envelope (e.g. a message ID)
+            payload = json.dumps({**envelope, "frame": None})
+        if len(payload.encode()) > MAX_NOTIFY_PAYLOAD:
+            LOGGER.error("Backplane %s envelope too large, dropping it", envelope.get("kind"))
+            return
+
+        if self._publisher is None:
+            self._publisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="twaddle-backplane")
+        self._publisher.submit(self._notify, payload)
+
+    def _notify(self, payload: str) -> None:
+        try:
+            with db_pool.get_pool().connection() as conn, conn.cursor() as crsr:
+                crsr.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+        except psycopg2.Error:
+            LOGGER.exception("Could not publish to the backplane")
+
+
+_backplane: Backplane | None = None
+
+
+def get_backplane(kind: str | None = None) -> Backplane:
+    """
+    Get the process's backplane, creating it on first use
+    :param kind: "memory" or "postgres", defaults to the BACKPLANE env var, then "memory". Only used on first call.
+    :return: the backplane, not necessarily started
+    """
+    global _backplane
+    if _backplane is None:
+        kind = kind or BACKPLANE or "memory"
+        if kind == "postgres":
+            _backplane = PostgresBackplane()
+        elif kind == "memory":
+            _backplane = InMemoryBackplane()
+        else:
+            raise ValueError(f"Unknown backplane {kind}")
+    return _backplane
@@ -0,0 +1,57 @@
+"""
+Regression benchmark for LOAD_USER_CHATS.
+Times Database.load_user_chats for users with a growing number of chats and
+a growing chat history, and fails if latency grows far faster than the
+number of chats returned (as it did with the per-chat query cascade).
+
+Usage: python -m bench.bench_chat_list [--max-ratio 10]
+"""
+import argparse
+import sys
+
+from bench.common import throwaway_database, make_pool, connect, seed_users, seed_user_chat, measure
+from db_api import Database
+
+CHAT_COUNTS = (10, 50, 200)
+HISTORY_SIZES = (10, 100, 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-ratio", type=float, default=10.0,
+                        help="max allowed slowdown of the largest case compared to the smallest one")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    results: dict[tuple[int, int], float] = {}
+    with throwaway_database() as dbname:
+        conn = connect(dbname)
+        pool = make_pool(dbname, min_size=1, max_size=2)
+        db = Database(pool)
+
+        for history in HISTORY_SIZES:
+            for chat_count in CHAT_COUNTS:
+                # A fresh user per case, chatting with chat_count other users
+                user_id, *others = seed_users(conn, chat_count + 1)
+                for other in others:
+                    seed_user_chat(conn, (user_id, other), history)
+
+                timing = measure(lambda: db.load_user_chats(user_id), repeat=args.repeat)
+                results[(chat_count, history)] = timing["median"]
+                print(f"chats={chat_count:<5} history={history:<6} "
+                      f"median={timing['median'] * 1000:8.2f}ms max={timing['max'] * 1000:8.2f}ms")
+
+        pool.close()
+        conn.close()
+
+    smallest = results[(CHAT_COUNTS[0], HISTORY_SIZES[0])]
+    largest = results[(CHAT_COUNTS[-1], HISTORY_SIZES[-1])]
+    ratio = largest / smallest
+    print(f"largest/smallest: {ratio:.1f}x (limit {args.max_ratio}x)")
+    if ratio > args.max_ratio:
+        print("FAIL: LOAD_USER_CHATS latency grows with chat count/history size")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark for the wire codecs.
+Encodes and decodes typical frames with every codec, and reports bytes per
+frame and time per encode/decode. Doesn't need a database.
+
+Usage: python -m bench.bench_codec [--repeat 20] [--frames 1000]
+"""
+import argparse
+
+import codec
+from bench.common import measure
+
+
+def sample_message(message_id: int) -> dict:
+    return {
+        "message_id": message_id,
+        "chat_id": 1234,
+        "author_id": 56789,
+        "time_sent": 1700000000 + message_id,
+        "content": "See you at the usual place, around eight?"
+    }
+
+
+def sample_frames() -> dict[str, dict]:
+    return {
+        "SEND_CHAT_MESSAGE request": {"op": 1, "id": 17, "data": {
+            "event": "SEND_CHAT_MESSAGE",
+            "data": {"chat_id": 1234, "content": "See you at the usual place, around eight?"}
+        }},
+        "SEND_CHAT_MESSAGE response": {"op": 1, "id": 17, "data": {
+            "e": "SEND_CHAT_MESSAGE", "s": True, "data": sample_message(1)
+        }},
+        "message push": {"op": 2, "data": sample_message(1)},
+        "LOAD_SINGLE_CHAT, 100 messages": {"op": 1, "id": 18, "data": {
+            "e": "LOAD_SINGLE_CHAT", "s": True, "data": {
+                "users": [{"user_id": 56789 + i, "firebase_id": f"fb{i:026d}", "user_name": f"User {i}",
+                           "user_tag": f"user_{i}"} for i in range(2)],
+                "messages": [sample_message(i) for i in range(100)],
+                "next_before_message_id": 0,
+                "has_more": False
+            }
+        }},
+        "batch of 20 sends": {"op": 3, "id": 19, "data": {
+            "events": [{"event": "SEND_CHAT_MESSAGE", "data": {"chat_id": 1234, "content": f"Message {i}"}}
+                       for i in range(20)],
+            "mode": "atomic"
+        }}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--frames", type=int, default=1000, help="frames encoded/decoded per sample")
+    args = parser.parse_args()
+
+    codecs = (codec.JSON, codec.MSGPACK)
+    print(f"{'frame':<32}{'codec':<10}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for name, frame in sample_frames().items():
+        for cdc in codecs:
+            data = cdc.encode(frame)
+            assert cdc.decode(data) == frame, f"{cdc.name} doesn't round-trip {name}"
+
+            encode = measure(lambda: [cdc.encode(frame) for _ in range(args.frames)], repeat=args.repeat)
+            decode = measure(lambda: [cdc.decode(data) for _ in range(args.frames)], repeat=args.repeat)
+            print(f"{name:<32}{cdc.name:<10}{len(data):>8}"
+                  f"{encode['median'] / args.frames * 1e6:>12.2f}{decode['median'] / args.frames * 1e6:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Message insert throughput with and without group commit.
+At several concurrency levels, that many concurrent senders each send messages
+to their own chat for a fixed time, either through one transaction per message
+(Database.create_new_message) or through the shared MessageWriter. Without group
+commit, throughput is capped by the commit (fsync) rate.
+
+Usage: python -m bench.bench_group_commit [--duration 5] [--batch 256] [--delay-ms 2]
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.common import throwaway_database, make_pool, connect, seed_users, seed_user_chat
+from db_api import Database, AsyncDatabase, MessageWriter
+
+CONCURRENCY = (1, 8, 64, 256)
+
+
+async def run_senders(send, chat_ids: list[tuple[int, int]], concurrency: int, duration: float) -> int:
+    deadline = time.perf_counter() + duration
+    sent = 0
+
+    async def sender(chat_id: int, user_id: int):
+        nonlocal sent
+        while time.perf_counter() < deadline:
+            await send(chat_id, user_id, "benchmark")
+            sent += 1
+
+    await asyncio.gather(*(sender(*chat_ids[i % len(chat_ids)]) for i in range(concurrency)))
+    return sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per measurement")
+    parser.add_argument("--batch", type=int, default=256, help="max messages per group commit")
+    parser.add_argument("--delay-ms", type=float, default=2.0, help="max ms a message waits for a group")
+    parser.add_argument("--executor-workers", type=int, default=32,
+                        help="DB threads, bounds the concurrency of the one-commit-per-message path")
+    args = parser.parse_args()
+
+    with throwaway_database() as dbname:
+        conn = connect(dbname)
+        users = seed_users(conn, max(CONCURRENCY) * 2)
+        chats = [(seed_user_chat(conn, (users[2 * i], users[2 * i + 1]), 0), users[2 * i])
+                 for i in range(max(CONCURRENCY))]
+        conn.close()
+
+        pool = make_pool(dbname, min_size=1, max_size=args.executor_workers)
+        executor = ThreadPoolExecutor(max_workers=args.executor_workers)
+        db = AsyncDatabase(Database(pool), executor)
+        writer = MessageWriter(db, max_batch=args.batch, max_delay=args.delay_ms / 1000)
+
+        async def direct(chat_id, user_id, content):
+            return await db.run(db.sync.create_new_message, chat_id, user_id, content)
+
+        print(f"{'senders':>8}{'per-message msg/s':>20}{'group commit msg/s':>20}{'speedup':>10}")
+        for concurrency in CONCURRENCY:
+            single = asyncio.run(run_senders(direct, chats, concurrency, args.duration)) / args.duration
+            grouped = asyncio.run(run_senders(writer.write, chats, concurrency, args.duration)) / args.duration
+            print(f"{concurrency:>8}{single:>20.0f}{grouped:>20.0f}{grouped / single:>9.1f}x")
+            # The writer's event belongs to the loop that just finished
+            writer = MessageWriter(db, max_batch=args.batch, max_delay=args.delay_ms / 1000)
+
+        executor.shutdown()
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Load test for message inserts as the database grows.
+Grows the number of chats (and so chats_users rows and messages) in stages, and
+times Database.create_new_message on a fixed chat at every stage. Insert latency
+should stay flat; it used to grow with the total size of chats_users because the
+last_active trigger rewrote every membership row on every insert.
+
+Usage: python -m bench.bench_message_insert [--original-trigger] [--max-ratio 3]
+"""
+import argparse
+import sys
+
+from bench.common import throwaway_database, make_pool, connect, seed_users, seed_user_chat, \
+    seed_many_user_chats, measure
+from db_api import Database
+
+STAGES = (100, 1_000, 10_000)
+HISTORY = 20
+
+# The last_active trigger as it shipped in twaddle_db.sql, for comparison
+ORIGINAL_TRIGGER = """CREATE OR REPLACE FUNCTION update_chat_last_active() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  UPDATE chats_users
+  SET last_active = NEW.time_sent
+  FROM messages
+  WHERE messages.chat_id = NEW.chat_id;
+  RETURN NEW;
+END;
+$$;"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--original-trigger", action="store_true",
+                        help="run against the original, unscoped last_active trigger")
+    parser.add_argument("--max-ratio", type=float, default=3.0,
+                        help="max allowed slowdown between the smallest and largest stage")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    results: list[float] = []
+    with throwaway_database() as dbname:
+        conn = connect(dbname)
+        if args.original_trigger:
+            with conn.cursor() as crsr:
+                crsr.execute(ORIGINAL_TRIGGER)
+            conn.commit()
+
+        pool = make_pool(dbname, min_size=1, max_size=2)
+        db = Database(pool)
+
+        users = seed_users(conn, 1000)
+        chat_id = seed_user_chat(conn, (users[0], users[1]), HISTORY)
+
+        chat_count = 0
+        for stage in STAGES:
+            seed_many_user_chats(conn, users, stage - chat_count, HISTORY)
+            chat_count = stage
+
+            timing = measure(lambda: db.create_new_message(chat_id, users[0], "benchmark"), repeat=args.repeat)
+            results.append(timing["median"])
+            print(f"chats={stage:<7} memberships={stage * 2:<7} messages={stage * HISTORY:<8} "
+                  f"insert median={timing['median'] * 1000:8.2f}ms max={timing['max'] * 1000:8.2f}ms")
+
+        pool.close()
+        conn.close()
+
+    ratio = results[-1] / results[0]
+    print(f"largest/smallest: {ratio:.1f}x (limit {args.max_ratio}x)")
+    if ratio > args.max_ratio:
+        print("FAIL: insert latency grows with table size")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
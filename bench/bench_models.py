@@ -0,0 +1,98 @@
+"""
+Memory and time to turn 10k message rows into a JSON frame.
+Compares the original path (datetime rows -> __dict__ Message objects ->
+serialize() -> json) with slotted Messages and with the bulk row-to-wire path
+(epoch rows -> Message.serialize_rows -> json). Rows are generated in memory,
+no database is needed, so the time psycopg2 spends building datetimes for
+the original rows isn't included.
+
+Usage: python -m bench.bench_models [--messages 10000] [--repeat 10]
+"""
+import argparse
+import datetime
+import json
+import math
+import tracemalloc
+
+from bench.common import measure
+from db_api import Message
+
+
+class OriginalMessage:
+    """
+    Message as it used to be: a __dict__ object, with timestamps converted in Python
+    """
+
+    def __init__(self, message_id, chat_id, author_id, time_sent, content):
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.author_id = author_id
+        if isinstance(time_sent, datetime.datetime):
+            self.time_sent = math.floor(time_sent.timestamp())
+        else:
+            self.time_sent = time_sent
+        self.content = content
+
+    def serialize(self):
+        return self.__dict__
+
+
+def make_rows(count: int, epoch: bool) -> list[tuple]:
+    start = datetime.datetime(2024, 1, 1)
+    rows = []
+    for i in range(count):
+        time_sent = start + datetime.timedelta(seconds=i)
+        rows.append((i, 1234, 56789 + i % 2, math.floor(time_sent.timestamp()) if epoch else time_sent,
+                     f"Message number {i}, see you at the usual place"))
+    return rows
+
+
+def original(rows):
+    msgs = [OriginalMessage(*row) for row in rows]
+    return msgs, [msg.serialize() for msg in msgs]
+
+
+def slotted(rows):
+    msgs = [Message.from_tuple(row) for row in rows]
+    return msgs, [msg.serialize() for msg in msgs]
+
+
+def bulk(rows):
+    return None, Message.serialize_rows(rows)
+
+
+def built_memory(func, rows) -> int:
+    """
+    Memory held by everything built from the rows, up to (not including) the encoded frame
+    """
+    tracemalloc.start()
+    res = func(rows)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del res
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    cases = (
+        ("original", original, make_rows(args.messages, epoch=False)),
+        ("slotted", slotted, make_rows(args.messages, epoch=False)),
+        ("row-to-wire", bulk, make_rows(args.messages, epoch=True)),
+    )
+    print(f"{args.messages} messages")
+    print(f"{'path':<14}{'build ms':>10}{'encode ms':>11}{'held KiB':>10}")
+    for name, func, rows in cases:
+        build = measure(lambda: func(rows), repeat=args.repeat)
+        _, wire = func(rows)
+        encode = measure(lambda: json.dumps({"messages": wire}), repeat=args.repeat)
+        held = built_memory(func, rows)
+        print(f"{name:<14}{build['median'] * 1000:>10.2f}{encode['median'] * 1000:>11.2f}{held / 1024:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Database round trips per event.
+Runs every event through its real handlers against a throwaway database, and
+counts the statements sent to Postgres for each one: BEGIN and COMMIT,
+PREPAREs, prepared statements (by name) and plain query text. Every round
+trip is a full network latency, so this is the number that sets the floor on
+an event's latency. Also prints each event's median time.
+
+Run with DB_PREPARE=0 to send query text instead of prepared statements,
+MESSAGE_BATCH_SIZE=1 to see SEND_CHAT_MESSAGE without group commit, and
+READ_MARKER_FLUSH_MS=0 to write read markers on every event instead of coalescing them.
+
+Usage: python -m bench.bench_round_trips [--repeat 50]
+"""
+import argparse
+import asyncio
+import functools
+import re
+import statistics
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2.extensions
+
+import codec
+import webserver  # Registers the handlers that talk to the socket
+from bench.common import throwaway_database, connect, seed_users, seed_user_chat, random_tag
+from db_api import Database, AsyncDatabase
+from db_pool import ConnectionPool
+from sse_handling import ServerSideEventHandler, Events
+
+
+class TripCounter:
+    def __init__(self):
+        self.counts: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, label: str) -> None:
+        with self._lock:
+            self.counts[label] += 1
+
+    def take(self) -> Counter[str]:
+        with self._lock:
+            counts, self.counts = self.counts, Counter()
+        return counts
+
+
+TRIPS = TripCounter()
+
+
+def label(query: str | bytes) -> str:
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+    query = " ".join(query.split())
+    match = re.match(r"(EXECUTE|PREPARE) (\w+)", query)
+    if match is not None:
+        return match.group(2) if match.group(1) == "EXECUTE" else f"PREPARE {match.group(2)}"
+    return query[:60]
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        conn = self.connection
+        # psycopg2 opens a transaction with its own BEGIN before the first statement
+        if not conn.autocommit and conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            TRIPS.add("BEGIN")
+        TRIPS.add(label(query))
+        return super().execute(query, vars)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", CountingCursor)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        if self.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            TRIPS.add("COMMIT")
+        return super().commit()
+
+    def rollback(self):
+        if self.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            TRIPS.add("ROLLBACK")
+        return super().rollback()
+
+
+class BenchSocket:
+    """
+    Just enough of TwaddleWSServer for the handlers
+    """
+
+    def __init__(self, db: AsyncDatabase):
+        self.user_id = 0
+        self.codec = codec.JSON
+        self.handler = ServerSideEventHandler(self, db)
+
+    def set_active(self, user_id: int) -> None:
+        self.user_id = user_id
+
+    def announce_presence(self, online: bool) -> None:
+        pass
+
+    async def send_new_message(self, msg, users):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    with throwaway_database() as dbname:
+        conn = connect(dbname)
+        # Two for the main chat, and a fresh pair for every CREATE_USER_CHAT, warmup included
+        users = seed_users(conn, args.repeat * 2 + 4)
+        with conn.cursor() as crsr:
+            crsr.execute("SELECT user_id, firebase_id, user_tag FROM users")
+            details = {row[0]: row for row in crsr.fetchall()}
+        user_id, other_id = users[:2]
+        chat_id = seed_user_chat(conn, (user_id, other_id), 200)
+        conn.close()
+
+        pool = ConnectionPool(connect_func=functools.partial(connect, dbname, connection_factory=CountingConnection),
+                              min_size=1, max_size=2)
+        executor = ThreadPoolExecutor(max_workers=2)
+        ws = BenchSocket(AsyncDatabase(Database(pool), executor))
+        ws.set_active(user_id)
+        pairs = iter(zip(users[2::2], users[3::2]))
+
+        def new_chat(i: int) -> dict:
+            orig_user_id, recv_user_id = next(pairs)
+            return {"orig_user_id": orig_user_id, "recv_user_tag": details[recv_user_id][2]}
+
+        # event -> data for the i-th run
+        events = {
+            "CREATE_USER": lambda i: {"firebase_uid": random_tag(28), "usertag": random_tag(14), "username": "New"},
+            "LOGIN_USER": lambda i: {"firebase_id": details[user_id][1]},
+            "CREATE_USER_CHAT": new_chat,
+            "LOAD_USER_CHATS": lambda i: {"user_id": user_id},
+            "LOAD_SINGLE_CHAT": lambda i: {"chat_id": chat_id, "limit": 100},
+            "SEND_CHAT_MESSAGE": lambda i: {"chat_id": chat_id, "content": f"Message {i}"},
+            "MARK_AS_READ": lambda i: {"chat_id": chat_id},
+            "UPDATE_DETAILS": lambda i: {"user_id": other_id, "firebase_id": details[other_id][1],
+                                         "user_name": f"Renamed {i}", "user_tag": details[other_id][2]},
+            "SYNC_SINCE": lambda i: {"message_id": 0, "marker_version": 0, "limit": 100},
+        }
+
+        async def run():
+            # One warmup round, so connections are open and statements prepared
+            for event, make_data in events.items():
+                await ws.handler.handle({"data": {"event": event, "data": make_data(-1)}})
+            TRIPS.take()
+
+            for event, make_data in events.items():
+                samples = []
+                for i in range(args.repeat):
+                    start = time.perf_counter()
+                    await ws.handler.handle({"data": {"event": event, "data": make_data(i)}})
+                    samples.append(time.perf_counter() - start)
+                counts = TRIPS.take()
+
+                total = sum(counts.values()) / args.repeat
+                print(f"{event:<20}{total:>6.1f} round trips  median {statistics.median(samples) * 1000:7.2f}ms")
+                for query, count in counts.most_common():
+                    print(f"    {count / args.repeat:>6.1f}  {query}")
+
+        asyncio.run(run())
+        executor.shutdown()
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
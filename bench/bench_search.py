@@ -0,0 +1,130 @@
+"""
+Search latency over a large seeded database.
+Seeds --messages messages (2 million by default) over user chats, with content
+drawn from a skewed vocabulary so that some words are very common and most are
+rare, and --users users. Then times Database.search_messages for a user with
+many chats and Database.search_users, and shows the indexes each plan uses.
+Fails if a search would sequentially scan messages or users.
+
+Usage: python -m bench.bench_search [--messages 2000000] [--users 100000] [--repeat 20]
+"""
+import argparse
+import json
+import sys
+
+import psycopg2.extensions
+
+import statements
+from bench.common import throwaway_database, make_pool, connect, seed_users, seed_user_chat, \
+    seed_many_user_chats, measure
+from db_api import Database
+
+HISTORY = 100
+# Chats of the user doing the message searches
+SEARCHER_CHATS = 50
+VOCABULARY = 5000
+
+# Messages of 4-11 words "w<n>", n skewed towards 0 so low numbers are common words.
+# The subquery refers to the row, so it runs (and draws new words) for every message.
+RANDOM_CONTENT = """UPDATE messages
+SET content = (
+    SELECT string_agg('w' || floor(%(vocabulary)s * random() ^ 3)::integer, ' ')
+    FROM generate_series(1, 4 + message_id %% 8)
+)"""
+
+
+def plan_nodes(plan: dict) -> list[str]:
+    nodes = []
+    if plan.get("Index Name"):
+        nodes.append(plan["Index Name"])
+    elif plan.get("Node Type") == "Seq Scan":
+        nodes.append(f"Seq Scan on {plan.get('Relation Name')}")
+    for child in plan.get("Plans", []):
+        nodes.extend(plan_nodes(child))
+    return nodes
+
+
+def explain(conn: psycopg2.extensions.connection, name: str, params: dict) -> list[str]:
+    with conn.cursor() as crsr:
+        crsr.execute("EXPLAIN (FORMAT JSON) " + statements.STATEMENTS[name].sql, params)
+        plan = crsr.fetchone()[0]
+    conn.rollback()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan_nodes(plan[0]["Plan"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    scans = []
+    with throwaway_database() as dbname:
+        conn = connect(dbname)
+        print(f"Seeding {args.users} users and {args.messages} messages...")
+        users = seed_users(conn, args.users)
+        searcher = users[0]
+        for other in users[1:SEARCHER_CHATS + 1]:
+            seed_user_chat(conn, (searcher, other), HISTORY)
+        seed_many_user_chats(conn, users, max(args.messages // HISTORY - SEARCHER_CHATS, 0), HISTORY)
+        with conn.cursor() as crsr:
+            crsr.execute(RANDOM_CONTENT, {"vocabulary": VOCABULARY})
+            crsr.execute("SELECT user_tag FROM users WHERE user_id = %s", (users[1],))
+            tag = crsr.fetchone()[0]
+        conn.commit()
+        conn.autocommit = True
+        with conn.cursor() as crsr:
+            crsr.execute("VACUUM ANALYZE messages")
+            crsr.execute("VACUUM ANALYZE users")
+        conn.autocommit = False
+
+        pool = make_pool(dbname, min_size=1, max_size=2)
+        db = Database(pool)
+
+        message_cases = (
+            ("common word", "w1", None),
+            ("uncommon word", "w600", None),
+            ("rare word", "w4900", None),
+            ("two words", "w1 w600", None),
+            ("phrase", '"w1 w2"', None),
+            ("common word, one chat", "w1", db.get_user_chat_ids(searcher)[0]),
+        )
+        print(f"{'SEARCH_MESSAGES':<24}{'results':>8}{'median ms':>11}  plan")
+        for name, query, chat_id in message_cases:
+            timing = measure(lambda: db.search_messages(searcher, query, chat_id), repeat=args.repeat)
+            results = len(db.search_messages(searcher, query, chat_id))
+            plan = explain(conn, "search_messages", {"query": query, "user_id": searcher, "chat_id": chat_id,
+                                                     "before": None, "limit": 20})
+            scans.extend(node for node in plan if node.startswith("Seq Scan on messages"))
+            print(f"{name:<24}{results:>8}{timing['median'] * 1000:>11.2f}  {', '.join(plan)}")
+
+        user_cases = (
+            ("tag prefix", tag[:4]),
+            ("exact tag", tag),
+            ("name fragment", "User 4242"),
+            ("misspelled name", "Bnech Usr 4242"),
+        )
+        print(f"\n{'SEARCH_USERS':<24}{'results':>8}{'median ms':>11}  plan")
+        for name, query in user_cases:
+            timing = measure(lambda: db.search_users(query), repeat=args.repeat)
+            results = len(db.search_users(query))
+            escaped = query.replace("_", "\\_")
+            plan = explain(conn, "search_users", {"query": query, "tag": query.lower(),
+                                                  "prefix": f"{escaped.lower()}%", "contains": f"%{escaped}%",
+                                                  "limit": 20, "offset": 0})
+            scans.extend(node for node in plan if node.startswith("Seq Scan on users"))
+            print(f"{name:<24}{results:>8}{timing['median'] * 1000:>11.2f}  {', '.join(plan)}")
+
+        pool.close()
+        conn.close()
+
+    if scans:
+        print(f"FAIL: {', '.join(scans)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Shared helpers for the benchmarks.
+Benchmarks never touch the configured database: each run creates a throwaway
+database next to it (same DB_HOST/DB_PORT/credentials), loads twaddle_db.sql
+and the migrations into it, and drops it afterwards.
+"""
+import functools
+import os
+import random
+import statistics
+import string
+import time
+from contextlib import contextmanager
+from typing import *
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+
+import db_pool
+import migrations
+from db_pool import ConnectionPool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEMA_FILE = os.path.join(ROOT, "twaddle_db.sql")
+
+# Lines of the pg_dump that only make sense against the original server
+_SKIPPED_LINE_MARKERS = ("OWNER TO", "REVOKE ", "COMMENT ON SCHEMA", "ALTER SCHEMA", " DROP ")
+
+
+def load_schema_sql() -> str:
+    """
+    Read twaddle_db.sql (a UTF-16 pg_dump) and strip the statements that can't run on a fresh database
+    :return: SQL ready to be executed in one go
+    """
+    with open(SCHEMA_FILE, "rb") as f:
+        text = f.read().decode("utf-16")
+
+    lines = []
+    for line in text.splitlines():
+        if line.startswith("DROP ") or any(marker in line for marker in _SKIPPED_LINE_MARKERS):
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def connect(dbname: str, **kwargs) -> psycopg2.extensions.connection:
+    return psycopg2.connect(
+        dbname=dbname,
+        user=os.getenv("DB_USERNAME"),
+        password=os.getenv("DB_PASSWORD"),
+        host=db_pool.DB_HOST,
+        port=db_pool.DB_PORT,
+        **kwargs
+    )
+
+
+@contextmanager
+def throwaway_database(prefix: str = "twaddle_bench") -> Iterator[str]:
+    """
+    Create a database with the Twaddle schema, and drop it when done
+    :param prefix: prefix of the database name
+    :return: the database name
+    """
+    dbname = f"{prefix}_{os.getpid()}"
+    admin = connect(os.getenv("BENCH_ADMIN_DB", "postgres"))
+    admin.autocommit = True
+    try:
+        with admin.cursor() as crsr:
+            crsr.execute(f"DROP DATABASE IF EXISTS {dbname}")
+            crsr.execute(f"CREATE DATABASE {dbname}")
+
+        conn = connect(dbname)
+        with conn, conn.cursor() as crsr:
+            crsr.execute(load_schema_sql())
+        migrations.migrate(conn)
+        conn.close()
+
+        yield dbname
+    finally:
+        with admin.cursor() as crsr:
+            crsr.execute(f"DROP DATABASE IF EXISTS {dbname} WITH (FORCE)")
+        admin.close()
+
+
+def make_pool(dbname: str, **kwargs) -> ConnectionPool:
+    return ConnectionPool(connect_func=functools.partial(connect, dbname), **kwargs)
+
+
+def random_tag(length: int = 12) -> str:
+    return "".join(random.choices(string.ascii_lowercase + string.digits, k=length))
+
+
+def seed_users(conn: psycopg2.extensions.connection, count: int) -> list[int]:
+    """
+    Insert `count` users
+    :return: the new user IDs
+    """
+    with conn.cursor() as crsr:
+        rows = [(random_tag(28), random_tag(14), f"Bench User {i}") for i in range(count)]
+        res = execute_values(crsr,
+                             "INSERT INTO users (firebase_id, user_tag, user_name) VALUES %s RETURNING user_id",
+                             rows, page_size=1000, fetch=True)
+    conn.commit()
+    return [row[0] for row in res]
+
+
+def seed_user_chat(conn: psycopg2.extensions.connection,
+                   user_ids: tuple[int, int],
+                   history: int,
+                   read_all: bool = True) -> int:
+    """
+    Create a user chat between two users and fill it with messages
+    :param user_ids: the two members
+    :param history: number of messages to insert
+    :param read_all: whether the first member has read the whole chat
+    :return: the new chat ID
+    """
+    with conn.cursor() as crsr:
+        crsr.execute("INSERT INTO chats (creation_time) VALUES (now()) RETURNING chat_id")
+        chat_id = crsr.fetchone()[0]
+        execute_values(crsr, "INSERT INTO chats_users (chat_id, user_id, join_time) VALUES %s",
+                       [(chat_id, uid) for uid in user_ids],
+                       template="(%s, %s, now())")
+        crsr.execute("INSERT INTO direct_chats (low_user_id, high_user_id, chat_id) VALUES (%s, %s, %s) "
+                     "ON CONFLICT DO NOTHING", (min(user_ids), max(user_ids), chat_id))
+        if history > 0:
+            # Seeding goes around the triggers, the benchmarks measure the app's own writes
+            crsr.execute("ALTER TABLE messages DISABLE TRIGGER USER")
+            crsr.execute("""INSERT INTO messages (chat_id, author_id, time_sent, content)
+SELECT %s, (ARRAY[%s, %s])[1 + i %% 2], now() - (%s - i) * interval '1 second', md5(i::text)
+FROM generate_series(1, %s) i
+RETURNING message_id""", (chat_id, user_ids[0], user_ids[1], history, history))
+            last_id = max(row[0] for row in crsr.fetchall())
+            crsr.execute("ALTER TABLE messages ENABLE TRIGGER USER")
+            if read_all:
+                crsr.execute("UPDATE chats_users SET last_read_message = %s WHERE chat_id = %s AND user_id = %s",
+                             (last_id, chat_id, user_ids[0]))
+    conn.commit()
+    return chat_id
+
+
+def seed_many_user_chats(conn: psycopg2.extensions.connection,
+                         user_ids: list[int],
+                         count: int,
+                         history: int) -> list[int]:
+    """
+    Bulk-create user chats between random pairs of users, each with `history` messages
+    :param user_ids: users to pick members from
+    :param count: number of chats
+    :param history: messages per chat
+    :return: the new chat IDs
+    """
+    with conn.cursor() as crsr:
+        crsr.execute("INSERT INTO chats (creation_time) SELECT now() FROM generate_series(1, %s) RETURNING chat_id",
+                     (count,))
+        chat_ids = [row[0] for row in crsr.fetchall()]
+        pairs = {chat_id: random.sample(user_ids, 2) for chat_id in chat_ids}
+        execute_values(crsr, "INSERT INTO chats_users (chat_id, user_id, join_time) VALUES %s",
+                       [(chat_id, uid) for chat_id, pair in pairs.items() for uid in pair],
+                       template="(%s, %s, now())", page_size=5000)
+        # A pair picked twice keeps its first chat as its direct chat, like the migration's backfill
+        execute_values(crsr, "INSERT INTO direct_chats (low_user_id, high_user_id, chat_id) VALUES %s "
+                             "ON CONFLICT DO NOTHING",
+                       [(min(pair), max(pair), chat_id) for chat_id, pair in pairs.items()], page_size=5000)
+
+        if history > 0:
+            crsr.execute("ALTER TABLE messages DISABLE TRIGGER USER")
+            execute_values(crsr, """INSERT INTO messages (chat_id, author_id, time_sent, content)
+SELECT v.chat_id, (ARRAY[v.user_1, v.user_2])[1 + i %% 2], now() - (v.history - i) * interval '1 second', md5(i::text)
+FROM (VALUES %s) v(chat_id, user_1, user_2, history)
+CROSS JOIN LATERAL generate_series(1, v.history) i""",
+                           [(chat_id, pair[0], pair[1], history) for chat_id, pair in pairs.items()],
+                           page_size=1000)
+            crsr.execute("ALTER TABLE messages ENABLE TRIGGER USER")
+    conn.commit()
+    return chat_ids
+
+
+def measure(func: Callable, repeat: int = 20, warmup: int = 2) -> dict[str, float]:
+    """
+    Time a callable
+    :return: median/min/max in seconds
+    """
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "max": max(samples)
+    }
@@ -0,0 +1,423 @@
+"""
+Load test of the whole server over the WebSocket protocol.
+
+Creates a throwaway database, seeds users and chats into it, starts the server
+(webserver.main) against it in a subprocess, and drives simulated clients through
+a session: CREATE_USER (for a share of new users), LOGIN_USER, LOAD_USER_CHATS, then
+a weighted mix of LOAD_USER_CHATS, LOAD_SINGLE_CHAT and SEND_CHAT_MESSAGE with random
+think times. Reports throughput and p50/p95/p99 latency per event, and the
+end-to-end latency of op 2 pushes (from the sender's send to the recipient's receive).
+
+Every sent frame can be recorded to a JSONL trace, and a trace can be replayed
+against a freshly seeded database with the same timing, so runs of different
+releases see exactly the same traffic. Seeding is deterministic given --seed;
+only users created during the run (CREATE_USER) may get different IDs on replay.
+Reports can be saved with --output and compared with --compare.
+
+Thousands of clients need a high enough open file limit (ulimit -n).
+
+Usage:
+    python -m bench.load_test [--clients 1000] [--duration 30] [--record trace.jsonl] [--output run.json]
+    python -m bench.load_test --replay trace.jsonl [--speed 1] [--output run.json] [--compare old.json]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import *
+
+import tornado.websocket
+
+import codec
+from bench.common import ROOT, throwaway_database, connect, seed_users, seed_many_user_chats, random_tag
+from loop_monitor import percentile
+
+DEFAULT_MIX = "SEND_CHAT_MESSAGE=40,LOAD_SINGLE_CHAT=40,LOAD_USER_CHATS=20"
+# Seconds to wait for a response before counting the request as an error
+RESPONSE_TIMEOUT = 30.0
+# Messages sent by the load test carry a nonce, so pushes can be matched to their send time
+NONCE_PREFIX = "load:"
+
+
+class Stats:
+    def __init__(self):
+        self.latency: dict[str, list[float]] = {}
+        self.failures: dict[str, int] = {}
+        self.errors: dict[str, int] = {}
+        self.push_latency: list[float] = []
+        self.started = time.perf_counter()
+        self.finished = self.started
+
+    def record(self, event: str, seconds: float, success: bool) -> None:
+        self.latency.setdefault(event, []).append(seconds)
+        if not success:
+            self.failures[event] = self.failures.get(event, 0) + 1
+        self.finished = time.perf_counter()
+
+    def error(self, event: str) -> None:
+        self.errors[event] = self.errors.get(event, 0) + 1
+
+    def report(self) -> dict:
+        duration = max(self.finished - self.started, 1e-9)
+        events = {}
+        for event in sorted(set(self.latency) | set(self.errors)):
+            samples = self.latency.get(event, [])
+            events[event] = {
+                "count": len(samples),
+                "failures": self.failures.get(event, 0),
+                "errors": self.errors.get(event, 0),
+                "throughput": len(samples) / duration,
+                "p50": percentile(samples, 50),
+                "p95": percentile(samples, 95),
+                "p99": percentile(samples, 99)
+            }
+        return {
+            "duration": duration,
+            "throughput": sum(len(samples) for samples in self.latency.values()) / duration,
+            "events": events,
+            "push": {
+                "count": len(self.push_latency),
+                "p50": percentile(self.push_latency, 50),
+                "p95": percentile(self.push_latency, 95),
+                "p99": percentile(self.push_latency, 99)
+            }
+        }
+
+
+class TraceRecorder:
+    """
+    Writes every frame sent by the simulated clients, with its offset from the start of the run
+    """
+
+    def __init__(self, path: str, header: dict):
+        self.file = open(path, "w")
+        self.started = time.perf_counter()
+        self.file.write(json.dumps({"type": "header", **header}) + "\n")
+
+    def record(self, client: int, frame: dict) -> None:
+        self.file.write(json.dumps({
+            "type": "frame",
+            "t": round(time.perf_counter() - self.started, 6),
+            "client": client,
+            "frame": frame
+        }) + "\n")
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class SimClient:
+    """
+    One simulated client: a WebSocket connection that matches responses to requests by ID
+    """
+
+    def __init__(self, index: int, url: str, cdc: codec.Codec, stats: Stats, sent_at: dict[str, float],
+                 recorder: TraceRecorder | None = None):
+        self.index = index
+        self.url = url
+        self.codec = cdc
+        self.stats = stats
+        self.sent_at = sent_at
+        self.recorder = recorder
+        self.ids = itertools.count(1)
+        self.pending: dict[Any, asyncio.Future] = {}
+        self.conn: tornado.websocket.WebSocketClientConnection | None = None
+        self._reader: asyncio.Task | None = None
+
+    async def connect(self) -> None:
+        self.conn = await tornado.websocket.websocket_connect(self.url, subprotocols=[self.codec.subprotocol])
+        self._reader = asyncio.ensure_future(self._read())
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+
+    async def _read(self):
+        while True:
+            message = await self.conn.read_message()
+            if message is None:
+                break
+            received = time.perf_counter()
+            frame = self.codec.decode(message)
+
+            if frame.get("op") == 2:
+                sent = self.sent_at.get(frame["data"].get("content"))
+                if sent is not None:
+                    self.stats.push_latency.append(received - sent)
+                continue
+
+            future = self.pending.pop(frame.get("id"), None)
+            if future is not None and not future.done():
+                future.set_result(frame)
+
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed"))
+
+    async def request(self, event: str, data: dict) -> dict | None:
+        return await self.send_frame({"op": 1, "id": next(self.ids), "data": {"event": event, "data": data}})
+
+    async def send_frame(self, frame: dict) -> dict | None:
+        """
+        Send a request and wait for its response, recording its latency
+        :return: the response, None if there was none
+        """
+        event = frame["data"]["event"]
+        future = asyncio.get_running_loop().create_future()
+        self.pending[frame["id"]] = future
+
+        if self.recorder is not None:
+            self.recorder.record(self.index, frame)
+        content = (frame["data"].get("data") or {}).get("content")
+        start = time.perf_counter()
+        if content is not None:
+            self.sent_at[content] = start
+
+        try:
+            await self.conn.write_message(self.codec.encode(frame), binary=self.codec.binary)
+            res = await asyncio.wait_for(future, RESPONSE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, tornado.websocket.WebSocketClosedError):
+            self.pending.pop(frame["id"], None)
+            self.stats.error(event)
+            return None
+
+        self.stats.record(event, time.perf_counter() - start, bool(res["data"].get("s")))
+        return res
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    res = {}
+    for item in mix.split(","):
+        event, weight = item.split("=")
+        res[event.strip()] = float(weight)
+    return res
+
+
+async def run_session(client: SimClient, user: tuple[int, str] | None, rng: random.Random,
+                      mix: dict[str, float], think: float, deadline: float, page_size: int):
+    """
+    Log in (creating the user first if it's a new one) and keep sending the mix until the deadline
+    :param user: (user_id, firebase_id) of a seeded user, None for a new user
+    :param think: mean seconds between requests
+    """
+    if user is None:
+        firebase_id = random_tag(28)
+        tag = random_tag(14)
+        await client.request("CREATE_USER", {"firebase_uid": firebase_id, "usertag": tag, "username": f"Load {tag}"})
+    else:
+        firebase_id = user[1]
+
+    res = await client.request("LOGIN_USER", {"firebase_id": firebase_id})
+    if res is None or not res["data"].get("s"):
+        return
+    user_id = res["data"]["data"]["user_id"]
+
+    chat_ids = []
+    events, weights = list(mix.keys()), list(mix.values())
+    event = "LOAD_USER_CHATS"
+    sent = itertools.count()
+    while time.perf_counter() < deadline:
+        if event == "LOAD_USER_CHATS" or not chat_ids:
+            res = await client.request("LOAD_USER_CHATS", {"user_id": user_id})
+            if res is not None and res["data"].get("s"):
+                chat_ids = [chat["chat_id"] for chat in res["data"]["data"]["chats"]]
+        elif event == "LOAD_SINGLE_CHAT":
+            await client.request("LOAD_SINGLE_CHAT", {"chat_id": rng.choice(chat_ids), "limit": page_size})
+        elif event == "SEND_CHAT_MESSAGE":
+            await client.request("SEND_CHAT_MESSAGE", {
+                "chat_id": rng.choice(chat_ids),
+                "content": f"{NONCE_PREFIX}{client.index}:{next(sent)}"
+            })
+
+        await asyncio.sleep(rng.expovariate(1 / think) if think > 0 else 0)
+        event = rng.choices(events, weights)[0]
+
+
+async def drive(url: str, cdc: codec.Codec, users: list[tuple[int, str]], args, recorder: TraceRecorder | None,
+                stats: Stats):
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    sent_at: dict[str, float] = {}
+
+    clients = [SimClient(i, url, cdc, stats, sent_at, recorder) for i in range(args.clients)]
+    # Connect in small waves, a thundering herd only measures the accept queue
+    for i in range(0, len(clients), 100):
+        await asyncio.gather(*(client.connect() for client in clients[i:i + 100]))
+
+    stats.started = time.perf_counter()
+    deadline = stats.started + args.duration
+    sessions = []
+    for client in clients:
+        user = None if rng.random() < args.new_users else rng.choice(users)
+        client_rng = random.Random(rng.random())
+        sessions.append(run_session(client, user, client_rng, mix, args.think / 1000, deadline, args.page_size))
+    await asyncio.gather(*sessions)
+
+    # Give the last pushes a moment to arrive
+    await asyncio.sleep(1)
+    for client in clients:
+        client.close()
+
+
+async def replay(url: str, cdc: codec.Codec, frames: list[dict], speed: float, stats: Stats):
+    sent_at: dict[str, float] = {}
+    clients = {index: SimClient(index, url, cdc, stats, sent_at) for index in {item["client"] for item in frames}}
+    client_ls = list(clients.values())
+    for i in range(0, len(client_ls), 100):
+        await asyncio.gather(*(client.connect() for client in client_ls[i:i + 100]))
+
+    stats.started = time.perf_counter()
+    requests = []
+    for item in frames:
+        delay = stats.started + item["t"] / speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        requests.append(asyncio.ensure_future(clients[item["client"]].send_frame(item["frame"])))
+    await asyncio.gather(*requests)
+
+    await asyncio.sleep(1)
+    for client in client_ls:
+        client.close()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def running_server(dbname: str, port: int, workers: int) -> Iterator[subprocess.Popen]:
+    """
+    Run webserver.main against the given database in a subprocess, until the with block exits
+    """
+    env = {**os.environ, "DB_NAME": dbname, "DB_AUTO_MIGRATE": "0", "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING")}
+    proc = subprocess.Popen([sys.executable, "-c", f"import webserver; webserver.main({port}, '127.0.0.1', {workers})"],
+                            cwd=ROOT, env=env)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"Server exited with {proc.returncode}")
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Server didn't start listening")
+                time.sleep(0.2)
+        yield proc
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def seed_world(dbname: str, users: int, chats: int, history: int, seed_value: int) -> list[tuple[int, str]]:
+    """
+    Seed the world the clients run in. Deterministic for a given seed.
+    :return: (user_id, firebase_id) of every seeded user
+    """
+    random.seed(seed_value)
+    conn = connect(dbname)
+    user_ids = seed_users(conn, users)
+    if chats:
+        seed_many_user_chats(conn, user_ids, chats, history)
+    with conn.cursor() as crsr:
+        crsr.execute("SELECT user_id, firebase_id FROM users ORDER BY user_id")
+        res = crsr.fetchall()
+    conn.close()
+    return res
+
+
+def print_report(report: dict, compare: dict | None = None) -> None:
+    print(f"duration={report['duration']:.1f}s throughput={report['throughput']:.1f} req/s")
+    print(f"{'event':<20}{'count':>8}{'fail':>6}{'err':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for event, summ in report["events"].items():
+        line = (f"{event:<20}{summ['count']:>8}{summ['failures']:>6}{summ['errors']:>6}{summ['throughput']:>9.1f}"
+                f"{summ['p50'] * 1000:>9.2f}{summ['p95'] * 1000:>9.2f}{summ['p99'] * 1000:>9.2f}")
+        old = (compare or {}).get("events", {}).get(event)
+        if old and old["p99"]:
+            line += f"   p99 x{summ['p99'] / old['p99']:.2f}, req/s x{summ['throughput'] / max(old['throughput'], 1e-9):.2f}"
+        print(line)
+    push = report["push"]
+    print(f"{'push (end-to-end)':<20}{push['count']:>8}{'':>21}"
+          f"{push['p50'] * 1000:>9.2f}{push['p95'] * 1000:>9.2f}{push['p99'] * 1000:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000, help="users to seed")
+    parser.add_argument("--chats", type=int, default=5000, help="user chats to seed, between random users")
+    parser.add_argument("--history", type=int, default=200, help="messages per seeded chat")
+    parser.add_argument("--clients", type=int, default=1000, help="simulated clients")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run the mix for")
+    parser.add_argument("--think", type=float, default=1000, help="mean ms between a client's requests")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="event weights after login")
+    parser.add_argument("--new-users", type=float, default=0.05, help="share of clients that CREATE_USER first")
+    parser.add_argument("--page-size", type=int, default=50, help="LOAD_SINGLE_CHAT limit")
+    parser.add_argument("--codec", choices=("json", "msgpack"), default="json")
+    parser.add_argument("--workers", type=int, default=1, help="server processes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--record", help="write the sent frames to this JSONL trace")
+    parser.add_argument("--replay", help="replay this JSONL trace instead of generating traffic")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="compare with a report written by --output")
+    args = parser.parse_args()
+
+    frames = None
+    if args.replay:
+        with open(args.replay) as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        header = lines[0]
+        # The world has to match the recorded one
+        for key in ("users", "chats", "history", "seed", "codec"):
+            setattr(args, key, header[key])
+        frames = [line for line in lines[1:] if line["type"] == "frame"]
+
+    cdc = codec.CODECS[f"twaddle.{args.codec}"]
+    stats = Stats()
+    with throwaway_database("twaddle_load") as dbname:
+        users = seed_world(dbname, args.users, args.chats, args.history, args.seed)
+        port = free_port()
+        with running_server(dbname, port, args.workers):
+            url = f"ws://127.0.0.1:{port}/"
+            if frames is not None:
+                asyncio.run(replay(url, cdc, frames, args.speed, stats))
+            else:
+                recorder = None
+                if args.record:
+                    recorder = TraceRecorder(args.record, {key: getattr(args, key) for key in
+                                                           ("users", "chats", "history", "seed", "codec")})
+                try:
+                    asyncio.run(drive(url, cdc, users, args, recorder, stats))
+                finally:
+                    if recorder is not None:
+                        recorder.close()
+
+    report = stats.report()
+    report["args"] = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+
+    compare = None
+    if args.compare:
+        with open(args.compare) as f:
+            compare = json.load(f)
+    print_report(report, compare)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+In-process caches for rarely-changing rows.
+
+Caches are shared by every socket in the process and are accessed both from the
+IOLoop and from the DB executor's threads, so everything here is thread-safe.
+Changes are reported to listeners, which the server uses to tell other processes.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import *
+
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "100000"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "100000"))
+# Seconds a cached user is trusted for, bounds staleness if an invalidation is ever missed
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+_MISSING = object()
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A thread-safe LRU cache with an optional time-to-live
+    """
+
+    def __init__(self, max_size: int, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[K, tuple[V, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: K, default: Any = None) -> V | Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING or (self.ttl is not None and item[1] < time.monotonic()):
+                if item is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def peek(self, key: K, default: Any = None) -> V | Any:
+        """
+        Get a value without counting a hit/miss or refreshing its position
+        """
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING or (self.ttl is not None and item[1] < time.monotonic()):
+                return default
+            return item[0]
+
+    def set(self, key: K, value: V) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl is not None else 0.0
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, key: K, func: Callable[[V], V]) -> None:
+        """
+        Replace a cached value with func(value), if it is cached
+        """
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING:
+                self._data[key] = (func(item[0]), item[1])
+
+    def pop(self, key: K) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+class MembershipIndex:
+    """
+    Chat membership in both directions: chat ID -> member IDs, and user ID -> chat IDs.
+    Entries are loaded lazily by the caller and kept up to date by member_added/member_removed.
+    """
+
+    def __init__(self, max_size: int = MEMBERSHIP_CACHE_SIZE):
+        self.chat_members: LRUCache[int, frozenset[int]] = LRUCache(max_size)
+        self.user_chats: LRUCache[int, frozenset[int]] = LRUCache(max_size)
+        # Bumped on every change, a load that raced with a change isn't cached
+        self.generation = 0
+        # Called with (chat_id, user_ids, joined) whenever membership changes locally
+        self.listeners: list[Callable[[int, tuple[int, ...], bool], Any]] = []
+
+    def get_chat_members(self, chat_id: int, loader: Callable[[int], Iterable[int]]) -> frozenset[int]:
+        """
+        Get the members of a chat, loading them on a miss
+        :param chat_id: chat to look up
+        :param loader: called with the chat ID to get the members from the database
+        :return: the member IDs
+        """
+        members = self.chat_members.get(chat_id)
+        if members is None:
+            members = self.load_chat_members(chat_id, loader)
+        return members
+
+    def load_chat_members(self, chat_id: int, loader: Callable[[int], Iterable[int]]) -> frozenset[int]:
+        """
+        Load the members of a chat and cache them, for callers that already missed with peek_chat_members
+        """
+        generation = self.generation
+        members = frozenset(loader(chat_id))
+        if generation == self.generation:
+            self.chat_members.set(chat_id, members)
+        return members
+
+    def get_user_chats(self, user_id: int, loader: Callable[[int], Iterable[int]]) -> frozenset[int]:
+        """
+        Get the chats of a user, loading them on a miss
+        :param user_id: user to look up
+        :param loader: called with the user ID to get the chat IDs from the database
+        :return: the chat IDs
+        """
+        chats = self.user_chats.get(user_id)
+        if chats is None:
+            generation = self.generation
+            chats = frozenset(loader(user_id))
+            if generation == self.generation:
+                self.user_chats.set(user_id, chats)
+        return chats
+
+    def peek_chat_members(self, chat_id: int) -> frozenset[int] | None:
+        """
+        Get the members of a chat only if they are cached
+        """
+        return self.chat_members.get(chat_id)
+
+    def peek_user_chats(self, user_id: int) -> frozenset[int] | None:
+        """
+        Get the chats of a user only if they are cached
+        """
+        return self.user_chats.get(user_id)
+
+    def loaded_user_chats(self, user_id: int, chat_ids: Iterable[int], generation: int) -> None:
+        """
+        Cache the chats of a user that were read along with something else, e.g. their chat list
+        :param generation: the index's generation from before they were read
+        """
+        if generation == self.generation:
+            self.user_chats.set(user_id, frozenset(chat_ids))
+
+    def loaded_members(self, user_id: int, chats: dict[int, Iterable[int]], generation: int) -> None:
+        """
+        Cache the chats of a user along with the members of each of them
+        :param chats: chat ID -> member IDs, for every chat of the user
+        :param generation: the index's generation from before they were read
+        """
+        if generation != self.generation:
+            return
+        self.user_chats.set(user_id, frozenset(chats))
+        for chat_id, members in chats.items():
+            self.chat_members.set(chat_id, frozenset(members))
+
+    def apply(self, chat_id: int, user_ids: Iterable[int], joined: bool) -> None:
+        """
+        Apply a membership change to whatever is cached, without notifying listeners.
+        Used for changes that happened in another process.
+        """
+        user_ids = frozenset(user_ids)
+        self.generation += 1
+        if joined:
+            self.chat_members.update(chat_id, lambda members: members | user_ids)
+            for user_id in user_ids:
+                self.user_chats.update(user_id, lambda chats: chats | {chat_id})
+        else:
+            self.chat_members.update(chat_id, lambda members: members - user_ids)
+            for user_id in user_ids:
+                self.user_chats.update(user_id, lambda chats: chats - {chat_id})
+
+    def member_added(self, chat_id: int, *user_ids: int) -> None:
+        self.apply(chat_id, user_ids, True)
+        for listener in self.listeners:
+            listener(chat_id, user_ids, True)
+
+    def member_removed(self, chat_id: int, *user_ids: int) -> None:
+        self.apply(chat_id, user_ids, False)
+        for listener in self.listeners:
+            listener(chat_id, user_ids, False)
+
+    def invalidate_chat(self, chat_id: int) -> None:
+        self.generation += 1
+        self.chat_members.pop(chat_id)
+
+    def invalidate_user(self, user_id: int) -> None:
+        self.generation += 1
+        self.user_chats.pop(user_id)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self.chat_members.clear()
+        self.user_chats.clear()
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            "chat_members": self.chat_members.stats(),
+            "user_chats": self.user_chats.stats()
+        }
+
+
+class UserCache:
+    """
+    Users by user_id, with firebase_id and user_tag as secondary keys pointing at the user_id.
+    Secondary hits are checked against the cached user, so a stale key (e.g. an old tag) is just a miss.
+    Only users that exist are cached, a lookup that found nothing always goes to the database.
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.by_id: LRUCache[int, Any] = LRUCache(max_size, ttl)
+        self.by_fuid: LRUCache[str, int] = LRUCache(max_size, ttl)
+        self.by_tag: LRUCache[str, int] = LRUCache(max_size, ttl)
+        # Called with the user_id whenever a user changes locally
+        self.listeners: list[Callable[[int], Any]] = []
+
+        self.hits = {"user_id": 0, "firebase_id": 0, "user_tag": 0}
+        self.misses = {"user_id": 0, "firebase_id": 0, "user_tag": 0}
+
+    def _count(self, key_type: str, user: Any) -> Any:
+        if user is None:
+            self.misses[key_type] += 1
+        else:
+            self.hits[key_type] += 1
+        return user
+
+    def get(self, user_id: int) -> Any:
+        return self._count("user_id", self.by_id.get(user_id))
+
+    def get_by_fuid(self, firebase_id: str) -> Any:
+        user_id = self.by_fuid.get(firebase_id)
+        user = self.by_id.get(user_id) if user_id is not None else None
+        if user is not None and user.firebase_id != firebase_id:
+            user = None
+        return self._count("firebase_id", user)
+
+    def get_by_tag(self, user_tag: str) -> Any:
+        user_id = self.by_tag.get(user_tag)
+        user = self.by_id.get(user_id) if user_id is not None else None
+        if user is not None and user.user_tag != user_tag:
+            user = None
+        return self._count("user_tag", user)
+
+    def put(self, user: Any) -> None:
+        """
+        Cache a user as just read from the database. If it replaces a cached version, stale keys are dropped.
+        """
+        old = self.by_id.peek(user.user_id)
+        if old is not None:
+            if old.user_tag != user.user_tag:
+                self.by_tag.pop(old.user_tag)
+            if old.firebase_id != user.firebase_id:
+                self.by_fuid.pop(old.firebase_id)
+
+        self.by_id.set(user.user_id, user)
+        self.by_fuid.set(user.firebase_id, user.user_id)
+        self.by_tag.set(user.user_tag, user.user_id)
+
+    def user_changed(self, user: Any) -> None:
+        """
+        Cache a user that was just written, and tell listeners
+        """
+        self.put(user)
+        for listener in self.listeners:
+            listener(user.user_id)
+
+    def invalidate(self, user_id: int) -> None:
+        old = self.by_id.peek(user_id)
+        self.by_id.pop(user_id)
+        if old is not None:
+            self.by_fuid.pop(old.firebase_id)
+            self.by_tag.pop(old.user_tag)
+
+    def clear(self) -> None:
+        self.by_id.clear()
+        self.by_fuid.clear()
+        self.by_tag.clear()
+
+    def stats(self) -> dict[str, Any]:
+        hits = sum(self.hits.values())
+        lookups = hits + sum(self.misses.values())
+        return {
+            "size": len(self.by_id),
+            "hits": dict(self.hits),
+            "misses": dict(self.misses),
+            "hit_ratio": hits / lookups if lookups else 0.0
+        }
+
+
+membership = MembershipIndex()
+users = UserCache()
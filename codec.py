@@ -0,0 +1,181 @@
+"""
+Wire formats, chosen per connection through the WebSocket subprotocol.
+
+Handlers always work with frames as dicts, in the shape of the JSON protocol.
+A codec turns those into bytes on the wire and back:
+
+- JSON ("twaddle.json", or no subprotocol at all) sends the dicts as they are.
+- MessagePack ("twaddle.msgpack") packs frames into arrays, with integer opcodes and event codes:
+    op 1 request:   [1, id, event, data]
+    op 1 response:  [1, id, event, success, data]
+    op 2 push:      [2, data]
+    op 3 request:   [3, id, [[event, data], ...], mode]
+    op 3 response:  [3, id, success, mode, [[op 1 response, ...], ...], failed]
+    op 4 ephemeral: [4, data]
+  Events without a code are sent by name.
+"""
+import json
+from abc import ABC, abstractmethod
+from typing import *
+
+import msgpack
+
+# Never reuse or renumber a code, clients depend on them
+EVENT_CODES: dict[str, int] = {
+    "CREATE_USER": 1,
+    "LOGIN_USER": 2,
+    "CREATE_USER_CHAT": 3,
+    "LOAD_USER_CHATS": 4,
+    "LOAD_SINGLE_CHAT": 5,
+    "UPDATE_DETAILS": 6,
+    "MARK_AS_READ": 7,
+    "SEND_CHAT_MESSAGE": 8,
+    "SEARCH_MESSAGES": 9,
+    "SEARCH_USERS": 10,
+    "SYNC_SINCE": 11,
+}
+EVENT_NAMES: dict[int, str] = {code: name for name, code in EVENT_CODES.items()}
+
+
+class CodecException(Exception):
+    pass
+
+
+class Codec(ABC):
+    # Name used to share encoded frames between sockets using the same codec
+    name: str = ""
+    subprotocol: str = ""
+    # Whether frames are sent as binary WebSocket messages
+    binary: bool = False
+
+    @abstractmethod
+    def encode(self, frame: dict) -> str | bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, data: str | bytes) -> dict:
+        pass
+
+    @staticmethod
+    def _checked(frame: Any) -> dict:
+        """
+        Make sure a decoded frame has the shape the handlers rely on: an object, with an object as its "data"
+        """
+        if not isinstance(frame, dict):
+            raise CodecException("Expected an object frame")
+        if not isinstance(frame.get("data"), dict):
+            raise CodecException("Expected an object as the frame's data")
+        return frame
+
+
+class JsonCodec(Codec):
+    name = "json"
+    subprotocol = "twaddle.json"
+
+    def encode(self, frame: dict) -> str:
+        return json.dumps(frame)
+
+    def decode(self, data: str | bytes) -> dict:
+        return self._checked(json.loads(data))
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+    subprotocol = "twaddle.msgpack"
+    binary = True
+
+    def encode(self, frame: dict) -> bytes:
+        return msgpack.packb(self._pack(frame), use_bin_type=True)
+
+    def decode(self, data: str | bytes) -> dict:
+        if isinstance(data, str):
+            raise CodecException("Expected a binary frame")
+        try:
+            packed = msgpack.unpackb(data, raw=False)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise CodecException(f"Malformed frame: {e}") from e
+        if not isinstance(packed, list) or not packed:
+            raise CodecException("Expected an array frame")
+        return self._checked(self._unpack(packed))
+
+    @staticmethod
+    def _event_code(event: str) -> int | str:
+        return EVENT_CODES.get(event, event)
+
+    @staticmethod
+    def _event_name(code: int | str) -> str:
+        return EVENT_NAMES.get(code, code) if isinstance(code, int) else code
+
+    def _pack_response(self, resp: dict) -> list:
+        data = resp["data"]
+        return [1, resp.get("id"), self._event_code(data.get("e")), data.get("s"), data.get("data")]
+
+    def _pack(self, frame: dict) -> list:
+        op = frame.get("op")
+        data = frame.get("data")
+
+        if op == 1:
+            if "e" in data:
+                return self._pack_response(frame)
+            return [1, frame.get("id"), self._event_code(data.get("event")), data.get("data")]
+
+        if op in (2, 4):
+            return [op, data]
+
+        if op == 3:
+            if "results" in data:
+                results = [[self._pack_response(resp) for resp in res_ls] for res_ls in data.get("results")]
+                return [3, frame.get("id"), data.get("s"), data.get("mode"), results, data.get("failed")]
+            events = [[self._event_code(item.get("event")), item.get("data")] for item in data.get("events")]
+            return [3, frame.get("id"), events, data.get("mode")]
+
+        raise CodecException(f"Can't encode op {op}")
+
+    def _unpack(self, packed: list) -> dict:
+        op = packed[0]
+        try:
+            if op == 1 and len(packed) == 4:
+                _, request_id, event, data = packed
+                return {"op": 1, "id": request_id, "data": {"event": self._event_name(event), "data": data}}
+
+            if op == 1:
+                _, request_id, event, success, data = packed
+                resp = {"op": 1, "id": request_id, "data": {"e": self._event_name(event), "s": success}}
+                if data is not None:
+                    resp["data"]["data"] = data
+                return resp
+
+            if op in (2, 4) and len(packed) == 2:
+                return {"op": op, "data": packed[1]}
+
+            if op == 3 and len(packed) == 4:
+                _, request_id, events, mode = packed
+                batch = {"events": [{"event": self._event_name(event), "data": data} for event, data in events]}
+                # nil is how msgpack clients leave the mode out
+                if mode is not None:
+                    batch["mode"] = mode
+                return {"op": 3, "id": request_id, "data": batch}
+        except (TypeError, ValueError, IndexError) as e:
+            raise CodecException(f"Malformed op {op} frame: {e}") from e
+
+        raise CodecException(f"Can't decode op {op}")
+
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec()
+
+# Subprotocol -> codec, a client listing several gets the first one it listed
+CODECS: dict[str, Codec] = {codec.subprotocol: codec for codec in (JSON, MSGPACK)}
+
+
+def select_codec(subprotocols: list[str]) -> Codec:
+    """
+    Pick the codec for a connection
+    :param subprotocols: the subprotocols the client asked for, in its order of preference
+    :return: the first one we support, JSON if there are none
+    """
+    for subprotocol in subprotocols:
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec
+    return JSON
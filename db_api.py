@@ -1,32 +1,90 @@
+import asyncio
 import datetime
+import functools
+import logging
 import math
 import os
+import sys
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
 from typing import *
 import psycopg2
+import psycopg2.extensions
 from psycopg2 import errors as pgerr
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
+import metrics
+import statements
+from caches import membership, users as user_cache
+from db_pool import ConnectionPool, get_pool
+
 
 load_dotenv()
 
-USERNAME = os.getenv("DB_USERNAME")
-PASSWORD = os.getenv("DB_PASSWORD")
+LOGGER = logging.getLogger(__name__)
+
+# Max number of queries that may run at the same time off the IOLoop
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "8"))
+
+# Chat history is sent in pages/chunks of this many messages
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 500
+
+# Search results are sent in pages of this many results
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+# User search is paged by offset, which gets slower the deeper it goes
+SEARCH_MAX_OFFSET = 500
+# Text search configuration of the messages' full-text index. "simple" doesn't stem, so it works for any language.
+# Queries must use the same configuration as the index for it to be used.
+MESSAGE_SEARCH_CONFIG = "simple"
+
+# Reconnecting clients are sent the messages they missed in pages of this many
+SYNC_PAGE_SIZE = 200
+SYNC_MAX_PAGE_SIZE = 1000
+
+# Group commit of new messages: at most this many per transaction,
+# and a message waits at most this many seconds for others to join it. 0/1 to turn it off.
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "256"))
+MESSAGE_BATCH_DELAY = float(os.getenv("MESSAGE_BATCH_DELAY_MS", "2")) / 1000
+
+# Read markers are kept in memory and written at most this often, in seconds. 0 to write them right away.
+READ_MARKER_FLUSH_INTERVAL = float(os.getenv("READ_MARKER_FLUSH_MS", "1000")) / 1000
 
 
 class ToDict:
+    __slots__ = ()
+
     @abstractmethod
     def serialize(self):
         pass
 
+    @classmethod
+    def serialize_rows(cls, rows: Iterable[tuple]) -> list[dict]:
+        """
+        Serialize rows straight from a cursor, without building model objects.
+        The rows' columns have to be in the order of the model's __slots__, with timestamps already in epoch seconds.
+        :param rows: rows to serialize
+        :return: wire-ready dicts
+        """
+        fields = cls.__slots__
+        return [dict(zip(fields, row)) for row in rows]
+
+
+def to_epoch(value: int | datetime.datetime) -> int:
+    if isinstance(value, datetime.datetime):
+        return math.floor(value.timestamp())
+    return value
+
 
 class Chat:
+    __slots__ = ("chat_id", "creation_time", "name")
+
     def __init__(self, chat_id: int, creation_time: int | datetime.datetime, name: str | None = None):
         self.chat_id = chat_id
-        if isinstance(creation_time, datetime.datetime):
-            self.creation_time = math.floor(creation_time.timestamp())
-        else:
-            self.creation_time = creation_time
+        self.creation_time = to_epoch(creation_time)
         self.name = name
 
     @classmethod
@@ -35,19 +93,18 @@ class Chat:
 
 
 class Message(ToDict):
+    __slots__ = ("message_id", "chat_id", "author_id", "time_sent", "content")
+
     def __init__(self,
                  message_id: int,
                  chat_id: int,
                  author_id: int,
-                 time_sent: int,
+                 time_sent: int | datetime.datetime,
                  content: str):
         self.message_id = message_id
         self.chat_id = chat_id
         self.author_id = author_id
-        if isinstance(time_sent, datetime.datetime):
-            self.time_sent = math.floor(time_sent.timestamp())
-        else:
-            self.time_sent = time_sent
+        self.time_sent = to_epoch(time_sent)
         self.content = content
 
     @classmethod
@@ -55,10 +112,29 @@ class Message(ToDict):
         return cls(*tup)
 
     def serialize(self):
-        return self.__dict__
+        return {
+            "message_id": self.message_id,
+            "chat_id": self.chat_id,
+            "author_id": self.author_id,
+            "time_sent": self.time_sent,
+            "content": self.content
+        }
+
+    @classmethod
+    def serialize_rows(cls, rows: Iterable[tuple]) -> list[dict]:
+        # History is the bulkiest thing we send, so this skips the generic zip for a plain comprehension
+        return [{
+            "message_id": message_id,
+            "chat_id": chat_id,
+            "author_id": author_id,
+            "time_sent": time_sent,
+            "content": content
+        } for message_id, chat_id, author_id, time_sent, content in rows]
 
 
 class DisplayChat(ToDict):
+    __slots__ = ("chat_id", "name", "unreads", "last_message", "last_msg_preview", "time_last_msg")
+
     def __init__(
             self,
             chat_id: int,
@@ -66,17 +142,14 @@ class DisplayChat(ToDict):
             unreads: int,
             last_message: int,
             last_msg_preview: str,
-            time_last_msg: int
+            time_last_msg: int | datetime.datetime
     ):
         self.chat_id = chat_id
         self.name = name
         self.unreads = unreads
         self.last_message = last_message
         self.last_msg_preview = last_msg_preview
-        if isinstance(time_last_msg, datetime.datetime):
-            self.time_last_msg = math.floor(time_last_msg.timestamp())
-        else:
-            self.time_last_msg = time_last_msg
+        self.time_last_msg = to_epoch(time_last_msg)
 
     def serialize(self):
         return {
@@ -90,6 +163,7 @@ class DisplayChat(ToDict):
 
 
 class User(ToDict):
+    __slots__ = ("user_id", "firebase_id", "user_tag", "user_name")
 
     def __init__(self,
                  user_id: int,
@@ -115,201 +189,486 @@ class User(ToDict):
         }
 
 
+# Message columns in Message.__slots__ order, with time_sent in epoch seconds.
+# Timestamps are stored without a time zone, and are read in the session's time zone.
+MESSAGE_COLUMNS = """message_id, chat_id, author_id, 
+EXTRACT(EPOCH FROM time_sent::timestamptz)::bigint AS time_sent, content"""
+
+
+# Builds DisplayChat rows for a user (%(user_id)s), callers append extra filters and ordering.
+# The last message is the one with the highest ID: time_sent only has second precision, and a group commit
+# gives all of its messages the same one.
+# The name falls back to the other member's name for user chats,
+# and unreads come from the per-member counter kept up to date on write.
+DISPLAY_CHATS_QUERY = """SELECT c.chat_id,
+       COALESCE(c.name, other_user.user_name) AS name,
+       cu.unread_count AS unreads,
+       COALESCE(last_msg.message_id, 0) AS last_message,
+       COALESCE(LEFT(last_msg.content, 64), '') AS last_msg_preview,
+       EXTRACT(EPOCH FROM COALESCE(last_msg.time_sent, c.creation_time)::timestamptz)::bigint AS time_last_msg
+FROM chats_users cu
+JOIN chats c ON c.chat_id = cu.chat_id
+LEFT JOIN LATERAL (
+    SELECT u.user_name
+    FROM chats_users other_cu
+    JOIN users u ON u.user_id = other_cu.user_id
+    WHERE other_cu.chat_id = cu.chat_id
+    AND other_cu.user_id <> cu.user_id
+    LIMIT 1
+) other_user ON c.name IS NULL
+LEFT JOIN LATERAL (
+    SELECT m.message_id, m.content, m.time_sent
+    FROM messages m
+    WHERE m.chat_id = cu.chat_id
+    ORDER BY m.message_id DESC
+    LIMIT 1
+) last_msg ON TRUE
+WHERE cu.user_id = %(user_id)s
+"""
+
+# Rebuilds unread counters from the messages table, for one chat (%(chat_id)s) or all of them (NULL)
+RECONCILE_UNREAD_COUNTS_QUERY = """UPDATE chats_users cu
+SET unread_count = counted.count
+FROM chats_users cu2
+CROSS JOIN LATERAL (
+    SELECT COUNT(*) AS count
+    FROM messages m
+    WHERE m.chat_id = cu2.chat_id
+    AND m.message_id > COALESCE(cu2.last_read_message, 0)
+    AND m.author_id <> cu2.user_id
+) counted
+WHERE cu.chat_id = cu2.chat_id
+AND cu.user_id = cu2.user_id
+AND cu.unread_count <> counted.count
+AND (%(chat_id)s::integer IS NULL OR cu.chat_id = %(chat_id)s)
+"""
+
+# The queries run on every event, prepared once per connection and run by name.
+# Writes hand back their rows with RETURNING instead of reading them again.
+statements.register("load_user", "SELECT * FROM users WHERE user_id = %(user_id)s", {"user_id": 1})
+statements.register("load_user_by_fuid", "SELECT * FROM users WHERE firebase_id = %(fuid)s", {"fuid": "fuid"})
+statements.register("load_user_by_tag", "SELECT * FROM users WHERE user_tag = %(user_tag)s", {"user_tag": "tag"})
+statements.register("register_user", """INSERT INTO users (firebase_id, user_tag, user_name)
+VALUES (%(firebase_id)s, %(user_tag)s, %(user_name)s)
+RETURNING *""", {"firebase_id": "fuid", "user_tag": "tag", "user_name": "name"})
+statements.register("update_user", """UPDATE users
+SET user_tag = %(user_tag)s, user_name = %(user_name)s
+WHERE user_id = %(user_id)s
+RETURNING *""", {"user_id": 1, "user_tag": "tag", "user_name": "name"})
+statements.register("get_chat", "SELECT * FROM chats WHERE chat_id = %(chat_id)s", {"chat_id": 1})
+# 1:1 chats are found through direct_chats, keyed by the ordered pair of their members
+statements.register("get_chat_by_users", """SELECT c.*
+FROM direct_chats d
+JOIN chats c ON c.chat_id = d.chat_id
+WHERE d.low_user_id = LEAST(%(user_id_1)s::integer, %(user_id_2)s::integer)
+AND d.high_user_id = GREATEST(%(user_id_1)s::integer, %(user_id_2)s::integer)""", {"user_id_1": 1, "user_id_2": 2})
+# Claims the pair first: of two concurrent requests for the same pair, the second waits for the first,
+# then inserts nothing and returns no row
+statements.register("create_user_chat", """WITH pair AS (
+    INSERT INTO direct_chats (low_user_id, high_user_id, chat_id)
+    VALUES (LEAST(%(user_id_1)s::integer, %(user_id_2)s::integer),
+            GREATEST(%(user_id_1)s::integer, %(user_id_2)s::integer),
+            nextval(pg_get_serial_sequence('chats', 'chat_id')))
+    ON CONFLICT (low_user_id, high_user_id) DO NOTHING
+    RETURNING chat_id
+), new_chat AS (
+    INSERT INTO chats (chat_id, creation_time)
+    SELECT chat_id, now()
+    FROM pair
+    RETURNING *
+), members AS (
+    INSERT INTO chats_users (chat_id, user_id, join_time)
+    SELECT new_chat.chat_id, member.user_id, new_chat.creation_time
+    FROM new_chat, (VALUES (%(user_id_1)s::integer), (%(user_id_2)s::integer)) member(user_id)
+)
+SELECT * FROM new_chat""", {"user_id_1": 1, "user_id_2": 2})
+statements.register("get_user_chats", "SELECT * FROM chats_users WHERE user_id = %(user_id)s", {"user_id": 1})
+statements.register("load_chat_user_ids", "SELECT user_id FROM chats_users WHERE chat_id = %(chat_id)s",
+                    {"chat_id": 1})
+statements.register("load_user_chat_ids", "SELECT chat_id FROM chats_users WHERE user_id = %(user_id)s",
+                    {"user_id": 1})
+# Every chat of a user with its members, to warm the membership cache when they log in
+statements.register("load_user_chat_members", """SELECT cu.chat_id, array_agg(members.user_id)
+FROM chats_users cu
+JOIN chats_users members ON members.chat_id = cu.chat_id
+WHERE cu.user_id = %(user_id)s
+GROUP BY cu.chat_id""", {"user_id": 1})
+statements.register("get_last_read_message_id", """SELECT last_read_message
+FROM chats_users
+WHERE chat_id = %(chat_id)s
+AND user_id = %(user_id)s""", {"chat_id": 1, "user_id": 1})
+statements.register("get_display_chat", DISPLAY_CHATS_QUERY + "AND cu.chat_id = %(chat_id)s",
+                    {"user_id": 1, "chat_id": 1})
+statements.register("load_user_chats", DISPLAY_CHATS_QUERY + "ORDER BY time_last_msg DESC, cu.chat_id DESC",
+                    {"user_id": 1})
+statements.register("get_message", f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE message_id = %(message_id)s",
+                    {"message_id": 1})
+statements.register("get_last_message_in_chat", f"""SELECT {MESSAGE_COLUMNS}
+FROM messages
+WHERE chat_id = %(chat_id)s
+ORDER BY message_id DESC
+LIMIT 1""", {"chat_id": 1})
+statements.register("get_chat_messages", f"""SELECT {MESSAGE_COLUMNS}
+FROM messages
+WHERE chat_id = %(chat_id)s
+ORDER BY message_id DESC""", {"chat_id": 1})
+CHAT_MESSAGES_PAGE_QUERY = f"""SELECT {MESSAGE_COLUMNS}
+FROM messages
+WHERE chat_id = %(chat_id)s
+AND (%(before)s::integer IS NULL OR message_id < %(before)s)
+AND (%(after)s::integer IS NULL OR message_id > %(after)s)
+ORDER BY message_id {{order}}
+LIMIT %(limit)s"""
+statements.register("get_chat_messages_page_desc", CHAT_MESSAGES_PAGE_QUERY.format(order="DESC"),
+                    {"chat_id": 1, "before": 1000, "after": None, "limit": HISTORY_PAGE_SIZE})
+statements.register("get_chat_messages_page_asc", CHAT_MESSAGES_PAGE_QUERY.format(order="ASC"),
+                    {"chat_id": 1, "before": None, "after": 1000, "limit": HISTORY_PAGE_SIZE})
+# Markers only move forward, to the last message of the chat at or before the one asked for (its last message if NULL).
+# Each member's unread counter loses the messages their marker moved past, rather than being reset,
+# so a message committed while the markers are written stays counted.
+statements.register("mark_chats_as_read", """UPDATE chats_users cu
+SET last_read_message = marked.message_id,
+    marker_version = txid_current(),
+    unread_count = GREATEST(cu.unread_count - (
+        SELECT COUNT(*)
+        FROM messages m
+        WHERE m.chat_id = cu.chat_id
+        AND m.message_id > COALESCE(cu.last_read_message, 0)
+        AND m.message_id <= marked.message_id
+        AND m.author_id <> cu.user_id
+    ), 0)
+FROM (
+    SELECT v.chat_id, v.user_id, (
+        SELECT m.message_id
+        FROM messages m
+        WHERE m.chat_id = v.chat_id
+        AND (v.message_id IS NULL OR m.message_id <= v.message_id)
+        ORDER BY m.message_id DESC
+        LIMIT 1
+    ) AS message_id
+    FROM unnest(%(chat_ids)s::integer[], %(user_ids)s::integer[], %(message_ids)s::integer[])
+        v(chat_id, user_id, message_id)
+) marked
+WHERE cu.chat_id = marked.chat_id
+AND cu.user_id = marked.user_id
+AND marked.message_id > COALESCE(cu.last_read_message, 0)""",
+                    {"chat_ids": [1, 2], "user_ids": [1, 1], "message_ids": [None, 1000]})
+# Newest matches first, only in chats the user is a member of. Paged with the last message_id of the previous page.
+statements.register("search_messages", f"""SELECT {MESSAGE_COLUMNS}
+FROM messages
+WHERE to_tsvector('{MESSAGE_SEARCH_CONFIG}', content) @@ websearch_to_tsquery('{MESSAGE_SEARCH_CONFIG}', %(query)s)
+AND chat_id IN (SELECT chat_id FROM chats_users WHERE user_id = %(user_id)s)
+AND (%(chat_id)s::integer IS NULL OR chat_id = %(chat_id)s)
+AND (%(before)s::integer IS NULL OR message_id < %(before)s)
+ORDER BY message_id DESC
+LIMIT %(limit)s""", {"query": "hello world", "user_id": 1, "chat_id": None, "before": None, "limit": SEARCH_PAGE_SIZE})
+# Tag prefix, or name substring, or either one similar (pg_trgm) to the query. Exact and prefix tag matches come first.
+# firebase_id isn't selected, search results mustn't expose it.
+statements.register("search_users", """SELECT user_id, user_tag, user_name
+FROM users
+WHERE user_tag LIKE %(prefix)s
+OR user_name ILIKE %(contains)s
+OR user_tag %% %(query)s
+OR user_name %% %(query)s
+ORDER BY user_tag = %(tag)s DESC,
+         user_tag LIKE %(prefix)s DESC,
+         GREATEST(similarity(user_tag, %(query)s), similarity(user_name, %(query)s)) DESC,
+         user_id
+LIMIT %(limit)s
+OFFSET %(offset)s""", {"query": "tag", "tag": "tag", "prefix": "tag%", "contains": "%tag%", "limit": SEARCH_PAGE_SIZE, "offset": 0})
+# SYNC_SINCE. Read marker and message versions are the IDs of the transactions that wrote them
+# (see migrations 7 and 8). The version handed back is the oldest transaction still running, so rows that
+# weren't visible yet are at or after it, and are sent on the next sync.
+statements.register("sync_read_markers", """WITH snapshot AS (
+    SELECT txid_snapshot_xmin(txid_current_snapshot()) AS version
+)
+SELECT snapshot.version, cu.chat_id, COALESCE(cu.last_read_message, 0)
+FROM snapshot
+LEFT JOIN chats_users cu ON cu.user_id = %(user_id)s
+AND cu.marker_version >= %(version)s""", {"user_id": 1, "version": 0})
+statements.register("sync_chats", DISPLAY_CHATS_QUERY + """AND (cu.marker_version >= %(version)s
+    OR EXISTS (SELECT 1 FROM messages m WHERE m.chat_id = cu.chat_id AND m.message_id > %(after)s))
+ORDER BY time_last_msg DESC, cu.chat_id DESC""", {"user_id": 1, "version": 0, "after": 1000})
+# Message IDs are taken before their transaction commits, so a message can become visible after a sync
+# already moved past its ID. Those committed between the client's version and the current one are found here,
+# and the sync goes back to the first of them.
+statements.register("sync_late_message", """SELECT MIN(message_id)
+FROM messages
+WHERE xact_id >= %(version)s
+AND xact_id < %(snapshot)s
+AND message_id <= %(after)s
+AND chat_id IN (SELECT chat_id FROM chats_users WHERE user_id = %(user_id)s)""",
+                    {"user_id": 1, "version": 1000, "snapshot": 2000, "after": 1000})
+# Walks messages by message_id, only keeping those of the user's chats
+statements.register("sync_messages", f"""SELECT {MESSAGE_COLUMNS}
+FROM messages
+WHERE message_id > %(after)s
+AND chat_id IN (SELECT chat_id FROM chats_users WHERE user_id = %(user_id)s)
+ORDER BY message_id
+LIMIT %(limit)s""", {"user_id": 1, "after": 1000, "limit": SYNC_PAGE_SIZE})
+# The unread counters are bumped by the same statement, so they can't drift from the messages
+statements.register("create_new_message", f"""WITH new_message AS (
+    INSERT INTO messages (chat_id, author_id, time_sent, content)
+    VALUES (%(chat_id)s, %(user_id)s, now(), %(content)s)
+    RETURNING {MESSAGE_COLUMNS}
+), unread AS (
+    UPDATE chats_users
+    SET unread_count = unread_count + 1
+    WHERE chat_id = %(chat_id)s
+    AND user_id <> %(user_id)s
+)
+SELECT * FROM new_message""", {"chat_id": 1, "user_id": 1, "content": "content"})
+
+
 class Database:
-    def __init__(self):
-        self.connection = psycopg2.connect(
-            dbname="twaddle_db",
-            user=USERNAME,
-            password=PASSWORD,
-            host="localhost",
-            port=5432
-        )
+    """
+    Twaddle's queries. Every call borrows a connection from the shared pool,
+    so instances are cheap and hold no connection of their own.
+    Instances returned by transaction() are the exception, and run every call on the transaction's connection.
+    """
+
+    def __init__(self, pool: ConnectionPool | None = None, conn: psycopg2.extensions.connection | None = None):
+        self.pool = pool if pool is not None else get_pool()
+        # Only set on instances bound to a transaction
+        self.conn = conn
+        # Work to do once the bound transaction commits
+        self.on_commit: list[tuple[Callable, tuple]] = []
+
+    @contextmanager
+    def _cursor(self) -> Iterator[psycopg2.extensions.cursor]:
+        """
+        Borrow a pooled connection and open a cursor on it.
+        The work done in the with block is committed when it exits cleanly.
+        In a transaction, the transaction's connection is used and nothing is committed until it ends.
+        """
+        if self.conn is not None:
+            with self.conn.cursor() as crsr:
+                yield crsr
+                metrics.count_rows(crsr.rowcount)
+            return
+
+        with self.pool.connection() as conn, conn.cursor() as crsr:
+            yield crsr
+            metrics.count_rows(crsr.rowcount)
+
+    @contextmanager
+    def transaction(self) -> Iterator['Database']:
+        """
+        Run several calls in one transaction, committed when the with block exits cleanly
+        :return: a Database bound to the transaction
+        """
+        with self.pool.connection() as conn:
+            db = Database(self.pool, conn)
+            yield db
+        db.run_on_commit()
+
+    def after_commit(self, func: Callable, *args) -> Any:
+        """
+        Run func once the current transaction commits, or right away outside of a transaction.
+        Used for side effects (cache updates, pushes) that must not outlive a rollback.
+        """
+        if self.conn is None:
+            return func(*args)
+        self.on_commit.append((func, args))
+
+    def run_on_commit(self) -> None:
+        on_commit, self.on_commit = self.on_commit, []
+        for func, args in on_commit:
+            func(*args)
+
+    def savepoint(self) -> int:
+        """
+        Set a savepoint in the current transaction
+        :return: marker to pass to rollback_to_savepoint
+        """
+        if self.conn is None:
+            raise ValueError("Savepoints can only be used in a transaction")
+        with self._cursor() as crsr:
+            crsr.execute("SAVEPOINT batch_item")
+        return len(self.on_commit)
+
+    def release_savepoint(self) -> None:
+        with self._cursor() as crsr:
+            crsr.execute("RELEASE SAVEPOINT batch_item")
+
+    def rollback_to_savepoint(self, marker: int) -> None:
+        """
+        Undo everything done since the last savepoint, including work deferred with after_commit
+        :param marker: returned by savepoint
+        """
+        with self._cursor() as crsr:
+            crsr.execute("ROLLBACK TO SAVEPOINT batch_item; RELEASE SAVEPOINT batch_item")
+        del self.on_commit[marker:]
 
     def register_user(self, firebase_id: str, user_tag: str, user_name: str) -> User | None:
         try:
-            with self.connection.cursor() as crsr:
-                crsr.execute("INSERT INTO users (firebase_id, user_tag, user_name) VALUES (%s, %s, %s)",
-                             (firebase_id, user_tag, user_name))
-            self.connection.commit()
+            with self._cursor() as crsr:
+                statements.execute(crsr, "register_user",
+                                   {"firebase_id": firebase_id, "user_tag": user_tag, "user_name": user_name})
+                res = crsr.fetchone()
 
         except pgerr.UniqueViolation:
             return None
 
-        return self.get_user_by_fuid(firebase_id)
+        return self._cache_user(res)
+
+    def get_user(self, user_id: int) -> User | None:
+        user = user_cache.get(user_id)
+        if user is None:
+            user = self._load_user(user_id)
+        return user
 
-    def get_user(self, user_id: int):
-        with self.connection.cursor() as crsr:
-            crsr.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
+    def _load_user(self, user_id: int) -> User | None:
+        with self._cursor() as crsr:
+            statements.execute(crsr, "load_user", {"user_id": user_id})
             res = crsr.fetchone()
-        return User.from_tuple(res)
+        return self._cache_user(res)
 
     def get_chat(self, chat_id: int):
-        with self.connection.cursor() as crsr:
-            crsr.execute("SELECT * FROM chats WHERE chat_id = %s", (chat_id,))
+        with self._cursor() as crsr:
+            statements.execute(crsr, "get_chat", {"chat_id": chat_id})
             res = crsr.fetchone()
         return Chat.from_tuple(res)
 
-    def get_user_by_fuid(self, fuid: str):
-        with self.connection.cursor() as crsr:
-            crsr.execute("SELECT * FROM users WHERE firebase_id = %s", (fuid,))
+    def get_user_by_fuid(self, fuid: str) -> User | None:
+        user = user_cache.get_by_fuid(fuid)
+        if user is None:
+            user = self._load_user_by_fuid(fuid)
+        return user
+
+    def _load_user_by_fuid(self, fuid: str) -> User | None:
+        with self._cursor() as crsr:
+            statements.execute(crsr, "load_user_by_fuid", {"fuid": fuid})
             res = crsr.fetchone()
-        if res is None:
-            return None
-        return User.from_tuple(res)
+        return self._cache_user(res)
+
+    def get_user_by_tag(self, usertag: str) -> User | None:
+        user = user_cache.get_by_tag(usertag)
+        if user is None:
+            user = self._load_user_by_tag(usertag)
+        return user
 
-    def get_user_by_tag(self, usertag: str):
-        with self.connection.cursor() as crsr:
-            crsr.execute("SELECT * FROM users WHERE user_tag = %s;", (usertag,))
-            print(crsr.query)
+    def _load_user_by_tag(self, usertag: str) -> User | None:
+        with self._cursor() as crsr:
+            statements.execute(crsr, "load_user_by_tag", {"user_tag": usertag})
             res = crsr.fetchone()
         if res is None:
             return None
 
-        print(res)
+        return self._cache_user(res)
 
-        return User.from_tuple(res)
-
-    def get_chat_by_users(self, users: tuple[int, ...]) -> Chat | None:
-        with self.connection.cursor() as crsr:
-            crsr.execute("""SELECT chat_id
-FROM chats_users
-WHERE user_id IN %s
-GROUP BY chat_id
-HAVING COUNT(DISTINCT user_id) = %s;""", (users, len(users)))
-            chat_id = crsr.fetchone()
-
-            if chat_id is None:
-                return None
+    def _cache_user(self, row: tuple | None) -> User | None:
+        if row is None:
+            return None
+        user = User.from_tuple(row)
+        # A user read inside a transaction may have been written by it
+        self.after_commit(user_cache.put, user)
+        return user
 
-            crsr.execute("SELECT * FROM chats WHERE chat_id = %s", (chat_id,))
+    def get_chat_by_users(self, users: tuple[int, int]) -> Chat | None:
+        """
+        Get the 1:1 chat between two users
+        :param users: the two users, in any order
+        :return: their chat, None if they don't have one
+        """
+        with self._cursor() as crsr:
+            statements.execute(crsr, "get_chat_by_users", {"user_id_1": users[0], "user_id_2": users[1]})
             res = crsr.fetchone()
 
-            return Chat.from_tuple(res)
+        if res is None:
+            return None
+        return Chat.from_tuple(res)
 
     def get_chat_messages_tuples(self, chat_id: int) -> list[tuple]:
-        with self.connection.cursor() as crsr:
-            crsr.execute("""SELECT * 
-FROM messages 
-WHERE chat_id = %s 
-ORDER BY time_sent DESC""",
-                         (chat_id,))
+        with self._cursor() as crsr:
+            statements.execute(crsr, "get_chat_messages", {"chat_id": chat_id})
             res = crsr.fetchall()
         return res
 
     def get_last_read_message_id(self, chat_id: int, user_id: int) -> int:
-        with self.connection.cursor() as crsr:
-            crsr.execute("""SELECT last_read_message 
-FROM chats_users 
-WHERE chat_id = %s 
-AND user_id = %s""",
-                         (chat_id, user_id))
+        with self._cursor() as crsr:
+            statements.execute(crsr, "get_last_read_message_id", {"chat_id": chat_id, "user_id": user_id})
             res = crsr.fetchone()
 
         if res is None:
             return 0
         return res[0]
 
-    def get_display_chat(self, chat_id: int, user_id: int):
+    def get_display_chat(self, chat_id: int, user_id: int) -> DisplayChat | None:
         """
         Prepare and return a DisplayChat for a chat ID, user ID
         :param chat_id: chat to prepare
         :param user_id: user to get POV of
-        :return: prepared DisplayChat
+        :return: prepared DisplayChat, None if the user isn't in the chat
         """
+        with self._cursor() as crsr:
+            statements.execute(crsr, "get_display_chat", {"user_id": user_id, "chat_id": chat_id})
+            res = crsr.fetchone()
 
-        # Get the name for the chat
-        chat = self.get_chat(chat_id)
-
-        name = chat.name
-
-        # Get username of other user of chat, if chat is None.
-        # Should only happen in userchats, where there are 2 users.
-        if name is None:
-            uids = self.get_chat_user_ids(chat_id)
-
-            # We need to pop out the uids that aren't ours, should only occur once exactly but meh
-            uids_new = [uid for uid in uids if uid != user_id]
-
-            # aand set the name!
-            name = self.get_user(uids_new[0]).user_name
-
-        # We want to get the last message in the chat now, so we can get its data for the preview
-        last_msg = self.get_last_message_in_chat(chat_id)
-
-        # Set defaults if we failed to get our last message (non-existent, probably. Is a new chat?)
-        if last_msg is None:
-            message_id = 0
-            content = ""
-            time_sent = chat.creation_time
-        else:
-            message_id = last_msg.message_id
-            content = last_msg.content[:64]  # I don't want huge previews.
-            time_sent = last_msg.time_sent
-
-        # Get last read ID
-        lrm_id = self.get_last_read_message_id(chat_id, user_id)
-
-        # Count unreads until the last READ message.
-        unreads: int = 0
-        if lrm_id != 0:
-            msg_tups = self.get_chat_messages_tuples(chat_id)
-            for tup in msg_tups:
-                msg = Message.from_tuple(tup)
-                if msg.message_id == lrm_id:
-                    break
-                unreads += 1
-
-        return DisplayChat(chat_id, name, unreads, message_id, content, time_sent)
+        if res is None:
+            return None
+        return DisplayChat(*res)
 
     def create_user_chat(self, user_id_1: int, user_id_2: int) -> Chat | None:
+        """
+        Create the 1:1 chat between two users, in one statement
+        :return: the new chat, None if they already have one (or are the same user)
+        """
         try:
-            with self.connection.cursor() as crsr:
-                now = datetime.datetime.now(datetime.timezone.utc)
-
-                crsr.execute("INSERT INTO chats (creation_time) VALUES (%s); "
-                             "SELECT currval(pg_get_serial_sequence('chats', 'chat_id'));", (now,))
-
-                chat_id = crsr.fetchone()
-
-                crsr.execute("INSERT INTO chats_users (chat_id, user_id, join_time) VALUES (%s, %s, %s)",
-                             (chat_id, user_id_1, now))
-                crsr.execute("INSERT INTO chats_users (chat_id, user_id, join_time) VALUES (%s, %s, %s)",
-                             (chat_id, user_id_2, now))
+            with self._cursor() as crsr:
+                statements.execute(crsr, "create_user_chat", {"user_id_1": user_id_1, "user_id_2": user_id_2})
+                row = crsr.fetchone()
 
-                self.connection.commit()
-
-        except pgerr.UniqueViolation:
+        except (pgerr.UniqueViolation, pgerr.CheckViolation):
             return None
 
-        with self.connection.cursor() as crsr:
-            crsr.execute("SELECT * FROM chats WHERE chat_id = %s", (chat_id,))
-            tup = crsr.fetchone()
-            print(tup)
-            res = Chat.from_tuple(tup)
+        if row is None:
+            return None
+        res = Chat.from_tuple(row)
 
+        self.after_commit(membership.member_added, res.chat_id, user_id_1, user_id_2)
         return res
 
     def get_user_chats(self, user_id: int):
-        with self.connection.cursor() as crsr:
-            crsr.execute("SELECT * FROM chats_users WHERE user_id = %s", (user_id,))
+        with self._cursor() as crsr:
+            statements.execute(crsr, "get_user_chats", {"user_id": user_id})
             res = crsr.fetchall()
         return res
 
     def get_chat_user_ids(self, chat_id: int) -> list[int]:
-        with self.connection.cursor() as crsr:
-            crsr.execute("SELECT user_id FROM chats_users WHERE chat_id = %s", (chat_id,))
+        return list(membership.get_chat_members(chat_id, self._load_chat_user_ids))
+
+    def _load_chat_user_ids(self, chat_id: int) -> list[int]:
+        with self._cursor() as crsr:
+            statements.execute(crsr, "load_chat_user_ids", {"chat_id": chat_id})
             res = crsr.fetchall()
 
         return [val[0] for val in res]
 
+    def get_user_chat_ids(self, user_id: int) -> list[int]:
+        return list(membership.get_user_chats(user_id, self._load_user_chat_ids))
+
+    def _load_user_chat_ids(self, user_id: int) -> list[int]:
+        with self._cursor() as crsr:
+            statements.execute(crsr, "load_user_chat_ids", {"user_id": user_id})
+            res = crsr.fetchall()
+
+        return [val[0] for val in res]
+
+    def load_user_membership(self, user_id: int) -> None:
+        """
+        Cache a user's chats and the members of each of them, in one query.
+        Done when they log in, so presence and typing indicators know who to tell without going to the database.
+        """
+        generation = membership.generation
+        with self._cursor() as crsr:
+            statements.execute(crsr, "load_user_chat_members", {"user_id": user_id})
+            res = crsr.fetchall()
+        self.after_commit(membership.loaded_members, user_id, dict(res), generation)
+
     def get_last_message_in_chat(self, chat_id) -> Message | None:
-        with self.connection.cursor() as crsr:
-            crsr.execute("SELECT * "
-                         "FROM messages "
-                         "WHERE chat_id = %s "
-                         "ORDER BY time_sent DESC "
-                         "LIMIT 1",
-                         (chat_id,))
+        with self._cursor() as crsr:
+            statements.execute(crsr, "get_last_message_in_chat", {"chat_id": chat_id})
             res = crsr.fetchone()
 
         if res is None:
@@ -318,73 +677,632 @@ AND user_id = %s""",
         return Message.from_tuple(res)
 
     def get_group_name(self, chat_id: int):
-        with self.connection.cursor() as crsr:
+        with self._cursor() as crsr:
             crsr.execute("SELECT name FROM groupchats WHERE chat_id = %s", (chat_id,))
             res = crsr.fetchone()
         return res
 
-    def load_user_chats(self, user_id: int):
-        chats = self.get_user_chats(user_id)
-        res = []
-        for chat_tup in chats:
-            res.append(self.get_display_chat(chat_tup[0], user_id))
-        return res
+    def load_user_chats(self, user_id: int, serialized: bool = False) -> list[DisplayChat] | list[dict]:
+        """
+        Load all of a user's DisplayChats in a single query
+        :param user_id: user to get POV of
+        :param serialized: return wire-ready dicts instead of DisplayChats
+        :return: the user's chats, most recently active first
+        """
+        generation = membership.generation
+        with self._cursor() as crsr:
+            statements.execute(crsr, "load_user_chats", {"user_id": user_id})
+            res = crsr.fetchall()
+        # The chat list has all of the user's chats, which is what presence needs to find their contacts
+        self.after_commit(membership.loaded_user_chats, user_id, [row[0] for row in res], generation)
+
+        if serialized:
+            return DisplayChat.serialize_rows(res)
+        return [DisplayChat(*row) for row in res]
 
     def get_chat_users(self, chat_id: int) -> list[User]:
         user_ids = self.get_chat_user_ids(chat_id)
         return [self.get_user(user_id) for user_id in user_ids]
 
-    def get_chat_messages(self, chat_id: int) -> list[Message]:
+    def get_message(self, message_id: int) -> Message | None:
+        with self._cursor() as crsr:
+            statements.execute(crsr, "get_message", {"message_id": message_id})
+            res = crsr.fetchone()
+        if res is None:
+            return None
+        return Message.from_tuple(res)
+
+    def get_chat_messages(self, chat_id: int, serialized: bool = False) -> list[Message] | list[dict]:
+        """
+        Get a chat's whole history, newest first
+        :param chat_id: chat to load
+        :param serialized: return wire-ready dicts instead of Messages
+        """
         msgs = self.get_chat_messages_tuples(chat_id)
+        if serialized:
+            return Message.serialize_rows(msgs)
         return [Message.from_tuple(msg) for msg in msgs]
 
-    def mark_chat_as_read(self, chat_id: int, user_id: int):
-        msg = self.get_last_message_in_chat(chat_id)
+    def get_chat_messages_page(self,
+                               chat_id: int,
+                               before_message_id: int | None = None,
+                               after_message_id: int | None = None,
+                               limit: int = HISTORY_PAGE_SIZE,
+                               serialized: bool = False) -> list[Message] | list[dict]:
+        """
+        Get a page of a chat's history, newest first, using the (chat_id, message_id) index.
+        :param chat_id: chat to load
+        :param before_message_id: only get messages older than this one
+        :param after_message_id: only get messages newer than this one
+        :param limit: max number of messages, capped at HISTORY_MAX_PAGE_SIZE
+        :param serialized: return wire-ready dicts instead of Messages
+        :return: the page, newest message first
+        """
+        limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+        # When only paging forward, take the oldest messages after the cursor, then flip them
+        newest_first = after_message_id is None or before_message_id is not None
+        with self._cursor() as crsr:
+            statements.execute(crsr, "get_chat_messages_page_desc" if newest_first else "get_chat_messages_page_asc",
+                               {"chat_id": chat_id, "before": before_message_id, "after": after_message_id,
+                                "limit": limit})
+            res = crsr.fetchall()
 
-        if msg is None:
-            return
+        if not newest_first:
+            res.reverse()
+        if serialized:
+            return Message.serialize_rows(res)
+        return [Message.from_tuple(msg) for msg in res]
+
+    def iter_chat_messages(self,
+                           chat_id: int,
+                           before_message_id: int | None = None,
+                           chunk_size: int = HISTORY_PAGE_SIZE,
+                           serialized: bool = False) -> Iterator[list[Message] | list[dict]]:
+        """
+        Lazily read a chat's history, newest first, one page query per chunk.
+        Each chunk borrows a pooled connection only while it is read, so a consumer that is slow to take
+        the chunks (e.g. a slow client being streamed to) never holds on to one.
+        In a transaction, the transaction's connection is held until it ends, however slow the consumer is.
+        :param chat_id: chat to load
+        :param before_message_id: only get messages older than this one
+        :param chunk_size: number of messages per chunk, capped at HISTORY_MAX_PAGE_SIZE
+        :param serialized: yield wire-ready dicts instead of Messages
+        :return: generator of message chunks
+        """
+        chunk_size = max(1, min(chunk_size, HISTORY_MAX_PAGE_SIZE))
+        while True:
+            msgs = self.get_chat_messages_page(chat_id, before_message_id, None, chunk_size, serialized)
+            if not msgs:
+                break
+            yield msgs
+            if len(msgs) < chunk_size:
+                break
+            # Keyset paging: the next chunk starts below the oldest message of this one
+            before_message_id = msgs[-1]["message_id"] if serialized else msgs[-1].message_id
+
+    def search_messages(self,
+                        user_id: int,
+                        query: str,
+                        chat_id: int | None = None,
+                        before_message_id: int | None = None,
+                        limit: int = SEARCH_PAGE_SIZE,
+                        serialized: bool = False) -> list[Message] | list[dict]:
+        """
+        Full-text search of the messages in a user's chats, newest first.
+        The query is in web search syntax: words, "quoted phrases", OR and -excluded words.
+        :param user_id: user searching, only their chats are searched
+        :param query: what to look for
+        :param chat_id: only search this chat
+        :param before_message_id: only get messages older than this one, for the next page
+        :param limit: max number of messages, capped at SEARCH_MAX_PAGE_SIZE
+        :param serialized: return wire-ready dicts instead of Messages
+        :return: the matching messages, newest first
+        """
+        limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+        with self._cursor() as crsr:
+            statements.execute(crsr, "search_messages", {"query": query, "user_id": user_id, "chat_id": chat_id,
+                                                         "before": before_message_id, "limit": limit})
+            res = crsr.fetchall()
+
+        if serialized:
+            return Message.serialize_rows(res)
+        return [Message.from_tuple(msg) for msg in res]
+
+    def search_users(self, query: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0) -> list[dict]:
+        """
+        Find users by tag prefix, by name, or by a tag or name similar to the query
+        :param query: what to look for
+        :param limit: max number of users, capped at SEARCH_MAX_PAGE_SIZE
+        :param offset: number of results to skip, for the next page, capped at SEARCH_MAX_OFFSET
+        :return: the users' user_id, user_tag and user_name, best matches first
+        """
+        limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+        offset = max(0, min(offset, SEARCH_MAX_OFFSET))
+        # The query goes into LIKE patterns, where "_" (allowed in tags) and "%" are wildcards
+        escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        with self._cursor() as crsr:
+            # Tags are always lowercase
+            statements.execute(crsr, "search_users", {"query": query, "tag": query.lower(),
+                                                      "prefix": f"{escaped.lower()}%", "contains": f"%{escaped}%",
+                                                      "limit": limit, "offset": offset})
+            res = crsr.fetchall()
+
+        return [{"user_id": user_id, "user_tag": user_tag, "user_name": user_name}
+                for user_id, user_tag, user_name in res]
 
-        with self.connection.cursor() as crsr:
-            crsr.execute("""UPDATE chats_users 
-SET last_read_message = %s 
-WHERE chat_id = %s 
-AND user_id = %s""",
-                         (msg.message_id, chat_id, user_id))
-
-        self.connection.commit()
-
-    def create_new_message(self, chat_id: int, user_id: int, content: str):
-        now = datetime.datetime.now()
-        with self.connection.cursor() as crsr:
-            crsr.execute("""INSERT INTO messages 
-(chat_id, author_id, time_sent, content) 
-VALUES (%s, %s, %s, %s);
-SELECT currval(pg_get_serial_sequence('messages', 'message_id'));""",
-                         (chat_id, user_id, now, content))
+    def sync_since(self,
+                   user_id: int,
+                   after_message_id: int = 0,
+                   marker_version: int = 0,
+                   limit: int = SYNC_PAGE_SIZE) -> dict:
+        """
+        Everything that changed in a user's chats since a client last synced, so it can catch up after a reconnect
+        :param user_id: user syncing
+        :param after_message_id: last message the client has
+        :param marker_version: "marker_version" returned by the client's last sync, 0 for all read markers
+        :param limit: max number of messages, capped at SYNC_MAX_PAGE_SIZE
+        :return: wire-ready "messages" after after_message_id (oldest first), the "read_markers" and "chats"
+        (DisplayChats) that changed, and the "next_message_id" and "marker_version" to pass next time.
+        Messages that committed late are sent again from the first of them, so some may repeat.
+        """
+        limit = max(1, min(limit, SYNC_MAX_PAGE_SIZE))
+        params = {"user_id": user_id, "after": after_message_id, "version": marker_version, "limit": limit}
+        with self._cursor() as crsr:
+            # The version is taken first, whatever changes while the rest is read is sent again next time
+            statements.execute(crsr, "sync_read_markers", params)
+            markers = crsr.fetchall()
+            # A client that never synced has no version to compare against
+            if marker_version > 0:
+                statements.execute(crsr, "sync_late_message", {**params, "snapshot": markers[0][0]})
+                late = crsr.fetchone()[0]
+                if late is not None:
+                    params["after"] = late - 1
+            statements.execute(crsr, "sync_chats", params)
+            chats = DisplayChat.serialize_rows(crsr.fetchall())
+            statements.execute(crsr, "sync_messages", params)
+            msgs = Message.serialize_rows(crsr.fetchall())
+
+        return {
+            "messages": msgs,
+            # A single row without a chat when no marker changed
+            "read_markers": [{"chat_id": chat_id, "last_read_message": last_read_message}
+                             for _, chat_id, last_read_message in markers if chat_id is not None],
+            "chats": chats,
+            "next_message_id": msgs[-1]["message_id"] if msgs else params["after"],
+            "marker_version": markers[0][0]
+        }
+
+    def mark_chat_as_read(self, chat_id: int, user_id: int, message_id: int | None = None) -> bool:
+        """
+        Move a user's read marker forward, and take the messages it passes off their unread counter
+        :param chat_id: chat to mark
+        :param user_id: user who read it
+        :param message_id: last message read, defaults to the chat's last message
+        :return: whether the marker moved
+        """
+        return self.mark_chats_as_read([(chat_id, user_id, message_id)]) > 0
+
+    def mark_chats_as_read(self, markers: list[tuple[int, int, int | None]]) -> int:
+        """
+        Move many read markers forward in one statement.
+        Markers never move back, so they can be written late and in any order.
+        :param markers: (chat_id, user_id, message_id) of every marker, message_id None for the chat's last message.
+        A (chat_id, user_id) may only appear once.
+        :return: number of markers that moved
+        """
+        with self._cursor() as crsr:
+            statements.execute(crsr, "mark_chats_as_read", {
+                "chat_ids": [chat_id for chat_id, _, _ in markers],
+                "user_ids": [user_id for _, user_id, _ in markers],
+                "message_ids": [message_id for _, _, message_id in markers]
+            })
+            return crsr.rowcount
+
+    def create_new_message(self, chat_id: int, user_id: int, content: str) -> Message | None:
+        with self._cursor() as crsr:
+            statements.execute(crsr, "create_new_message", {"chat_id": chat_id, "user_id": user_id, "content": content})
             res = crsr.fetchone()
-            self.connection.commit()
         if res is None:
             return None
-        return Message(
-            res[0],
-            chat_id,
-            user_id,
-            math.floor(now.timestamp()),
-            content
-        )
+        return Message.from_tuple(res)
+
+    def create_new_messages(self, messages: list[tuple[int, int, str]]) -> list[Message]:
+        """
+        Insert many messages (possibly in different chats) in one transaction, in order
+        :param messages: (chat_id, user_id, content) of every message
+        :return: the new messages, in the same order
+        """
+        with self._cursor() as crsr:
+            # IDs are taken up front, so each row's ID is known without relying on RETURNING's order
+            crsr.execute("SELECT nextval(pg_get_serial_sequence('messages', 'message_id')) "
+                         "FROM generate_series(1, %s)", (len(messages),))
+            message_ids = sorted(row[0] for row in crsr.fetchall())
+
+            # The unread counters are bumped by the same statement, so they can't drift from the messages
+            res = execute_values(crsr, f"""WITH new_messages AS (
+    INSERT INTO messages (message_id, chat_id, author_id, time_sent, content)
+    VALUES %s
+    RETURNING {MESSAGE_COLUMNS}
+), unread AS (
+    UPDATE chats_users cu
+    SET unread_count = cu.unread_count + counted.count
+    FROM (
+        SELECT members.chat_id, members.user_id, COUNT(*) AS count
+        FROM new_messages
+        JOIN chats_users members ON members.chat_id = new_messages.chat_id
+        AND members.user_id <> new_messages.author_id
+        GROUP BY members.chat_id, members.user_id
+    ) counted
+    WHERE cu.chat_id = counted.chat_id
+    AND cu.user_id = counted.user_id
+)
+SELECT * FROM new_messages""",
+                                 [(message_id, chat_id, user_id, content)
+                                  for message_id, (chat_id, user_id, content) in zip(message_ids, messages)],
+                                 template="(%s, %s, %s, now(), %s)", page_size=len(messages), fetch=True)
+
+        rows = {row[0]: row for row in res}
+        return [Message.from_tuple(rows[message_id]) for message_id in message_ids]
+
+    def reconcile_unread_counts(self, chat_id: int | None = None) -> int:
+        """
+        Rebuild unread counters from the messages table, e.g. after a migration or a restore.
+        A member's unread count is the number of messages by others after their last read message.
+        :param chat_id: only reconcile this chat, defaults to all chats
+        :return: number of counters that were wrong and got fixed
+        """
+        with self._cursor() as crsr:
+            crsr.execute(RECONCILE_UNREAD_COUNTS_QUERY, {"chat_id": chat_id})
+            return crsr.rowcount
 
     def update_user(self, user: User):
-        with self.connection.cursor() as crsr:
-            crsr.execute("""UPDATE users 
-SET user_tag = %s, user_name = %s 
-WHERE user_id = %s;
-SELECT * FROM users WHERE user_id = %s""",
-                         (user.user_tag, user.user_name, user.user_id, user.user_id))
+        with self._cursor() as crsr:
+            statements.execute(crsr, "update_user",
+                               {"user_id": user.user_id, "user_tag": user.user_tag, "user_name": user.user_name})
             res = crsr.fetchone()
-            self.connection.commit()
         if res is None:
             return False
+
+        # Replaces the cached user, dropping the old tag if it changed
+        self.after_commit(user_cache.user_changed, User.from_tuple(res))
         return True
 
 
-db = Database()
+_executor: ThreadPoolExecutor | None = None
+
+
+def get_db_executor() -> ThreadPoolExecutor:
+    """
+    Get the process-wide executor that database calls are offloaded to.
+    Created lazily, so that forked workers don't inherit the parent's threads.
+    :return: the shared executor
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="twaddle-db")
+    return _executor
+
+
+class AsyncDatabase:
+    """
+    Awaitable wrapper around Database.
+    Every method of the wrapped Database is run on the bounded DB executor,
+    so a slow query only occupies a worker thread instead of the IOLoop.
+    """
+
+    def __init__(self, database: Database | None = None, executor: ThreadPoolExecutor | None = None):
+        self.sync = database if database is not None else Database()
+        self.executor = executor if executor is not None else get_db_executor()
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """
+        Run a blocking callable on the DB executor and await its result
+        :param func: callable to run
+        :return: whatever func returned
+        """
+        return await self.run_as(getattr(func, "__name__", "unknown"), func, *args, **kwargs)
+
+    async def run_as(self, method: str, func: Callable, *args, **kwargs):
+        """
+        Like run, with the time and rows recorded under the given method name
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(metrics.timed_query, method, func, *args, **kwargs))
+
+    async def iterate(self, gen: Iterator):
+        """
+        Consume a blocking generator (e.g. Database.iter_chat_messages) without blocking the IOLoop
+        :param gen: generator to consume
+        :return: async generator of its items
+        """
+        done = object()
+        try:
+            while True:
+                item = await self.run_as(gen.__name__, next, gen, done)
+                if item is done:
+                    break
+                yield item
+        finally:
+            # Releases whatever the generator holds, such as its pooled connection
+            await self.run_as(gen.__name__, gen.close)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator['AsyncDatabase']:
+        """
+        Run several calls in one transaction on one connection, committed when the with block exits cleanly
+        :return: an AsyncDatabase bound to the transaction
+        """
+        connection = self.sync.pool.connection()
+        conn = await self.run_as("transaction_begin", connection.__enter__)
+        db = Database(self.sync.pool, conn)
+        try:
+            yield AsyncDatabase(db, self.executor)
+        except BaseException:
+            # Rolls back, and puts the connection back in the pool
+            if not await self.run_as("transaction_rollback", connection.__exit__, *sys.exc_info()):
+                raise
+        else:
+            await self.run_as("transaction_commit", connection.__exit__, None, None, None)
+
+            on_commit, db.on_commit = db.on_commit, []
+            for func, args in on_commit:
+                res = func(*args)
+                if asyncio.iscoroutine(res):
+                    await res
+
+    async def after_commit(self, func: Callable, *args) -> Any:
+        """
+        Run func (which may be a coroutine function) once the current transaction commits,
+        or right away outside of a transaction
+        """
+        if self.sync.conn is not None:
+            self.sync.on_commit.append((func, args))
+            return None
+
+        res = func(*args)
+        if asyncio.iscoroutine(res):
+            res = await res
+        return res
+
+    # Cached users are returned straight away, only misses go to the executor
+
+    async def get_user(self, user_id: int) -> User | None:
+        return user_cache.get(user_id) or await self.run(self.sync._load_user, user_id)
+
+    async def get_user_by_fuid(self, fuid: str) -> User | None:
+        return user_cache.get_by_fuid(fuid) or await self.run(self.sync._load_user_by_fuid, fuid)
+
+    async def get_user_by_tag(self, usertag: str) -> User | None:
+        return user_cache.get_by_tag(usertag) or await self.run(self.sync._load_user_by_tag, usertag)
+
+    async def create_new_message(self, chat_id: int, user_id: int, content: str) -> Message | None:
+        # Outside of a transaction, messages from all connections are group-committed
+        if self.sync.conn is None and MESSAGE_BATCH_SIZE > 1:
+            return await get_message_writer(self).write(chat_id, user_id, content)
+        return await self.run(self.sync.create_new_message, chat_id, user_id, content)
+
+    async def mark_chat_as_read(self, chat_id: int, user_id: int, message_id: int | None = None) -> None:
+        # Outside of a transaction, markers are coalesced and written a little later.
+        # Not "the chat's last message" though, which would take in messages that arrive until then
+        if self.sync.conn is None and READ_MARKER_FLUSH_INTERVAL > 0 and message_id is not None:
+            get_read_marker_writer(self).mark(chat_id, user_id, message_id)
+            return
+        await self.run(self.sync.mark_chat_as_read, chat_id, user_id, message_id)
+
+    async def load_user_chats(self, user_id: int, serialized: bool = False) -> list[DisplayChat] | list[dict]:
+        # Unread counts have to account for the chats the user has just read
+        await get_read_marker_writer(self).flush(user_id)
+        return await self.run(self.sync.load_user_chats, user_id, serialized)
+
+    async def sync_since(self,
+                         user_id: int,
+                         after_message_id: int = 0,
+                         marker_version: int = 0,
+                         limit: int = SYNC_PAGE_SIZE) -> dict:
+        # The user's own markers still waiting in memory are changes too
+        await get_read_marker_writer(self).flush(user_id)
+        return await self.run(self.sync.sync_since, user_id, after_message_id, marker_version, limit)
+
+    async def get_chat_user_ids(self, chat_id: int) -> list[int]:
+        # Membership is almost always cached, skip the trip to the executor when it is
+        members = membership.peek_chat_members(chat_id)
+        if members is not None:
+            return list(members)
+        return list(await self.run(membership.load_chat_members, chat_id, self.sync._load_chat_user_ids))
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.sync, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        # Cache the wrapper so later lookups skip __getattr__
+        setattr(self, name, wrapper)
+        return wrapper
+
+
+class MessageWriter:
+    """
+    Group commit for new messages.
+    Messages sent at about the same time, from any connection, are inserted in one
+    transaction, so a burst of messages costs one commit (and one WAL flush) instead of one each.
+    A message waits at most max_delay for company when the writer is idle; while a batch is
+    being written, the next one fills up by itself.
+    """
+
+    def __init__(self,
+                 database: AsyncDatabase | None = None,
+                 max_batch: int = MESSAGE_BATCH_SIZE,
+                 max_delay: float = MESSAGE_BATCH_DELAY):
+        self.db = database if database is not None else AsyncDatabase()
+        self.max_batch = max(max_batch, 1)
+        self.max_delay = max_delay
+        self.pending: list[tuple[tuple[int, int, str], asyncio.Future]] = []
+        self._full = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    async def write(self, chat_id: int, user_id: int, content: str) -> Message:
+        """
+        Queue a message and wait until it has been committed
+        :return: the new message
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(((chat_id, user_id, content), future))
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        elif len(self.pending) >= self.max_batch:
+            self._full.set()
+        return await future
+
+    async def _run(self):
+        if self.max_delay > 0 and len(self.pending) < self.max_batch:
+            self._full.clear()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+
+        while self.pending:
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            await self._flush(batch)
+
+    async def _flush(self, batch: list[tuple[tuple[int, int, str], asyncio.Future]]):
+        metrics.message_batch_size.observe(len(batch))
+        try:
+            msgs = await self.db.run(self.db.sync.create_new_messages, [row for row, _ in batch])
+        except (psycopg2.IntegrityError, psycopg2.DataError):
+            # A single bad message fails the whole batch, write them one by one so only it fails
+            for row, future in batch:
+                try:
+                    msg = await self.db.run(self.db.sync.create_new_message, *row)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                if not future.done():
+                    future.set_result(msg)
+            return
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # A sender that gave up waiting (e.g. its socket closed) has a cancelled future, the message is still sent
+        for (_, future), msg in zip(batch, msgs):
+            if not future.done():
+                future.set_result(msg)
+
+
+_message_writers: dict[ConnectionPool, MessageWriter] = {}
+
+
+def get_message_writer(database: AsyncDatabase) -> MessageWriter:
+    """
+    Get the message writer for a database's pool, creating it on first use.
+    Every connection shares it, which is what lets their messages be committed together.
+    """
+    writer = _message_writers.get(database.sync.pool)
+    if writer is None:
+        writer = _message_writers[database.sync.pool] = MessageWriter(AsyncDatabase(Database(database.sync.pool),
+                                                                                    database.executor))
+    return writer
+
+
+class ReadMarkerWriter:
+    """
+    Coalesces read markers.
+    Chats are marked as read on every LOAD_SINGLE_CHAT, MARK_AS_READ and SEND_CHAT_MESSAGE, but only the
+    furthest marker of each member matters. Markers are kept in memory and written together, in one statement,
+    at most every interval.
+    """
+
+    def __init__(self, database: AsyncDatabase | None = None, interval: float = READ_MARKER_FLUSH_INTERVAL):
+        self.db = database if database is not None else AsyncDatabase()
+        self.interval = interval
+        # (chat_id, user_id) -> last message read, None for the chat's last message
+        self.pending: dict[tuple[int, int], int | None] = {}
+        self._task: asyncio.Task | None = None
+
+    def mark(self, chat_id: int, user_id: int, message_id: int | None = None) -> None:
+        """
+        Mark a chat as read, to be written on the next flush
+        :param message_id: last message read, defaults to the chat's last message at the time of the flush
+        """
+        self._merge({(chat_id, user_id): message_id})
+        metrics.read_markers.inc("marked")
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def _merge(self, markers: dict[tuple[int, int], int | None]) -> None:
+        for key, message_id in markers.items():
+            if key in self.pending:
+                current = self.pending[key]
+                message_id = None if current is None or message_id is None else max(current, message_id)
+            self.pending[key] = message_id
+
+    async def _run(self):
+        while self.pending:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self, user_id: int | None = None) -> None:
+        """
+        Write pending markers now
+        :param user_id: only write this user's markers, e.g. when they disconnect
+        """
+        if user_id is None:
+            markers, self.pending = self.pending, {}
+        else:
+            markers = {key: self.pending.pop(key) for key in [key for key in self.pending if key[1] == user_id]}
+        if not markers:
+            return
+
+        try:
+            # A stable order, so two flushes can't deadlock on each other's rows
+            moved = await self.db.run(self.db.sync.mark_chats_as_read,
+                                      [(chat_id, user_id, message_id)
+                                       for (chat_id, user_id), message_id in sorted(markers.items())])
+        except Exception:
+            LOGGER.warning("Failed to write %d read markers, will retry", len(markers), exc_info=True)
+            metrics.errors.inc("read_markers")
+            self._merge(markers)
+            if self._task is None or self._task.done():
+                self._task = asyncio.ensure_future(self._run())
+            return
+
+        metrics.read_markers.inc("flushed", amount=len(markers))
+        metrics.read_markers.inc("moved", amount=moved)
+
+    @staticmethod
+    def stats() -> dict[str, int]:
+        marked = metrics.read_markers.get("marked")
+        flushed = metrics.read_markers.get("flushed")
+        return {
+            "marked": marked,
+            "flushed": flushed,
+            "moved": metrics.read_markers.get("moved"),
+            # Each of these used to be its own UPDATE and commit
+            "saved": marked - flushed
+        }
+
+
+_read_marker_writers: dict[ConnectionPool, ReadMarkerWriter] = {}
+
+
+def get_read_marker_writer(database: AsyncDatabase) -> ReadMarkerWriter:
+    """
+    Get the read marker writer for a database's pool, creating it on first use
+    """
+    writer = _read_marker_writers.get(database.sync.pool)
+    if writer is None:
+        writer = _read_marker_writers[database.sync.pool] = ReadMarkerWriter(
+            AsyncDatabase(Database(database.sync.pool), database.executor)
+        )
+    return writer
@@ -0,0 +1,266 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import *
+
+import psycopg2
+import psycopg2.extensions
+from dotenv import load_dotenv
+
+from loop_monitor import percentile
+
+load_dotenv()
+
+DB_NAME = os.getenv("DB_NAME", "twaddle_db")
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = int(os.getenv("DB_PORT", "5432"))
+
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN", "2"))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX", "20"))
+# Seconds to wait for a free connection before giving up
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# Connections idle for longer than this many seconds are pinged before being handed out
+POOL_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL", "30"))
+
+
+class PoolException(Exception):
+    pass
+
+
+class PoolTimeoutException(PoolException):
+    pass
+
+
+def connect() -> psycopg2.extensions.connection:
+    """
+    Open a new connection to the Twaddle database
+    :return: the new connection
+    """
+    return psycopg2.connect(
+        dbname=DB_NAME,
+        user=os.getenv("DB_USERNAME"),
+        password=os.getenv("DB_PASSWORD"),
+        host=DB_HOST,
+        port=DB_PORT
+    )
+
+
+class ConnectionPool:
+    """
+    A bounded, thread-safe pool of psycopg2 connections.
+    Connections are opened lazily up to max_size, idle ones are health-checked
+    before being handed out, and broken ones are thrown away and replaced.
+    """
+
+    def __init__(self,
+                 connect_func: Callable[[], psycopg2.extensions.connection] = connect,
+                 min_size: int = POOL_MIN_SIZE,
+                 max_size: int = POOL_MAX_SIZE,
+                 timeout: float = POOL_TIMEOUT,
+                 health_check_interval: float = POOL_HEALTH_CHECK_INTERVAL):
+        if min_size > max_size:
+            raise ValueError("min_size can't be larger than max_size")
+
+        self.connect_func = connect_func
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        # Idle connections along with the time they were returned
+        self._idle: deque[tuple[psycopg2.extensions.connection, float]] = deque()
+        self._size = 0
+        self._closed = False
+
+        self.in_use = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.checkout_latency: deque[float] = deque(maxlen=2048)
+
+        for _ in range(min_size):
+            self._idle.append((self.connect_func(), time.monotonic()))
+            self._size += 1
+
+    def getconn(self, timeout: float | None = None) -> psycopg2.extensions.connection:
+        """
+        Check a connection out of the pool, waiting for one if the pool is exhausted
+        :param timeout: seconds to wait, defaults to the pool's timeout
+        :return: a healthy connection
+        """
+        start = time.monotonic()
+        deadline = start + (self.timeout if timeout is None else timeout)
+
+        conn = None
+        idle_since = 0.0
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    if self._closed:
+                        raise PoolException("Pool is closed")
+
+                    if self._idle:
+                        conn, idle_since = self._idle.pop()
+                        break
+
+                    if self._size < self.max_size:
+                        # Reserve a slot, the actual connect happens outside the lock
+                        self._size += 1
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeoutException(f"No free connection after {timeout or self.timeout}s")
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+        try:
+            if conn is None:
+                conn = self.connect_func()
+            elif not self._is_healthy(conn, idle_since):
+                self._close_quietly(conn)
+                conn = self.connect_func()
+                self.reconnects += 1
+        except BaseException:
+            # Give the reserved slot back
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self.in_use += 1
+            self.checkouts += 1
+            self.checkout_latency.append(time.monotonic() - start)
+
+        return conn
+
+    def putconn(self, conn: psycopg2.extensions.connection, broken: bool = False) -> None:
+        """
+        Return a connection to the pool
+        :param conn: connection checked out with getconn
+        :param broken: whether the connection should be discarded instead of reused
+        """
+        if not broken and not conn.closed:
+            # Never hand out a connection in the middle of a transaction
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+
+        with self._cond:
+            self.in_use -= 1
+            if broken or conn.closed or self._closed:
+                self._size -= 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: float | None = None) -> Iterator[psycopg2.extensions.connection]:
+        """
+        Borrow a connection for the duration of a with block.
+        The transaction is committed if the block succeeds and rolled back otherwise.
+        :param timeout: seconds to wait for a connection
+        """
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.putconn(conn, broken=True)
+            raise
+        except BaseException:
+            broken = False
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            self.putconn(conn, broken=broken)
+            raise
+        else:
+            self.putconn(conn)
+
+    def _is_healthy(self, conn: psycopg2.extensions.connection, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as crsr:
+                crsr.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn: psycopg2.extensions.connection) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def stats(self) -> dict[str, int | float]:
+        with self._cond:
+            latency = list(self.checkout_latency)
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "waiting": self.waiting,
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "reconnects": self.reconnects,
+                "checkout_p50": percentile(latency, 50),
+                "checkout_p99": percentile(latency, 99)
+            }
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close_quietly(conn)
+            self._cond.notify_all()
+
+
+_pool: ConnectionPool | None = None
+_pool_pid: int = 0
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Get the process-wide connection pool, creating it on first use.
+    A forked worker gets its own pool instead of sharing the parent's sockets.
+    :return: the shared pool
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool()
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def close_pool() -> None:
+    """
+    Close the process-wide pool, if there is one. The next get_pool() makes a new one.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
@@ -0,0 +1,147 @@
+"""
+Logging setup for the server.
+
+Loggers only put records on a queue; a background thread formats and writes them,
+so the IOLoop never waits on stdout. Records are formatted lazily (use
+`LOGGER.debug("... %s", arg)`, not f-strings) and only if their level is enabled.
+
+Env config:
+- LOG_LEVEL: root level, INFO by default
+- LOG_LEVELS: per-module levels, e.g. "webserver=DEBUG,db_api=WARNING"
+- LOG_FORMAT: "text" (default) or "json"
+- LOG_SAMPLE_RATE: only 1 in this many records of a sampled kind (e.g. every frame) is kept
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from typing import *
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_SAMPLE_RATE = int(os.getenv("LOG_SAMPLE_RATE", "100"))
+
+
+def fields(sample: str | None = None, **kwargs) -> dict:
+    """
+    Build the `extra` of a log call
+    :param sample: kind of record to sample, e.g. "frame". Only 1 in LOG_SAMPLE_RATE of each kind is kept.
+    :param kwargs: structured fields, e.g. event, user_id, latency
+    :return: the extra dict
+    """
+    return {"fields": kwargs, "sample": sample}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps 1 in `rate` records of each sampled kind, records that aren't sampled always pass
+    """
+
+    def __init__(self, rate: int = LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = max(rate, 1)
+        self.counts: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        kind = getattr(record, "sample", None)
+        if kind is None:
+            return True
+        with self._lock:
+            count = self.counts.get(kind, 0)
+            self.counts[kind] = count + 1
+        return count % self.rate == 0
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Appends a record's fields to the message, as key=value pairs or as a JSON object
+    """
+
+    def __init__(self, output: str = LOG_FORMAT):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.output = output
+
+    def format(self, record: logging.LogRecord) -> str:
+        record_fields = getattr(record, "fields", None) or {}
+        if self.output == "json":
+            entry = {
+                "time": self.formatTime(record),
+                "level": record.levelname,
+                "logger": record.name,
+                "message": record.getMessage(),
+                **record_fields
+            }
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+
+        text = super().format(record)
+        if record_fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in record_fields.items())
+        return text
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records as they are, leaving all formatting to the listener thread.
+    The queue never leaves the process, so records don't have to be flattened first.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+_listener: logging.handlers.QueueListener | None = None
+_listener_pid: int = 0
+
+
+def parse_levels(levels: str) -> dict[str, str]:
+    res = {}
+    for item in levels.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            res[name.strip()] = level.strip().upper()
+    return res
+
+
+def setup_logging() -> None:
+    """
+    Route all logging through the queue. Safe to call again, e.g. in a forked worker,
+    which gets its own listener thread since threads don't survive a fork.
+    """
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        return
+
+    output = logging.StreamHandler()
+    output.setFormatter(StructuredFormatter())
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    _listener_pid = os.getpid()
+
+
+def stop_logging() -> None:
+    """
+    Write out whatever is still queued
+    """
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import *
+
+
+def percentile(samples: Iterable[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of a collection of samples
+    :param samples: samples to look at
+    :param pct: percentile, 0-100
+    :return: the percentile value, 0 if there are no samples
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+class LatencyTracker:
+    """
+    Keeps a rolling window of latency samples (in seconds) per key
+    """
+
+    def __init__(self, window: int = 2048):
+        self.window = window
+        self.samples: dict[str, deque[float]] = {}
+
+    def record(self, key: str, seconds: float) -> None:
+        ls = self.samples.get(key)
+        if ls is None:
+            ls = self.samples[key] = deque(maxlen=self.window)
+        ls.append(seconds)
+
+    def summary(self, key: str) -> dict[str, float]:
+        ls = self.samples.get(key, ())
+        return {
+            "count": len(ls),
+            "p50": percentile(ls, 50),
+            "p99": percentile(ls, 99),
+            "max": max(ls, default=0.0)
+        }
+
+    def summaries(self) -> dict[str, dict[str, float]]:
+        return {key: self.summary(key) for key in self.samples}
+
+
+class LoopLagMonitor:
+    """
+    Measures how long the IOLoop is blocked.
+    A probe is scheduled every `interval` seconds; how late it actually wakes up
+    is the time the loop spent busy with something else (e.g. a blocking query).
+    """
+
+    def __init__(self, interval: float = 0.05, window: int = 2048):
+        self.interval = interval
+        self.lag = deque(maxlen=window)
+        self.total_blocked: float = 0.0
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - expected, 0.0)
+            self.lag.append(lag)
+            self.total_blocked += lag
+
+    def summary(self) -> dict[str, float]:
+        return {
+            "p50": percentile(self.lag, 50),
+            "p99": percentile(self.lag, 99),
+            "max": max(self.lag, default=0.0),
+            "total_blocked": self.total_blocked
+        }
+
+
+# Process-wide instances, used by the server and the event handler
+loop_lag = LoopLagMonitor()
+event_latency = LatencyTracker()
+
+
+def log_summary(logger: logging.Logger) -> None:
+    """
+    Log loop lag and per-event latency, meant to be called periodically
+    :param logger: logger to report to
+    """
+    lag = loop_lag.summary()
+    logger.info("Loop lag: p50=%.1fms p99=%.1fms max=%.1fms total=%.2fs",
+                lag["p50"] * 1000, lag["p99"] * 1000, lag["max"] * 1000, lag["total_blocked"])
+    for event, summ in event_latency.summaries().items():
+        logger.info("Event %s: n=%d p50=%.1fms p99=%.1fms max=%.1fms",
+                    event, summ["count"], summ["p50"] * 1000, summ["p99"] * 1000, summ["max"] * 1000)
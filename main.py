@@ -7,8 +7,10 @@ import webserver
 ##########
 IP = socket.gethostbyname(socket.gethostname())
 PORT = 8888
+# Number of server processes, 0 for one per CPU core
+WORKERS = 1
 
 # There ain't much to do here, is there?
 if __name__ == "__main__":
-    app = webserver.main(PORT, IP)
+    app = webserver.main(PORT, IP, WORKERS)
     print("")
@@ -0,0 +1,197 @@
+"""
+Process-wide metrics, exposed in the Prometheus text format.
+
+Recording is a dict lookup and a few additions under a lock, cheap enough to
+leave on for every event and query. Metrics are per process; with several
+workers, each one reports its own.
+"""
+import bisect
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import *
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    type: str = ""
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"] + self._samples()
+
+    @abstractmethod
+    def _samples(self) -> list[str]:
+        pass
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values) -> float:
+        with self._lock:
+            return self.values.get(label_values, 0)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = list(self.values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(Metric):
+    """
+    A gauge read from a callback when metrics are collected, so nothing has to be kept up to date
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, func: Callable[[], float]):
+        super().__init__(name, description)
+        self.func = func
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name} {_format_value(self.func())}"]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        # label values -> [per-bucket counts (the last one is +Inf), sum, count]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            item = self.values.get(label_values)
+            if item is None:
+                item = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            item[0][index] += 1
+            item[1] += value
+            item[2] += 1
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+
+        lines = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def add(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} already exists")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self.add(Counter(name, description, labels))
+
+    def histogram(self, name: str, description: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, description, labels, buckets))
+
+    def gauge(self, name: str, description: str, func: Callable[[], float]) -> Gauge:
+        """
+        Add a gauge, replacing an existing gauge of the same name (e.g. when the server is restarted in-process)
+        """
+        self.metrics.pop(name, None)
+        return self.add(Gauge(name, description, func))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+event_duration = REGISTRY.histogram("twaddle_event_duration_seconds", "Time to handle an event", ("event",))
+event_failures = REGISTRY.counter("twaddle_event_failures_total", "Events answered with s=false", ("event",))
+query_duration = REGISTRY.histogram("twaddle_db_query_duration_seconds",
+                                    "Time spent in a Database method, on the DB executor", ("method",))
+query_rows = REGISTRY.counter("twaddle_db_rows_total", "Rows returned or affected by Database methods", ("method",))
+fan_out_duration = REGISTRY.histogram("twaddle_fan_out_duration_seconds", "Time to queue a push for all recipients")
+message_batch_size = REGISTRY.histogram("twaddle_message_batch_size", "Messages committed together by the writer",
+                                        buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+read_markers = REGISTRY.counter("twaddle_read_markers_total",
+                                "Chats marked as read (marked), markers written after coalescing (flushed), "
+                                "and markers that moved forward (moved)", ("kind",))
+ephemeral = REGISTRY.counter("twaddle_ephemeral_total",
+                              "Typing and presence updates broadcast (sent), held back by the rate limit (coalesced), "
+                              "and dropped for lack of cached membership (dropped)", ("outcome",))
+errors = REGISTRY.counter("twaddle_errors_total", "Unexpected errors, by where they happened", ("where",))
+
+# Rows counted by the queries of the Database method running on this thread
+_rows = threading.local()
+
+
+def count_rows(count: int) -> None:
+    if count > 0:
+        _rows.count = getattr(_rows, "count", 0) + count
+
+
+def timed_query(method: str, func: Callable, *args, **kwargs) -> Any:
+    """
+    Call func, recording its duration and the rows its queries touched under the method's name.
+    Meant to run on the thread doing the queries.
+    """
+    outer = getattr(_rows, "count", 0)
+    _rows.count = 0
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        query_duration.observe(time.perf_counter() - start, method)
+        if _rows.count:
+            query_rows.inc(method, amount=_rows.count)
+        # A method called from another one counts towards both
+        _rows.count += outer
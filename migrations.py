@@ -0,0 +1,260 @@
+"""
+Versioned schema migrations.
+
+twaddle_db.sql is the baseline schema. Every change after it is a numbered step
+in MIGRATIONS, applied in order and recorded in the schema_migrations table.
+Steps are written to be idempotent, so they are safe to run against a database
+that was created from a newer dump and already has some of them.
+
+Usage:
+    python migrations.py migrate             apply pending steps
+    python migrations.py status              show applied and pending steps
+    python migrations.py check-plans         fail if a hot query would sequentially scan a large table
+    python migrations.py reconcile-unreads   rebuild unread counters from messages
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from typing import *
+
+import psycopg2.extensions
+
+import statements
+from db_api import MESSAGE_SEARCH_CONFIG, RECONCILE_UNREAD_COUNTS_QUERY, Database
+from db_pool import get_pool
+
+LOGGER = logging.getLogger(__name__)
+
+# Whether the server applies pending migrations when it starts
+AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "1") == "1"
+
+# Held while migrating, so several workers starting at once don't race each other
+MIGRATION_LOCK_ID = 0x7477_6464
+
+
+class Migration:
+    def __init__(self, version: int, name: str, sql: str):
+        self.version = version
+        self.name = name
+        self.sql = sql
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, "unread_counters", f"""
+ALTER TABLE chats_users ADD COLUMN IF NOT EXISTS unread_count integer DEFAULT 0 NOT NULL;
+{RECONCILE_UNREAD_COUNTS_QUERY % {"chat_id": "NULL"}};
+"""),
+    Migration(2, "messages_chat_id_message_id_idx", """
+CREATE INDEX IF NOT EXISTS messages_chat_id_message_id_idx ON messages (chat_id, message_id);
+"""),
+    Migration(3, "hot_path_indexes", """
+-- A member can only be in a chat once; the key also serves lookups by chat_id
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'chats_users_pkey') THEN
+        DELETE FROM chats_users a
+        USING chats_users b
+        WHERE a.ctid < b.ctid
+        AND a.chat_id = b.chat_id
+        AND a.user_id = b.user_id;
+
+        ALTER TABLE chats_users ADD CONSTRAINT chats_users_pkey PRIMARY KEY (chat_id, user_id);
+    END IF;
+END
+$$;
+
+-- A user's chats
+CREATE INDEX IF NOT EXISTS chats_users_user_id_idx ON chats_users (user_id, chat_id);
+"""),
+    Migration(4, "scope_last_active_trigger", """
+-- Only touch the members of the chat the message was sent to, and only when the value moves forward.
+-- The old version joined against messages without a chat filter and rewrote every row of chats_users.
+CREATE OR REPLACE FUNCTION update_chat_last_active() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    UPDATE chats_users
+    SET last_active = NEW.time_sent
+    WHERE chat_id = NEW.chat_id
+    AND (last_active IS NULL OR last_active < NEW.time_sent);
+    RETURN NEW;
+END;
+$$;
+"""),
+    Migration(5, "direct_chats", """
+-- The 1:1 chat of every pair of users, the pair ordered so each one has a single key
+CREATE TABLE IF NOT EXISTS direct_chats (
+    low_user_id integer NOT NULL REFERENCES users (user_id),
+    high_user_id integer NOT NULL REFERENCES users (user_id),
+    chat_id integer NOT NULL UNIQUE REFERENCES chats (chat_id) ON DELETE CASCADE,
+    PRIMARY KEY (low_user_id, high_user_id),
+    CHECK (low_user_id < high_user_id)
+);
+
+-- Existing user chats are the unnamed ones with two members. A pair that got several chats keeps the oldest.
+INSERT INTO direct_chats (low_user_id, high_user_id, chat_id)
+SELECT DISTINCT ON (low_user_id, high_user_id) low_user_id, high_user_id, chat_id
+FROM (
+    SELECT cu.chat_id, MIN(cu.user_id) AS low_user_id, MAX(cu.user_id) AS high_user_id
+    FROM chats_users cu
+    JOIN chats c ON c.chat_id = cu.chat_id
+    WHERE c.name IS NULL
+    GROUP BY cu.chat_id
+    HAVING COUNT(*) = 2
+) pairs
+ORDER BY low_user_id, high_user_id, chat_id
+ON CONFLICT DO NOTHING;
+"""),
+    Migration(6, "search_indexes", f"""
+-- SEARCH_MESSAGES, the expression has to match the one db_api searches with
+CREATE INDEX IF NOT EXISTS messages_content_fts_idx
+    ON messages USING gin (to_tsvector('{MESSAGE_SEARCH_CONFIG}', content));
+
+-- SEARCH_USERS: LIKE/ILIKE patterns and similarity on tags and names
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS users_user_tag_trgm_idx ON users USING gin (user_tag gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS users_user_name_trgm_idx ON users USING gin (user_name gin_trgm_ops);
+"""),
+    Migration(7, "read_marker_versions", """
+-- The transaction that last moved the member's read marker, or added them to the chat, for SYNC_SINCE.
+-- Existing rows get 0, so they are sent to clients that have never synced.
+ALTER TABLE chats_users ADD COLUMN IF NOT EXISTS marker_version bigint DEFAULT 0 NOT NULL;
+ALTER TABLE chats_users ALTER COLUMN marker_version SET DEFAULT txid_current();
+"""),
+    Migration(8, "message_versions", """
+-- The transaction that wrote the message, for SYNC_SINCE to find messages that committed after it passed them.
+-- Existing rows get 0, they committed long before any client synced.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS xact_id bigint DEFAULT 0 NOT NULL;
+ALTER TABLE messages ALTER COLUMN xact_id SET DEFAULT txid_current();
+CREATE INDEX IF NOT EXISTS messages_xact_id_idx ON messages (xact_id);
+"""),
+]
+
+
+def migrate(conn: psycopg2.extensions.connection) -> list[Migration]:
+    """
+    Apply all pending migrations, in a single transaction
+    :param conn: connection to migrate through
+    :return: the migrations that were applied
+    """
+    applied_now = []
+    with conn.cursor() as crsr:
+        crsr.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+        crsr.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+    version integer PRIMARY KEY,
+    name text NOT NULL,
+    applied_at timestamp(0) without time zone DEFAULT now() NOT NULL
+)""")
+        crsr.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in crsr.fetchall()}
+
+        for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+            if migration.version in applied:
+                continue
+            crsr.execute(migration.sql)
+            crsr.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                         (migration.version, migration.name))
+            applied_now.append(migration)
+
+    conn.commit()
+    return applied_now
+
+
+def migrate_on_startup() -> None:
+    """
+    Apply pending migrations through the shared pool, unless disabled with DB_AUTO_MIGRATE=0
+    """
+    if not AUTO_MIGRATE:
+        return
+    with get_pool().connection() as conn:
+        for migration in migrate(conn):
+            LOGGER.info("Applied migration %d (%s)", migration.version, migration.name)
+
+
+def current_version(conn: psycopg2.extensions.connection) -> int:
+    with conn.cursor() as crsr:
+        crsr.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        if not crsr.fetchone()[0]:
+            return 0
+        crsr.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        return crsr.fetchone()[0]
+
+
+# Tables that grow without bound, and must never be scanned sequentially by a hot query
+LARGE_TABLES = ("messages", "chats_users", "users", "direct_chats")
+
+# (description, query, sample params) for the queries db_api runs on every event, i.e. its prepared statements
+PLAN_CHECKS: list[tuple[str, str, Any]] = [
+    (statement.name, statement.sql, statement.sample)
+    for statement in statements.STATEMENTS.values()
+    if statement.sample is not None
+]
+
+
+def _seq_scans(plan: dict) -> Iterator[str]:
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan.get("Relation Name")
+    for child in plan.get("Plans", []):
+        yield from _seq_scans(child)
+
+
+def check_query_plans(conn: psycopg2.extensions.connection) -> list[str]:
+    """
+    EXPLAIN every query in PLAN_CHECKS and look for sequential scans on large tables.
+    Sequential scans are disabled while planning, so one only shows up when no index can serve the query.
+    :param conn: connection to the database to check
+    :return: a description of every offending query, empty if all is well
+    """
+    failures = []
+    with conn.cursor() as crsr:
+        crsr.execute("SET LOCAL enable_seqscan = off")
+        for name, query, params in PLAN_CHECKS:
+            crsr.execute("EXPLAIN (FORMAT JSON) " + query, params)
+            plan = crsr.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            scanned = {table for table in _seq_scans(plan[0]["Plan"]) if table in LARGE_TABLES}
+            if scanned:
+                failures.append(f"{name}: sequential scan on {', '.join(sorted(scanned))}")
+    # EXPLAIN doesn't run the queries, but the UPDATEs shouldn't leave anything behind either way
+    conn.rollback()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("migrate", "status", "check-plans", "reconcile-unreads"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    pool = get_pool()
+
+    if args.command == "reconcile-unreads":
+        fixed = Database(pool).reconcile_unread_counts()
+        print(f"Fixed {fixed} unread counters")
+        return
+
+    with pool.connection() as conn:
+        if args.command == "migrate":
+            applied = migrate(conn)
+            print(f"Applied {len(applied)} migrations, now at version {current_version(conn)}")
+
+        elif args.command == "status":
+            version = current_version(conn)
+            for migration in MIGRATIONS:
+                state = "applied" if migration.version <= version else "pending"
+                print(f"{migration.version:>4}  {migration.name:<40} {state}")
+
+        elif args.command == "check-plans":
+            failures = check_query_plans(conn)
+            for failure in failures:
+                print(f"FAIL {failure}")
+            if failures:
+                sys.exit(1)
+            print(f"All {len(PLAN_CHECKS)} queries use indexes")
+
+
+if __name__ == "__main__":
+    main()
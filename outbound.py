@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import *
+
+import tornado.websocket
+
+from loop_monitor import LatencyTracker
+
+LOGGER = logging.getLogger(__name__)
+
+# What to do with a frame for a socket whose queue is full
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_DROP_NEWEST = "drop_newest"
+POLICY_DISCONNECT = "disconnect"
+POLICIES = (POLICY_DROP_OLDEST, POLICY_DROP_NEWEST, POLICY_DISCONNECT)
+
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "256"))
+OUTBOUND_POLICY = os.getenv("OUTBOUND_POLICY", POLICY_DISCONNECT)
+
+# Close code sent to consumers that can't keep up ("Try Again Later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class OutboundStats:
+    """
+    Process-wide counters for all outbound queues
+    """
+
+    def __init__(self):
+        self.enqueued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self.max_depth = 0
+        self.deliver_latency = LatencyTracker()
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "enqueued": self.enqueued,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "disconnected": self.disconnected,
+            "max_depth": self.max_depth,
+            "time_to_deliver": self.deliver_latency.summary("frame")
+        }
+
+
+stats = OutboundStats()
+
+
+class OutboundQueue:
+    """
+    A bounded queue of encoded frames for a single WebSocket, drained by its own writer task.
+    Producers never wait on the socket, so a slow client only ever delays itself.
+    """
+
+    def __init__(self,
+                 ws: tornado.websocket.WebSocketHandler,
+                 max_size: int = OUTBOUND_QUEUE_SIZE,
+                 policy: str = OUTBOUND_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown outbound policy {policy}, expected one of {POLICIES}")
+
+        self.ws = ws
+        self.max_size = max_size
+        self.policy = policy
+        self.frames: deque[tuple[str | bytes, float]] = deque()
+        self.closed = False
+
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._drain())
+
+    def close(self) -> None:
+        self.closed = True
+        self.frames.clear()
+        self._ready.set()
+        self._space.set()
+
+    def put(self, frame: str | bytes) -> bool:
+        """
+        Queue a frame without waiting. If the queue is full, the queue's policy decides what happens.
+        :param frame: encoded frame
+        :return: whether the frame was queued
+        """
+        if self.closed:
+            return False
+
+        if len(self.frames) >= self.max_size:
+            if self.policy == POLICY_DROP_NEWEST:
+                stats.dropped += 1
+                return False
+
+            if self.policy == POLICY_DISCONNECT:
+                LOGGER.warning("Disconnecting slow consumer with %d queued frames", len(self.frames))
+                stats.disconnected += 1
+                self.close()
+                self.ws.close(SLOW_CONSUMER_CLOSE_CODE, "Too slow")
+                return False
+
+            self.frames.popleft()
+            stats.dropped += 1
+
+        self._append(frame)
+        return True
+
+    async def put_wait(self, frame: str | bytes) -> bool:
+        """
+        Queue a frame, waiting for room instead of applying the queue's policy.
+        Meant for bulk senders (e.g. history streaming) that can simply slow down.
+        :param frame: encoded frame
+        :return: whether the frame was queued
+        """
+        while not self.closed and len(self.frames) >= self.max_size:
+            self._space.clear()
+            await self._space.wait()
+
+        if self.closed:
+            return False
+        self._append(frame)
+        return True
+
+    def _append(self, frame: str | bytes) -> None:
+        self.frames.append((frame, time.perf_counter()))
+        stats.enqueued += 1
+        stats.max_depth = max(stats.max_depth, len(self.frames))
+        self._ready.set()
+
+    async def _drain(self):
+        while not self.closed:
+            if not self.frames:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            frame, queued_at = self.frames.popleft()
+            if len(self.frames) < self.max_size:
+                self._space.set()
+
+            try:
+                await self.ws.write_message(frame, binary=isinstance(frame, bytes))
+            except tornado.websocket.WebSocketClosedError:
+                self.close()
+                break
+
+            stats.delivered += 1
+            stats.deliver_latency.record("frame", time.perf_counter() - queued_at)
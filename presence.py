@@ -0,0 +1,174 @@
+"""
+Ephemeral events: typing indicators and presence (online, offline, last seen).
+
+They travel as op 4 frames and are handled entirely in memory. Who is online comes from the connected
+sockets (and from what other processes announce), and who to tell comes from the membership cache.
+They never make or wait for a database round trip, so a chat whose members aren't cached is skipped
+rather than loaded. Delivery is best effort, like the indicators themselves.
+
+Op 4 frames:
+    client: {"op": 4, "data": {"type": "typing", "chat_id", "typing": bool}}
+    client: {"op": 4, "data": {"type": "presence", "user_ids": [...]}}, answered with a presence frame
+    server: {"op": 4, "data": {"type": "typing", "chat_id", "user_id", "typing": bool}}
+    server: {"op": 4, "data": {"type": "presence", "users": [{"user_id", "online", "last_seen"}, ...]}}
+
+Env config:
+- TYPING_INTERVAL_MS: at most one typing broadcast per user per chat this often (default 1000)
+- PRESENCE_CACHE_SIZE: number of users whose presence is remembered (default 100000)
+"""
+import asyncio
+import os
+import time
+from typing import *
+
+import metrics
+from caches import LRUCache, membership
+
+TYPING_INTERVAL = float(os.getenv("TYPING_INTERVAL_MS", "1000")) / 1000
+PRESENCE_CACHE_SIZE = int(os.getenv("PRESENCE_CACHE_SIZE", "100000"))
+
+# Most users a single presence request may ask about
+MAX_PRESENCE_USERS = 100
+
+
+def typing_frame(chat_id: int, user_id: int, is_typing: bool) -> dict:
+    return {
+        "op": 4,
+        "data": {
+            "type": "typing",
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "typing": is_typing
+        }
+    }
+
+
+def presence_frame(users: list[dict]) -> dict:
+    return {
+        "op": 4,
+        "data": {
+            "type": "presence",
+            "users": users
+        }
+    }
+
+
+class TypingLimiter:
+    """
+    Coalesces typing indicators: at most one broadcast per user per chat per interval.
+    A change within the interval is held back until the interval is over, and only the latest state is sent,
+    so a client toggling between typing and not typing costs one broadcast per interval at most.
+    """
+
+    def __init__(self, send: Callable[[int, int, bool], Any], interval: float = TYPING_INTERVAL):
+        """
+        :param send: called with (user_id, chat_id, is_typing) for every broadcast
+        :param interval: min seconds between two broadcasts for the same user and chat
+        """
+        self.send = send
+        self.interval = interval
+        # user_id -> chat_id -> (time of the last broadcast, state broadcast)
+        self.sent: dict[int, dict[int, tuple[float, bool]]] = {}
+        # (user_id, chat_id) -> state waiting for the end of the interval
+        self.pending: dict[tuple[int, int], bool] = {}
+
+    def update(self, user_id: int, chat_id: int, is_typing: bool) -> None:
+        """
+        A user started or stopped typing in a chat
+        """
+        last = self.sent.get(user_id, {}).get(chat_id)
+        if last is None and not is_typing:
+            # Nobody was told they were typing
+            return
+
+        now = time.monotonic()
+        if last is None or now - last[0] >= self.interval:
+            if last is not None and not last[1] and not is_typing:
+                return
+            self._send(user_id, chat_id, is_typing, now)
+            return
+
+        key = (user_id, chat_id)
+        if key not in self.pending:
+            if is_typing == last[1]:
+                return
+            asyncio.get_event_loop().call_later(self.interval - (now - last[0]), self._flush, key)
+        self.pending[key] = is_typing
+        metrics.ephemeral.inc("coalesced")
+
+    def _flush(self, key: tuple[int, int]) -> None:
+        is_typing = self.pending.pop(key, None)
+        chats = self.sent.get(key[0])
+        # Gone if the user disconnected in the meantime
+        if is_typing is None or chats is None:
+            return
+        last = chats.get(key[1])
+        if last is not None and last[1] == is_typing:
+            return
+        self._send(key[0], key[1], is_typing, time.monotonic())
+
+    def _send(self, user_id: int, chat_id: int, is_typing: bool, now: float) -> None:
+        self.sent.setdefault(user_id, {})[chat_id] = (now, is_typing)
+        self.send(user_id, chat_id, is_typing)
+
+    def forget(self, user_id: int) -> None:
+        """
+        Drop a user's state when they disconnect, telling the chats they were typing in that they stopped
+        """
+        for chat_id, (_, is_typing) in self.sent.pop(user_id, {}).items():
+            self.pending.pop((user_id, chat_id), None)
+            if is_typing:
+                self.send(user_id, chat_id, False)
+
+
+class PresenceTracker:
+    """
+    Presence of users as far as this process knows: its own sockets, and what other processes announced.
+    A process that dies without announcing its users went offline leaves them online here until they come back.
+    """
+
+    def __init__(self, max_size: int = PRESENCE_CACHE_SIZE):
+        # user_id -> (online, when they came online or were last seen, in epoch seconds)
+        self.users: LRUCache[int, tuple[bool, int]] = LRUCache(max_size)
+
+    def set(self, user_id: int, online: bool, last_seen: int | None = None) -> dict:
+        """
+        Record a user coming online or going offline
+        :param last_seen: epoch seconds, defaults to now
+        :return: the user's presence, wire-ready
+        """
+        last_seen = last_seen if last_seen is not None else int(time.time())
+        self.users.set(user_id, (online, last_seen))
+        return {"user_id": user_id, "online": online, "last_seen": last_seen}
+
+    def get(self, user_id: int) -> dict:
+        """
+        :return: the user's presence, wire-ready. last_seen is None for users we know nothing about.
+        """
+        online, last_seen = self.users.peek(user_id, (False, None))
+        return {"user_id": user_id, "online": online, "last_seen": last_seen}
+
+    def is_online(self, user_id: int) -> bool:
+        return self.users.peek(user_id, (False, None))[0]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "known": len(self.users),
+            "sent": metrics.ephemeral.get("sent"),
+            "coalesced": metrics.ephemeral.get("coalesced"),
+            "dropped": metrics.ephemeral.get("dropped")
+        }
+
+
+def contacts(user_id: int) -> set[int]:
+    """
+    The users who share a chat with a user, as far as the membership cache knows. Never loads anything.
+    """
+    found = set()
+    for chat_id in membership.peek_user_chats(user_id) or ():
+        found.update(membership.peek_chat_members(chat_id) or ())
+    found.discard(user_id)
+    return found
+
+
+tracker = PresenceTracker()
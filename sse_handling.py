@@ -1,9 +1,36 @@
+import asyncio
 import logging
+import os
+import time
+from contextvars import ContextVar
 from typing import *
 
-from db_api import Database, User
+import logs
+import metrics
+from db_api import AsyncDatabase, User, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE, \
+    SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE, SEARCH_MAX_OFFSET, SYNC_PAGE_SIZE, SYNC_MAX_PAGE_SIZE
+from loop_monitor import event_latency
 from utils import is_valid_tag
 
+LOGGER = logging.getLogger(__name__)
+
+# Max number of requests a single connection can have running at once
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "16"))
+
+# Max number of events in a single batch
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "100"))
+
+# Longest search query accepted, in characters
+MAX_SEARCH_QUERY_LENGTH = 256
+
+# Batch failure modes: roll back the whole batch on the first failed event, or only the failed events
+BATCH_ATOMIC = "atomic"
+BATCH_PER_ITEM = "per_item"
+BATCH_MODES = (BATCH_ATOMIC, BATCH_PER_ITEM)
+
+# ID of the request being processed, echoed in every frame sent for it
+current_request_id: ContextVar[Any] = ContextVar("current_request_id", default=None)
+
 
 class BaseSSEException(Exception):
     pass
@@ -13,14 +40,37 @@ class EventNotFoundException(BaseSSEException):
     pass
 
 
+class BatchRollbackException(BaseSSEException):
+    pass
+
+
 class Events:
     class Registry:
         events: dict[str, list[Callable]] = {}
+        # Handlers that may run alongside the event's other concurrent handlers
+        concurrent: set[Callable] = set()
+        # event -> data field; requests of the event with the same value run in the order they arrived
+        order_by: dict[str, str] = {}
+        # Events that wait for everything before them, and hold up everything after them
+        barriers: set[str] = set()
 
         @classmethod
-        def register(cls, name: str):
+        def register(cls, name: str, concurrent: bool = False, order_by: str | None = None, barrier: bool = False):
+            """
+            Register a handler for an event
+            :param name: event name
+            :param concurrent: whether the handler doesn't depend on the event's other handlers
+            :param order_by: data field by which requests of this event have to stay in order
+            :param barrier: whether the event changes connection state that later requests depend on
+            """
             def wrapper(coro: Callable):
                 cls.add_handler(name, coro)
+                if concurrent:
+                    cls.concurrent.add(coro)
+                if order_by is not None:
+                    cls.order_by[name] = order_by
+                if barrier:
+                    cls.barriers.add(name)
                 return coro
 
             return wrapper
@@ -31,6 +81,17 @@ class Events:
                 cls.events[name] = []
             cls.events[name].append(coro)
 
+        @classmethod
+        def order_key(cls, name: str, data: dict | None) -> Hashable | None:
+            field = cls.order_by.get(name)
+            if field is None or not isinstance(data, dict):
+                return None
+            value = data.get(field)
+            # Anything else is no valid ID (and may not even be hashable), the handler will refuse it unordered
+            if not isinstance(value, (int, str)):
+                return None
+            return field, value
+
         @classmethod
         def get(cls, name: str, index: int) -> Callable:
             return cls.events.get(name)[index]
@@ -43,8 +104,8 @@ class Events:
     def get_events(cls):
         return list(Events.Registry.events.keys())
 
-    def __init__(self, ws):
-        self.db = Database()
+    def __init__(self, ws, db: AsyncDatabase | None = None):
+        self.db = db if db is not None else AsyncDatabase()
         self.ws: 'TwaddleWSServer' = ws
 
     @staticmethod
@@ -65,15 +126,15 @@ class Events:
 
         return resp
 
-    @Registry.register("CREATE_USER")
+    @Registry.register("CREATE_USER", barrier=True)
     async def create_user(self, event: str, data: dict):
         if not is_valid_tag(data.get("usertag")):
             return Events._prepare_event_resp(event, False)
 
-        if self.db.get_user_by_tag(data.get("usertag")) is not None:
+        if await self.db.get_user_by_tag(data.get("usertag")) is not None:
             return Events._prepare_event_resp(event, False)
 
-        res = self.db.register_user(
+        res = await self.db.register_user(
             data.get("firebase_uid"),
             data.get("usertag"),
             data.get("username")
@@ -81,34 +142,32 @@ class Events:
 
         if res is None:
             return Events._prepare_event_resp(event, False)
-        return Events._prepare_event_resp(event, True, vars(res))
+        return Events._prepare_event_resp(event, True, res.serialize())
 
-    @Registry.register("LOGIN_USER")
+    @Registry.register("LOGIN_USER", concurrent=True, barrier=True)
     async def login_user(self, event: str, data: dict):
-        res = self.db.get_user_by_fuid(
+        res = await self.db.get_user_by_fuid(
             data.get("firebase_id")
         )
 
         if res is None:
             return Events._prepare_event_resp(event, False)
-        return Events._prepare_event_resp(event, True, vars(res))
+        return Events._prepare_event_resp(event, True, res.serialize())
 
     @Registry.register("CREATE_USER_CHAT")
     async def create_user_chat(self, event: str, data: dict):
         user_tag = data.get("recv_user_tag")
         orig_user_id: int = data.get("orig_user_id")
 
-        user: User = self.db.get_user_by_tag(user_tag)
+        user: User = await self.db.get_user_by_tag(user_tag)
         if user is None:
             return Events._prepare_event_resp(event, False)
 
         if user.user_id == orig_user_id:
             return Events._prepare_event_resp(event, False)
 
-        if self.db.get_chat_by_users((orig_user_id, user.user_id)) is not None:
-            return Events._prepare_event_resp(event, False)
-
-        res = self.db.create_user_chat(orig_user_id, user.user_id)
+        # Fails if the users already have a chat
+        res = await self.db.create_user_chat(orig_user_id, user.user_id)
 
         if res is None:
             return Events._prepare_event_resp(event, False)
@@ -122,30 +181,153 @@ class Events:
     async def load_user_chats(self, event: str, data: dict):
         user_id = data.get("user_id")
 
-        res = self.db.load_user_chats(user_id)
-        res.sort(key=lambda x: x.time_last_msg, reverse=True)
-        print(res)
-        res_srz = [chat.serialize() for chat in res]
+        res_srz = await self.db.load_user_chats(user_id, serialized=True)
         return self._prepare_event_resp(event, True, {
             "chats": res_srz
         })
 
-    @Registry.register("LOAD_SINGLE_CHAT")
+    @Registry.register("LOAD_SINGLE_CHAT", concurrent=True, order_by="chat_id")
     async def load_single_chat(self, event: str, data: dict):
+        """
+        Load a chat's members and history, and mark the chat as read up to the newest message loaded.
+        History is paged with "before_message_id"/"after_message_id" and "limit".
+        With "stream" set, history is sent as a series of chunk frames before the response, except in a batch,
+        where it is sent in the response like without it.
+        Without any of these, the whole history is sent in the response, as older clients expect.
+        """
         chat_id = data.get("chat_id")
+        before = data.get("before_message_id")
+        after = data.get("after_message_id")
+        limit = data.get("limit")
 
-        msgs = self.db.get_chat_messages(chat_id)
-        users = self.db.get_chat_users(chat_id)
-
-        msgs_ls = [msg.serialize() for msg in msgs]
+        users = await self.db.get_chat_users(chat_id)
         users_ls = [user.serialize() for user in users]
 
+        # Waiting on a slow client would hold the batch's connection and transaction open
+        if data.get("stream") and self.db.sync.conn is None:
+            return await self._stream_chat_history(event, chat_id, before, limit, users_ls)
+
+        if before is None and after is None and limit is None:
+            msgs = await self.db.get_chat_messages(chat_id, serialized=True)
+            await self._mark_loaded(chat_id, msgs)
+            return self._prepare_event_resp(event, True, {
+                "users": users_ls,
+                "messages": msgs
+            })
+
+        limit = int(limit or HISTORY_PAGE_SIZE)
+        msgs = await self.db.get_chat_messages_page(chat_id, before, after, limit, serialized=True)
+        await self._mark_loaded(chat_id, msgs)
+
+        return self._prepare_event_resp(event, True, {
+            "users": users_ls,
+            "messages": msgs,
+            # Pass back as "before_message_id" to get the next (older) page
+            "next_before_message_id": msgs[-1]["message_id"] if msgs else None,
+            "has_more": len(msgs) == min(limit, HISTORY_MAX_PAGE_SIZE)
+        })
+
+    async def _stream_chat_history(self, event: str, chat_id: int, before: int | None, limit: int | None,
+                                   users_ls: list[dict]):
+        chunks = 0
+        msg_count = 0
+        gen = self.db.sync.iter_chat_messages(chat_id, before, int(limit or HISTORY_PAGE_SIZE), serialized=True)
+        async for msgs in self.db.iterate(gen):
+            chunk = self._prepare_event_resp(event, True, {
+                "chat_id": chat_id,
+                "chunk": chunks,
+                "messages": msgs
+            })
+            if current_request_id.get() is not None:
+                chunk["id"] = current_request_id.get()
+            if chunks == 0:
+                await self._mark_loaded(chat_id, msgs)
+
+            # Waits for room in the socket's queue, so history is only read as fast as the client takes it
+            await self.ws.outbound.put_wait(self.ws.codec.encode(chunk))
+            chunks += 1
+            msg_count += len(msgs)
+
         return self._prepare_event_resp(event, True, {
             "users": users_ls,
-            "messages": msgs_ls
+            "messages": [],
+            "chunks": chunks,
+            "message_count": msg_count
+        })
+
+    async def _mark_loaded(self, chat_id: int, msgs: list[dict]) -> None:
+        """
+        Mark a chat as read up to the newest of the messages sent to the client.
+        Not up to the chat's last message: markers are written a little later, and a message that arrives
+        in the meantime hasn't been seen.
+        :param msgs: loaded messages, newest first
+        """
+        if msgs:
+            await self.db.mark_chat_as_read(chat_id, self.ws.user_id, msgs[0]["message_id"])
+
+    @Registry.register("SEARCH_MESSAGES")
+    async def search_messages(self, event: str, data: dict):
+        """
+        Search the messages of the logged in user's chats, newest first.
+        Takes "query", and optionally "chat_id", "limit", and "before_message_id" for the next page.
+        """
+        query = (data.get("query") or "").strip()
+        if self.ws.user_id == 0 or not query or len(query) > MAX_SEARCH_QUERY_LENGTH:
+            return Events._prepare_event_resp(event, False)
+
+        limit = int(data.get("limit") or SEARCH_PAGE_SIZE)
+        msgs = await self.db.search_messages(self.ws.user_id, query, data.get("chat_id"),
+                                             data.get("before_message_id"), limit, serialized=True)
+        return self._prepare_event_resp(event, True, {
+            "messages": msgs,
+            # Pass back as "before_message_id" to get the next page
+            "next_before_message_id": msgs[-1]["message_id"] if msgs else None,
+            "has_more": len(msgs) == min(limit, SEARCH_MAX_PAGE_SIZE)
+        })
+
+    @Registry.register("SEARCH_USERS")
+    async def search_users(self, event: str, data: dict):
+        """
+        Find users by tag prefix or by name, best matches first. Only for logged in users.
+        Takes "query", and optionally "limit", and "offset" for the next page.
+        """
+        query = (data.get("query") or "").strip()
+        if self.ws.user_id == 0 or not query or len(query) > MAX_SEARCH_QUERY_LENGTH:
+            return Events._prepare_event_resp(event, False)
+
+        limit = int(data.get("limit") or SEARCH_PAGE_SIZE)
+        offset = int(data.get("offset") or 0)
+        if offset > SEARCH_MAX_OFFSET:
+            return Events._prepare_event_resp(event, False)
+
+        users = await self.db.search_users(query, limit, offset)
+        has_more = len(users) == min(limit, SEARCH_MAX_PAGE_SIZE)
+        return self._prepare_event_resp(event, True, {
+            "users": users,
+            # Pass back as "offset" to get the next page
+            "next_offset": offset + len(users) if has_more else None,
+            "has_more": has_more
         })
 
-    @Registry.register("UPDATE_DETAILS")
+    @Registry.register("SYNC_SINCE")
+    async def sync_since(self, event: str, data: dict):
+        """
+        Catch a reconnecting client up on the logged in user's chats, instead of reloading them.
+        Takes "message_id", the last message the client has, and "marker_version" from its last sync.
+        Sends the messages after it, oldest first, in pages of "limit", with the read markers and chat list
+        entries that changed. Pass "next_message_id" and "marker_version" back while "has_more" is set.
+        Messages that committed after an earlier sync passed their ID are sent again, so dedupe by message_id.
+        """
+        if self.ws.user_id == 0:
+            return Events._prepare_event_resp(event, False)
+
+        after = int(data.get("message_id") or 0)
+        limit = int(data.get("limit") or SYNC_PAGE_SIZE)
+        res = await self.db.sync_since(self.ws.user_id, after, int(data.get("marker_version") or 0), limit)
+        res["has_more"] = len(res["messages"]) == min(limit, SYNC_MAX_PAGE_SIZE)
+        return self._prepare_event_resp(event, True, res)
+
+    @Registry.register("UPDATE_DETAILS", barrier=True)
     async def update_details(self, event: str, data: dict):
         user_id = data.get("user_id")
         firebase_id = data.get("firebase_id")
@@ -155,9 +337,9 @@ class Events:
         if not is_valid_tag(user_tag):
             return Events._prepare_event_resp(event, False)
 
-        old_user = self.db.get_user(user_id)
+        old_user = await self.db.get_user(user_id)
         if old_user.user_tag != user_tag \
-                and self.db.get_user_by_tag(user_tag) is not None:
+                and await self.db.get_user_by_tag(user_tag) is not None:
             return self._prepare_event_resp(event, False)
 
         user_obj = User(
@@ -167,7 +349,7 @@ class Events:
             username
         )
 
-        res = self.db.update_user(user_obj)
+        res = await self.db.update_user(user_obj)
 
         return self._prepare_event_resp(event, res, user_obj.serialize())
 
@@ -177,26 +359,179 @@ class ServerSideEventHandler:
     Handles server event management
     """
 
-    def __init__(self, ws, handler: logging.Handler = None):
-        self.log = logging.Logger("SSEH")
-        if handler is not None:
-            self.log.addHandler(handler)
-        self.events = Events(ws)
-
-    async def handle(self, received_data: dict):
+    def __init__(self, ws, db: AsyncDatabase | None = None):
+        """
+        :param ws: the connection's socket
+        :param db: database to handle its events with, defaults to the configured one
+        """
+        # Shared by every connection
+        self.log = LOGGER
+        self.events = Events(ws, db)
+
+    async def handle(self, received_data: dict, events: Events | None = None):
+        """
+        Run all handlers of an event
+        :param received_data: the received frame
+        :param events: Events to run the handlers with, defaults to the connection's
+        :return: the handlers' responses
+        """
+        events = events if events is not None else self.events
         event = received_data.get("data").get("event")
 
         handler_ls: list[Callable] = self.events.Registry.get_all(event)
-        print(handler_ls)
 
-        self.log.info(f"Now handling event {event}")
         res_ls: list[dict] = []
         if handler_ls:
-            for handler in handler_ls:
-                res_ls.append(await handler(self=self.events, event=event, data=received_data.get("data").get("data")))
+            start = time.perf_counter()
+            data = received_data.get("data").get("data")
+
+            # Handlers that don't depend on each other run together, the rest run in registration order
+            concurrent = [handler for handler in handler_ls if handler in self.events.Registry.concurrent]
+            pending = asyncio.gather(*(handler(self=events, event=event, data=data) for handler in concurrent))
+            try:
+                for handler in handler_ls:
+                    if handler not in concurrent:
+                        res_ls.append(await handler(self=events, event=event, data=data))
+            except BaseException:
+                # Wait for the concurrent handlers too, so none outlives the request and their errors are retrieved
+                await asyncio.gather(pending, return_exceptions=True)
+                raise
+            res_ls.extend(await pending)
+
+            elapsed = time.perf_counter() - start
+            event_latency.record(event, elapsed)
+            metrics.event_duration.observe(elapsed, event)
+            success = all(res is None or res["data"]["s"] for res in res_ls)
+            if not success:
+                metrics.event_failures.inc(event)
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("Handled event", extra=logs.fields(
+                    sample="event", event=event, user_id=events.ws.user_id if events.ws else None,
+                    success=success, latency=f"{elapsed * 1000:.2f}ms"
+                ))
         else:
             raise EventNotFoundException(f"No handlers found for event {event}")
 
         if res_ls is not None:
-            self.log.info("Sending response")
             return res_ls
+
+    @staticmethod
+    def _prepare_batch_resp(success: bool, mode: str, results: list[list[dict]], failed: list[int]):
+        return {
+            "op": 3,
+            "data": {
+                "s": success,
+                "mode": mode,
+                "results": results,
+                "failed": failed
+            }
+        }
+
+    async def handle_batch(self, received_data: dict) -> dict:
+        """
+        Run a batch of events, in order, in a single transaction.
+        In "atomic" mode (the default) the first failed event rolls the whole batch back and the rest are skipped.
+        In "per_item" mode only the failed events are rolled back, and the rest are committed.
+        :param received_data: the received op 3 frame, with "events" (list of {"event", "data"}) and "mode"
+        :return: the batch response, with each event's responses in order
+        """
+        batch = received_data.get("data") or {}
+        items = batch.get("events") or []
+        mode = batch.get("mode") or BATCH_ATOMIC
+        if mode not in BATCH_MODES or len(items) > MAX_BATCH_SIZE:
+            return self._prepare_batch_resp(False, mode, [], [])
+
+        results: list[list[dict]] = []
+        failed: list[int] = []
+        try:
+            async with self.events.db.transaction() as db:
+                events = Events(self.events.ws, db)
+                for index, item in enumerate(items):
+                    marker = await db.savepoint() if mode == BATCH_PER_ITEM else 0
+
+                    res_ls, success = await self._handle_batch_item(item, events)
+                    results.append(res_ls)
+                    if success:
+                        if mode == BATCH_PER_ITEM:
+                            await db.release_savepoint()
+                        continue
+
+                    failed.append(index)
+                    if mode == BATCH_ATOMIC:
+                        raise BatchRollbackException(f"Event {index} of the batch failed")
+                    await db.rollback_to_savepoint(marker)
+        except BatchRollbackException:
+            return self._prepare_batch_resp(False, mode, results, failed)
+
+        return self._prepare_batch_resp(not failed, mode, results, failed)
+
+    async def _handle_batch_item(self, item: dict, events: Events) -> tuple[list[dict], bool]:
+        event = item.get("event")
+        try:
+            res_ls = await self.handle({"data": item}, events)
+        except Exception:
+            self.log.exception("Failed handling batched event %s", event, extra=logs.fields(event=event))
+            metrics.errors.inc("batch_event")
+            return [Events._prepare_event_resp(event, False)], False
+
+        res_ls = [res for res in res_ls if res is not None]
+        return res_ls, all(res["data"]["s"] for res in res_ls)
+
+
+class RequestScheduler:
+    """
+    Runs a connection's requests concurrently, up to a limit.
+    Requests sharing an order key run in arrival order, and barrier requests
+    run alone: after everything before them, and before everything after them.
+    """
+
+    def __init__(self, max_in_flight: int = MAX_IN_FLIGHT):
+        self.slots = asyncio.Semaphore(max_in_flight)
+        # Completion of the last request per order key
+        self.tails: dict[Hashable, asyncio.Future] = {}
+        self.barrier: asyncio.Future | None = None
+        self.in_flight: set[asyncio.Future] = set()
+        # The loop only keeps weak references to tasks, these have to outlive submit()
+        self.tasks: set[asyncio.Task] = set()
+
+    async def submit(self, run: Callable[[], Awaitable], order_key: Hashable | None = None, barrier: bool = False):
+        """
+        Schedule a request. Returns once it has been scheduled, which waits while the connection is at its limit.
+        :param run: coroutine function processing the request
+        :param order_key: requests with the same key run one after another
+        :param barrier: whether the request has to run alone
+        """
+        await self.slots.acquire()
+
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        waits = []
+        if self.barrier is not None and not self.barrier.done():
+            waits.append(self.barrier)
+        if barrier:
+            waits.extend(self.in_flight)
+            self.barrier = done
+        elif order_key is not None and order_key in self.tails:
+            waits.append(self.tails[order_key])
+
+        if order_key is not None:
+            self.tails[order_key] = done
+        self.in_flight.add(done)
+
+        task = loop.create_task(self._run(run, waits, done, order_key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, run: Callable[[], Awaitable], waits: list[asyncio.Future], done: asyncio.Future,
+                   order_key: Hashable | None):
+        try:
+            if waits:
+                await asyncio.wait(waits)
+            await run()
+        finally:
+            done.set_result(None)
+            self.in_flight.discard(done)
+            if order_key is not None and self.tails.get(order_key) is done:
+                del self.tails[order_key]
+            self.slots.release()
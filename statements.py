@@ -0,0 +1,93 @@
+"""
+Server-side prepared statements.
+
+Hot queries are registered here by name. The first time a statement runs on a
+connection it is PREPAREd there, and from then on it is EXECUTEd by name, so
+Postgres parses and plans it once per connection instead of on every call.
+Queries are written with psycopg2's named placeholders (%(name)s), which are
+turned into PREPARE's positional parameters.
+
+Env config:
+- DB_PREPARE: "1" (default) to prepare statements, "0" to send the query text on every call,
+  e.g. behind a transaction-pooling PgBouncer, where prepared statements don't follow the client
+"""
+import os
+import re
+import threading
+import weakref
+from typing import *
+
+import psycopg2.extensions
+
+PREPARE_STATEMENTS = os.getenv("DB_PREPARE", "1") == "1"
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s")
+
+
+class Statement:
+    def __init__(self, name: str, sql: str, sample: dict | None = None):
+        """
+        :param name: name the statement is prepared under
+        :param sql: the query, with %(name)s placeholders
+        :param sample: sample parameters, for checking the statement's plan
+        """
+        self.name = name
+        self.sql = sql
+        self.sample = sample
+        # Parameter names, in positional order
+        self.params: list[str] = []
+
+        def number(match: re.Match) -> str:
+            param = match.group(1)
+            if param not in self.params:
+                self.params.append(param)
+            return f"${self.params.index(param) + 1}"
+
+        self.prepare_sql = f"PREPARE {name} AS {_PLACEHOLDER.sub(number, sql).replace('%%', '%')}"
+        self.execute_sql = f"EXECUTE {name}"
+        if self.params:
+            self.execute_sql += f" ({', '.join(f'%({param})s' for param in self.params)})"
+
+
+STATEMENTS: dict[str, Statement] = {}
+
+# connection -> names of the statements prepared on it. Connections die with their prepared statements.
+_prepared: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+
+def register(name: str, sql: str, sample: dict | None = None) -> Statement:
+    """
+    Register a statement
+    :param name: unique name, used to run it
+    :param sql: the query, with %(name)s placeholders
+    :param sample: sample parameters, for checking the statement's plan (see migrations.check_query_plans)
+    :return: the statement
+    """
+    if name in STATEMENTS:
+        raise ValueError(f"Statement {name} already exists")
+    statement = STATEMENTS[name] = Statement(name, sql, sample)
+    return statement
+
+
+def execute(crsr: psycopg2.extensions.cursor, name: str, params: dict | None = None) -> None:
+    """
+    Run a registered statement on a cursor, preparing it on the cursor's connection first if needed
+    :param crsr: cursor to run the statement on
+    :param name: name the statement was registered under
+    :param params: the statement's parameters, by name
+    """
+    statement = STATEMENTS[name]
+    params = params if params is not None else {}
+    if not PREPARE_STATEMENTS:
+        crsr.execute(statement.sql, params)
+        return
+
+    with _prepared_lock:
+        prepared = _prepared.setdefault(crsr.connection, set())
+    if name not in prepared:
+        # Prepared statements belong to the session, a later rollback doesn't take them back
+        crsr.execute(statement.prepare_sql)
+        prepared.add(name)
+    crsr.execute(statement.execute_sql, params)
+
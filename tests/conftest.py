@@ -0,0 +1,135 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+# The modules live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_api import AsyncDatabase
+
+
+class FakeCursor:
+    def __init__(self, conn: 'FakeConnection'):
+        self.connection = conn
+        self.rowcount = -1
+
+    def __enter__(self) -> 'FakeCursor':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def execute(self, query: str, params: Any = None) -> None:
+        if self.connection.closed or self.connection.broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.connection.executed.append((query, params))
+        self.connection.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+    def fetchone(self) -> None:
+        return None
+
+    def fetchall(self) -> list:
+        return []
+
+
+class FakeConnection:
+    """
+    Stands in for a psycopg2 connection where a test needs one but no Postgres.
+    Records the statements executed on it, and fails them all once broken.
+    """
+
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.executed: list[tuple[str, Any]] = []
+        self.commits = 0
+        self.rollbacks = 0
+
+        class Info:
+            transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+        self.info = Info()
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+    def commit(self) -> None:
+        if self.closed or self.broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.commits += 1
+        self.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self) -> None:
+        if self.closed or self.broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.rollbacks += 1
+        self.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self) -> None:
+        self.closed = 1
+
+
+class FakeDatabase:
+    """
+    Stands in for Database where a test needs writes but no Postgres.
+    Its methods run on executor threads, like the real ones.
+    A message whose content is "bad" violates a constraint, and the exceptions in errors[method]
+    are raised, in order, by the next calls to that method instead of doing anything.
+    """
+
+    def __init__(self):
+        self.errors: dict[str, list[Exception]] = {}
+        # (method, args) of every call that went through
+        self.calls: list[tuple[str, Any]] = []
+        self.lock = threading.Lock()
+
+    def _call(self, method: str, args: Any) -> None:
+        with self.lock:
+            errors = self.errors.get(method)
+            if errors:
+                raise errors.pop(0)
+            self.calls.append((method, args))
+
+    def recorded(self, method: str) -> list:
+        """
+        :return: the args of every call of a method that went through
+        """
+        return [args for name, args in self.calls if name == method]
+
+    def create_new_messages(self, rows: list[tuple[int, int, str]]) -> list[str]:
+        self._call("create_new_messages", rows)
+        if any(content == "bad" for _, _, content in rows):
+            raise psycopg2.IntegrityError("bad message")
+        return [content for _, _, content in rows]
+
+    def create_new_message(self, chat_id: int, user_id: int, content: str) -> str:
+        self._call("create_new_message", (chat_id, user_id, content))
+        if content == "bad":
+            raise psycopg2.IntegrityError("bad message")
+        return content
+
+    def mark_chats_as_read(self, markers: list[tuple[int, int, int | None]]) -> int:
+        self._call("mark_chats_as_read", markers)
+        return len(markers)
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        yield executor
+
+
+@pytest.fixture
+def fake_db() -> FakeDatabase:
+    return FakeDatabase()
+
+
+@pytest.fixture
+def db(fake_db: FakeDatabase, executor: ThreadPoolExecutor) -> AsyncDatabase:
+    return AsyncDatabase(fake_db, executor)
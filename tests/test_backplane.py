@@ -0,0 +1,52 @@
+import json
+
+import db_pool
+from backplane import PostgresBackplane, MAX_NOTIFY_PAYLOAD
+from db_pool import ConnectionPool
+
+from conftest import FakeConnection
+
+
+def published(monkeypatch, publish) -> list[dict]:
+    """
+    Run publish(backplane) against a pool of fake connections
+    :return: the envelopes NOTIFYed, in the order they were sent
+    """
+    connections = []
+
+    def connect():
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    pool = ConnectionPool(connect_func=connect, min_size=0, max_size=4)
+    monkeypatch.setattr(db_pool, "get_pool", lambda: pool)
+
+    bp = PostgresBackplane(channel="test", origin="here")
+    publish(bp)
+    if bp._publisher is not None:
+        bp._publisher.shutdown(wait=True)
+
+    sent = []
+    for conn in connections:
+        sent.extend(params for _, params in conn.executed)
+    return [json.loads(payload) for _, payload in sent]
+
+
+def test_publishes_in_order(monkeypatch):
+    def publish(bp):
+        for i in range(50):
+            bp.publish("deliver", users=[1], frame=str(i))
+
+    envelopes = published(monkeypatch, publish)
+    assert [envelope["frame"] for envelope in envelopes] == [str(i) for i in range(50)]
+    assert envelopes[0] == {"kind": "deliver", "origin": "here", "users": [1], "frame": "0"}
+
+
+def test_large_frame_is_left_out(monkeypatch):
+    envelopes = published(monkeypatch, lambda bp: bp.publish("deliver", users=[1], frame="x" * MAX_NOTIFY_PAYLOAD,
+                                                             message_id=5))
+    assert envelopes == [{"kind": "deliver", "origin": "here", "users": [1], "frame": None, "message_id": 5}]
+
+
+def test_too_large_envelope_is_dropped(monkeypatch):
+    assert published(monkeypatch, lambda bp: bp.publish("deliver", users=list(range(5000)))) == []
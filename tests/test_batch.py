@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from db_api import AsyncDatabase, Database
+from db_pool import ConnectionPool
+from sse_handling import Events, ServerSideEventHandler, BATCH_ATOMIC, BATCH_PER_ITEM, MAX_BATCH_SIZE
+
+from conftest import FakeConnection
+
+
+class FakeSocket:
+    user_id = 1
+
+
+def write(db: Database, n: int) -> None:
+    with db._cursor() as crsr:
+        crsr.execute("INSERT %s", (n,))
+
+
+@pytest.fixture
+def batch(monkeypatch, executor):
+    """
+    Runs a batch of TEST events against a pool of one fake connection
+    :return: (run(events, mode), the connection, what was pushed after commit)
+    """
+    conn = FakeConnection()
+    pool = ConnectionPool(connect_func=lambda: conn, min_size=1, max_size=1)
+    handler = ServerSideEventHandler(FakeSocket(), AsyncDatabase(Database(pool), executor))
+    pushed = []
+
+    async def ok(self, event, data):
+        await self.db.run(write, self.db.sync, data["n"])
+        await self.db.after_commit(pushed.append, data["n"])
+        return Events._prepare_event_resp(event, True)
+
+    async def fail(self, event, data):
+        await self.db.run(write, self.db.sync, data["n"])
+        await self.db.after_commit(pushed.append, data["n"])
+        return Events._prepare_event_resp(event, False)
+
+    async def boom(self, event, data):
+        raise ValueError("boom")
+
+    monkeypatch.setitem(Events.Registry.events, "TEST_OK", [ok])
+    monkeypatch.setitem(Events.Registry.events, "TEST_FAIL", [fail])
+    monkeypatch.setitem(Events.Registry.events, "TEST_BOOM", [boom])
+
+    def run(events: list[tuple[str, int]], mode: str | None = None) -> dict:
+        data = {"events": [{"event": event, "data": {"n": n}} for event, n in events]}
+        if mode is not None:
+            data["mode"] = mode
+        return asyncio.run(handler.handle_batch({"op": 3, "data": data}))["data"]
+
+    return run, conn, pushed
+
+
+def statements(conn: FakeConnection) -> list[str]:
+    return [query if params is None else query % params for query, params in conn.executed]
+
+
+def test_atomic_batch_commits(batch):
+    run, conn, pushed = batch
+    res = run([("TEST_OK", 1), ("TEST_OK", 2)])
+    assert (res["s"], res["mode"], res["failed"]) == (True, BATCH_ATOMIC, [])
+    assert [[resp["data"]["s"] for resp in res_ls] for res_ls in res["results"]] == [[True], [True]]
+    assert statements(conn) == ["INSERT 1", "INSERT 2"]
+    assert (conn.commits, conn.rollbacks) == (1, 0)
+    assert pushed == [1, 2]
+
+
+def test_atomic_batch_rolls_back_on_first_failure(batch):
+    run, conn, pushed = batch
+    res = run([("TEST_OK", 1), ("TEST_FAIL", 2), ("TEST_OK", 3)], BATCH_ATOMIC)
+    assert (res["s"], res["failed"]) == (False, [1])
+    # The rest is skipped
+    assert len(res["results"]) == 2
+    assert statements(conn) == ["INSERT 1", "INSERT 2"]
+    assert (conn.commits, conn.rollbacks) == (0, 1)
+    assert pushed == []
+
+
+def test_per_item_batch_only_rolls_back_failed_events(batch):
+    run, conn, pushed = batch
+    res = run([("TEST_OK", 1), ("TEST_FAIL", 2), ("TEST_BOOM", 3), ("TEST_OK", 4)], BATCH_PER_ITEM)
+    assert (res["s"], res["mode"], res["failed"]) == (False, BATCH_PER_ITEM, [1, 2])
+    assert [[resp["data"]["s"] for resp in res_ls] for res_ls in res["results"]] == [[True], [False], [False], [True]]
+    assert statements(conn) == [
+        "SAVEPOINT batch_item", "INSERT 1", "RELEASE SAVEPOINT batch_item",
+        "SAVEPOINT batch_item", "INSERT 2", "ROLLBACK TO SAVEPOINT batch_item; RELEASE SAVEPOINT batch_item",
+        "SAVEPOINT batch_item", "ROLLBACK TO SAVEPOINT batch_item; RELEASE SAVEPOINT batch_item",
+        "SAVEPOINT batch_item", "INSERT 4", "RELEASE SAVEPOINT batch_item"
+    ]
+    assert conn.commits == 1
+    # Pushes of the rolled back events are dropped with them
+    assert pushed == [1, 4]
+
+
+@pytest.mark.parametrize("mode, size", [("all_or_nothing", 1), (BATCH_ATOMIC, MAX_BATCH_SIZE + 1)])
+def test_refused_batches(batch, mode, size):
+    run, conn, pushed = batch
+    res = run([("TEST_OK", n) for n in range(size)], mode)
+    assert res["s"] is False
+    assert res["results"] == []
+    assert conn.executed == []
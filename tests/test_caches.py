@@ -0,0 +1,155 @@
+import time
+
+from caches import LRUCache, MembershipIndex, UserCache
+from db_api import User
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set(1, "a")
+    cache.set(2, "b")
+    # Reading 1 makes 2 the least recently used
+    assert cache.get(1) == "a"
+    cache.set(3, "c")
+    assert cache.get(2) is None
+    assert (cache.get(1), cache.get(3)) == ("a", "c")
+    assert cache.evictions == 1
+
+
+def test_lru_peek_does_not_refresh():
+    cache = LRUCache(2)
+    cache.set(1, "a")
+    cache.set(2, "b")
+    assert cache.peek(1) == "a"
+    cache.set(3, "c")
+    assert cache.peek(1) is None
+    assert cache.hits == 0
+
+
+def test_lru_ttl():
+    cache = LRUCache(10, ttl=0.05)
+    cache.set(1, "a")
+    assert cache.get(1) == "a"
+    time.sleep(0.06)
+    assert cache.peek(1) is None
+    assert cache.get(1, "gone") == "gone"
+    # Expired entries are dropped when they are read
+    assert len(cache) == 0
+    assert cache.misses == 1
+
+
+def test_lru_update_keeps_expiry():
+    cache = LRUCache(10, ttl=0.05)
+    cache.set(1, 1)
+    cache.update(1, lambda value: value + 1)
+    cache.update(2, lambda value: value + 1)
+    assert cache.get(1) == 2
+    assert cache.get(2) is None
+    time.sleep(0.06)
+    assert cache.get(1) is None
+
+
+def test_membership_loads_once():
+    index = MembershipIndex()
+    loads = []
+
+    def loader(chat_id):
+        loads.append(chat_id)
+        return [1, 2]
+
+    assert index.get_chat_members(5, loader) == {1, 2}
+    assert index.get_chat_members(5, loader) == {1, 2}
+    assert loads == [5]
+
+
+def test_membership_load_racing_a_change_is_not_cached():
+    index = MembershipIndex()
+
+    def members(chat_id):
+        # A member joins while the old member list is being read
+        index.member_added(chat_id, 3)
+        return [1, 2]
+
+    def chats(user_id):
+        index.invalidate_chat(6)
+        return [5]
+
+    assert index.get_chat_members(5, members) == {1, 2}
+    assert index.peek_chat_members(5) is None
+    assert index.get_user_chats(1, chats) == {5}
+    assert index.user_chats.peek(1) is None
+
+
+def test_membership_changes_apply_to_cached_entries():
+    index = MembershipIndex()
+    changes = []
+    index.listeners.append(lambda *change: changes.append(change))
+    index.get_chat_members(5, lambda chat_id: [1, 2])
+    index.get_chat_members(6, lambda chat_id: [1])
+    index.get_user_chats(1, lambda user_id: [5, 6])
+
+    index.member_added(6, 2)
+    assert index.peek_chat_members(6) == {1, 2}
+    # Not cached, so not made up either
+    assert index.user_chats.peek(2) is None
+
+    index.member_removed(5, 1)
+    assert index.peek_chat_members(5) == {2}
+    assert index.user_chats.peek(1) == {6}
+
+    # Changes from other processes aren't passed on again
+    index.apply(6, [1], False)
+    assert changes == [(6, (2,), True), (5, (1,), False)]
+
+
+def test_user_cache_lookups():
+
+    cache = UserCache()
+    user = User(1, "fuid-1", "alice", "Alice")
+    cache.put(user)
+    assert cache.get(1) is user
+    assert cache.get_by_fuid("fuid-1") is user
+    assert cache.get_by_tag("alice") is user
+    assert cache.get_by_tag("bob") is None
+    assert cache.hits == {"user_id": 1, "firebase_id": 1, "user_tag": 1}
+    assert cache.misses["user_tag"] == 1
+
+
+def test_user_cache_changed_tag_drops_the_old_one():
+
+    cache = UserCache()
+    cache.put(User(1, "fuid-1", "alice", "Alice"))
+    cache.put(User(1, "fuid-1", "alicia", "Alice"))
+    assert cache.get_by_tag("alice") is None
+    assert cache.by_tag.peek("alice") is None
+    assert cache.get_by_tag("alicia").user_id == 1
+
+
+def test_user_cache_stale_secondary_key_is_a_miss():
+
+    cache = UserCache()
+    cache.put(User(1, "fuid-1", "alice", "Alice"))
+    # Evicted by user_id only, so the put of the renamed user can't tell which tag to drop
+    cache.by_id.pop(1)
+    cache.put(User(1, "fuid-1", "alicia", "Alice"))
+    assert cache.by_tag.peek("alice") == 1
+    assert cache.get_by_tag("alice") is None
+    assert cache.get_by_tag("alicia").user_tag == "alicia"
+
+
+def test_user_cache_invalidate():
+
+    cache = UserCache()
+    cache.put(User(1, "fuid-1", "alice", "Alice"))
+    cache.invalidate(1)
+    assert cache.get(1) is None
+    assert cache.get_by_fuid("fuid-1") is None
+    assert cache.get_by_tag("alice") is None
+
+
+def test_user_cache_ttl():
+
+    cache = UserCache(ttl=0.05)
+    cache.put(User(1, "fuid-1", "alice", "Alice"))
+    time.sleep(0.06)
+    assert cache.get_by_tag("alice") is None
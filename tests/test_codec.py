@@ -0,0 +1,78 @@
+import msgpack
+import pytest
+
+from codec import JSON, MSGPACK, CodecException, EVENT_CODES, select_codec
+
+FRAMES = [
+    {"op": 1, "id": 7, "data": {"event": "SEND_CHAT_MESSAGE", "data": {"chat_id": 1, "content": "hi"}}},
+    {"op": 1, "id": 7, "data": {"e": "SEND_CHAT_MESSAGE", "s": True, "data": {"message_id": 3}}},
+    {"op": 1, "id": None, "data": {"e": "LOGIN_USER", "s": False}},
+    # Events without a code travel by name
+    {"op": 1, "id": "x", "data": {"event": "NOT_AN_EVENT", "data": {}}},
+    {"op": 2, "data": {"type": "message", "message_id": 3}},
+    {"op": 3, "id": 9, "data": {"events": [{"event": "MARK_AS_READ", "data": {"chat_id": 1}}], "mode": "per_item"}},
+    {"op": 3, "id": 9, "data": {"events": [{"event": "MARK_AS_READ", "data": {"chat_id": 1}}]}},
+    {"op": 3, "id": 9, "data": {"s": True, "mode": "atomic", "failed": None,
+                                "results": [[{"op": 1, "id": 9, "data": {"e": "MARK_AS_READ", "s": True}}]]}},
+    {"op": 4, "data": {"type": "typing", "chat_id": 1, "user_id": 2, "typing": True}},
+]
+
+
+@pytest.mark.parametrize("frame", FRAMES)
+def test_json_round_trip(frame):
+    assert JSON.decode(JSON.encode(frame)) == frame
+
+
+# Batch responses are only ever sent, so they are only packed
+@pytest.mark.parametrize("frame", [frame for frame in FRAMES if frame["op"] != 3 or "results" not in frame["data"]])
+def test_msgpack_round_trip(frame):
+    assert MSGPACK.decode(MSGPACK.encode(frame)) == frame
+
+
+def test_msgpack_uses_event_codes():
+    packed = msgpack.unpackb(MSGPACK.encode(FRAMES[0]), raw=False)
+    assert packed == [1, 7, EVENT_CODES["SEND_CHAT_MESSAGE"], {"chat_id": 1, "content": "hi"}]
+
+
+def test_msgpack_batch_response_packing():
+    packed = msgpack.unpackb(MSGPACK.encode(FRAMES[7]), raw=False)
+    assert packed == [3, 9, True, "atomic", [[[1, 9, EVENT_CODES["MARK_AS_READ"], True, None]]], None]
+
+
+def test_msgpack_nil_batch_mode_is_left_out():
+    frame = MSGPACK.decode(msgpack.packb([3, 1, [[7, {"chat_id": 1}]], None]))
+    assert frame == {"op": 3, "id": 1, "data": {"events": [{"event": "MARK_AS_READ", "data": {"chat_id": 1}}]}}
+
+
+@pytest.mark.parametrize("packed", [[2], [4], [4, {}, {}], [3, 1, 5, None], [1, 1], [9, {}]])
+def test_msgpack_malformed_frames(packed):
+    with pytest.raises(CodecException):
+        MSGPACK.decode(msgpack.packb(packed))
+
+
+def test_msgpack_rejects_text_and_garbage():
+    with pytest.raises(CodecException):
+        MSGPACK.decode("[1, 1, 1, {}]")
+    with pytest.raises(CodecException):
+        MSGPACK.decode(msgpack.packb({"op": 1}))
+    with pytest.raises(CodecException):
+        MSGPACK.decode(b"\xc1")
+
+
+def test_select_codec():
+    assert select_codec([]) is JSON
+    assert select_codec(["other", "twaddle.msgpack", "twaddle.json"]) is MSGPACK
+    assert select_codec(["twaddle.json", "twaddle.msgpack"]) is JSON
+
+
+@pytest.mark.parametrize("data", ["[]", "5", '"x"', "null", '{"op": 1}', '{"op": 1, "data": []}',
+                                  '{"op": 4, "data": "typing"}'])
+def test_json_rejects_frames_of_the_wrong_shape(data):
+    with pytest.raises(CodecException):
+        JSON.decode(data)
+
+
+@pytest.mark.parametrize("packed", [[4, 5], [2, None], [4, []]])
+def test_msgpack_rejects_frames_of_the_wrong_shape(packed):
+    with pytest.raises(CodecException):
+        MSGPACK.decode(msgpack.packb(packed))
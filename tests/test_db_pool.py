@@ -0,0 +1,126 @@
+import threading
+import time
+
+import psycopg2
+import pytest
+
+from db_pool import ConnectionPool, PoolException, PoolTimeoutException
+
+from conftest import FakeConnection
+
+
+class Connector:
+    """
+    Opens fake connections, and remembers them
+    """
+
+    def __init__(self):
+        self.opened: list[FakeConnection] = []
+
+    def __call__(self) -> FakeConnection:
+        self.opened.append(FakeConnection())
+        return self.opened[-1]
+
+
+def test_opens_min_size_up_front_and_grows_lazily():
+    connect = Connector()
+    pool = ConnectionPool(connect_func=connect, min_size=1, max_size=3)
+    assert len(connect.opened) == 1
+
+    a = pool.getconn()
+    b = pool.getconn()
+    assert len(connect.opened) == 2
+    pool.putconn(a)
+    pool.putconn(b)
+    assert pool.stats()["idle"] == 2
+
+
+def test_times_out_when_exhausted():
+    pool = ConnectionPool(connect_func=Connector(), min_size=0, max_size=1, timeout=0.05)
+    conn = pool.getconn()
+    start = time.monotonic()
+    with pytest.raises(PoolTimeoutException):
+        pool.getconn()
+    assert time.monotonic() - start >= 0.05
+    assert pool.timeouts == 1
+
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+
+
+def test_waiter_gets_a_returned_connection():
+    pool = ConnectionPool(connect_func=Connector(), min_size=0, max_size=1, timeout=5)
+    conn = pool.getconn()
+    threading.Timer(0.05, pool.putconn, (conn,)).start()
+    assert pool.getconn() is conn
+
+
+def test_connection_block_commits_or_rolls_back():
+    connect = Connector()
+    pool = ConnectionPool(connect_func=connect, min_size=1, max_size=1)
+    with pool.connection() as conn:
+        with conn.cursor() as crsr:
+            crsr.execute("SELECT 1")
+    assert conn.commits == 1
+
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            with conn.cursor() as crsr:
+                crsr.execute("SELECT 1")
+            raise ValueError()
+    assert conn.rollbacks == 1
+    # Still good, back in the pool
+    assert pool.stats()["idle"] == 1
+
+
+def test_broken_connection_is_replaced():
+    connect = Connector()
+    pool = ConnectionPool(connect_func=connect, min_size=1, max_size=1)
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn:
+            conn.broken = True
+            with conn.cursor() as crsr:
+                crsr.execute("SELECT 1")
+    assert conn.closed
+    assert pool.stats()["size"] == 0
+
+    with pool.connection() as fresh:
+        pass
+    assert fresh is not conn
+    assert len(connect.opened) == 2
+
+
+def test_idle_connection_is_checked_and_reconnected():
+    connect = Connector()
+    pool = ConnectionPool(connect_func=connect, min_size=1, max_size=1, health_check_interval=0)
+    # The server went away while the connection sat in the pool
+    connect.opened[0].broken = True
+    conn = pool.getconn()
+    assert conn is connect.opened[1]
+    assert connect.opened[0].closed
+    assert pool.reconnects == 1
+    pool.putconn(conn)
+
+    # A healthy one is pinged and kept
+    assert pool.getconn() is conn
+    assert conn.executed == [("SELECT 1", None)]
+
+
+def test_failed_connect_gives_the_slot_back():
+    def connect():
+        raise psycopg2.OperationalError("could not connect")
+
+    pool = ConnectionPool(connect_func=connect, min_size=0, max_size=1, timeout=0.05)
+    for _ in range(2):
+        with pytest.raises(psycopg2.OperationalError):
+            pool.getconn()
+    assert pool.stats()["size"] == 0
+
+
+def test_closed_pool():
+    connect = Connector()
+    pool = ConnectionPool(connect_func=connect, min_size=1, max_size=1)
+    pool.close()
+    assert connect.opened[0].closed
+    with pytest.raises(PoolException):
+        pool.getconn()
@@ -0,0 +1,95 @@
+import asyncio
+
+import psycopg2
+
+from db_api import MessageWriter
+
+
+def test_concurrent_messages_share_a_commit(db, fake_db):
+    writer = MessageWriter(db, max_batch=100, max_delay=0.05)
+
+    async def main():
+        return await asyncio.gather(*(writer.write(1, 1, f"m{i}") for i in range(10)))
+
+    assert asyncio.run(main()) == [f"m{i}" for i in range(10)]
+    assert fake_db.recorded("create_new_messages") == [[(1, 1, f"m{i}") for i in range(10)]]
+
+
+def test_full_batch_is_written_without_waiting(db, fake_db):
+    # The delay would time the test out if a full batch waited for it
+    writer = MessageWriter(db, max_batch=4, max_delay=60)
+
+    async def main():
+        return await asyncio.wait_for(asyncio.gather(*(writer.write(1, 1, f"m{i}") for i in range(8))), 5)
+
+    assert asyncio.run(main()) == [f"m{i}" for i in range(8)]
+    assert [len(batch) for batch in fake_db.recorded("create_new_messages")] == [4, 4]
+
+
+def test_bad_message_only_fails_itself(db, fake_db):
+    writer = MessageWriter(db, max_batch=100, max_delay=0.05)
+
+    async def main():
+        return await asyncio.gather(writer.write(1, 1, "a"), writer.write(1, 1, "bad"), writer.write(1, 1, "b"),
+                                    return_exceptions=True)
+
+    a, bad, b = asyncio.run(main())
+    assert (a, b) == ("a", "b")
+    assert isinstance(bad, psycopg2.IntegrityError)
+    # One failed batch, then the messages one by one
+    assert len(fake_db.recorded("create_new_messages")) == 1
+    assert fake_db.recorded("create_new_message") == [(1, 1, "a"), (1, 1, "bad"), (1, 1, "b")]
+
+
+def test_other_errors_fail_the_batch(db, fake_db):
+    fake_db.errors["create_new_messages"] = [psycopg2.OperationalError("connection lost")]
+    writer = MessageWriter(db, max_batch=100, max_delay=0.05)
+
+    async def main():
+        return await asyncio.gather(*(writer.write(1, 1, f"m{i}") for i in range(3)), return_exceptions=True)
+
+    assert all(isinstance(res, psycopg2.OperationalError) for res in asyncio.run(main()))
+    assert fake_db.recorded("create_new_message") == []
+
+
+def test_writer_restarts_after_going_idle(db, fake_db):
+    writer = MessageWriter(db, max_batch=100, max_delay=0)
+
+    async def main():
+        first = await writer.write(1, 1, "first")
+        second = await writer.write(1, 1, "second")
+        return first, second
+
+    assert asyncio.run(main()) == ("first", "second")
+    assert fake_db.recorded("create_new_messages") == [[(1, 1, "first")], [(1, 1, "second")]]
+
+
+def test_cancelled_sender_does_not_hold_up_the_batch(db, fake_db):
+    writer = MessageWriter(db, max_batch=100, max_delay=0.05)
+
+    async def main():
+        gone = asyncio.ensure_future(writer.write(1, 1, "gone"))
+        stays = asyncio.ensure_future(writer.write(1, 1, "stays"))
+        await asyncio.sleep(0)
+        gone.cancel()
+        return await asyncio.wait_for(stays, 5)
+
+    assert asyncio.run(main()) == "stays"
+    # Still written, it may already have been
+    assert fake_db.recorded("create_new_messages") == [[(1, 1, "gone"), (1, 1, "stays")]]
+
+
+def test_cancelled_sender_in_the_one_by_one_retry(db, fake_db):
+    writer = MessageWriter(db, max_batch=100, max_delay=0.05)
+
+    async def main():
+        gone = asyncio.ensure_future(writer.write(1, 1, "gone"))
+        bad = asyncio.ensure_future(writer.write(1, 1, "bad"))
+        stays = asyncio.ensure_future(writer.write(1, 1, "stays"))
+        await asyncio.sleep(0)
+        gone.cancel()
+        return await asyncio.wait_for(asyncio.gather(bad, stays, return_exceptions=True), 5)
+
+    bad, stays = asyncio.run(main())
+    assert isinstance(bad, psycopg2.IntegrityError)
+    assert stays == "stays"
@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+import tornado.websocket
+
+import outbound
+from outbound import OutboundQueue, POLICY_DROP_OLDEST, POLICY_DROP_NEWEST, POLICY_DISCONNECT, \
+    SLOW_CONSUMER_CLOSE_CODE
+
+
+class FakeSocket:
+    """
+    Just enough of a WebSocketHandler for an OutboundQueue. Writes block until released.
+    """
+
+    def __init__(self):
+        self.written: list[str | bytes] = []
+        self.close_code: int | None = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    async def write_message(self, message: str | bytes, binary: bool = False) -> None:
+        if self.close_code is not None:
+            raise tornado.websocket.WebSocketClosedError()
+        await self.writable.wait()
+        self.written.append(message)
+
+    def close(self, code: int | None = None, reason: str | None = None) -> None:
+        self.close_code = code
+
+
+def fill(policy: str, frames: int, max_size: int = 3) -> tuple[FakeSocket, OutboundQueue, list[bool]]:
+    """
+    Queue frames on a queue whose socket isn't being drained
+    :return: the socket, the queue, and what put returned for each frame
+    """
+    ws = FakeSocket()
+    queue = OutboundQueue(ws, max_size=max_size, policy=policy)
+    return ws, queue, [queue.put(str(i)) for i in range(frames)]
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        OutboundQueue(FakeSocket(), policy="block")
+
+
+def test_drop_oldest():
+    ws, queue, queued = fill(POLICY_DROP_OLDEST, 5)
+    assert queued == [True] * 5
+    assert [frame for frame, _ in queue.frames] == ["2", "3", "4"]
+
+
+def test_drop_newest():
+    ws, queue, queued = fill(POLICY_DROP_NEWEST, 5)
+    assert queued == [True, True, True, False, False]
+    assert [frame for frame, _ in queue.frames] == ["0", "1", "2"]
+
+
+def test_disconnect():
+    disconnected = outbound.stats.disconnected
+    ws, queue, queued = fill(POLICY_DISCONNECT, 5)
+    assert queued == [True, True, True, False, False]
+    assert ws.close_code == SLOW_CONSUMER_CLOSE_CODE
+    assert queue.closed
+    assert len(queue) == 0
+    assert outbound.stats.disconnected == disconnected + 1
+
+
+def test_drains_in_order():
+    async def main():
+        ws = FakeSocket()
+        queue = OutboundQueue(ws, max_size=10, policy=POLICY_DISCONNECT)
+        queue.start()
+        for i in range(5):
+            queue.put(str(i))
+        queue.put(b"binary")
+        await asyncio.sleep(0.01)
+        queue.close()
+        return ws.written
+
+    assert asyncio.run(main()) == ["0", "1", "2", "3", "4", b"binary"]
+
+
+def test_put_wait_waits_for_room():
+    async def main():
+        ws = FakeSocket()
+        ws.writable.clear()
+        queue = OutboundQueue(ws, max_size=2, policy=POLICY_DISCONNECT)
+        queue.start()
+        for i in range(3):
+            await queue.put_wait(str(i))
+        # One is being written, two are queued, the next one has to wait
+        waiting = asyncio.ensure_future(queue.put_wait("3"))
+        await asyncio.sleep(0.01)
+        blocked = not waiting.done()
+
+        ws.writable.set()
+        await asyncio.wait_for(waiting, 1)
+        await asyncio.sleep(0.01)
+        queue.close()
+        return blocked, ws.written, ws.close_code
+
+    blocked, written, close_code = asyncio.run(main())
+    assert blocked
+    assert written == ["0", "1", "2", "3"]
+    # Waiting isn't being too slow
+    assert close_code is None
+
+
+def test_closed_queue_refuses_frames():
+    async def main():
+        queue = OutboundQueue(FakeSocket(), max_size=1)
+        queue.close()
+        return queue.put("0"), await queue.put_wait("1")
+
+    assert asyncio.run(main()) == (False, False)
@@ -0,0 +1,78 @@
+import asyncio
+
+from presence import TypingLimiter, PresenceTracker
+
+
+def run_limiter(script, interval: float = 0.05) -> list[tuple[int, int, bool]]:
+    """
+    Feed a limiter (delay, user_id, chat_id, is_typing) updates, then wait out the interval
+    :return: the broadcasts it sent
+    """
+    sent = []
+
+    async def main():
+        limiter = TypingLimiter(lambda *args: sent.append(args), interval)
+        for delay, user_id, chat_id, is_typing in script:
+            await asyncio.sleep(delay)
+            limiter.update(user_id, chat_id, is_typing)
+        await asyncio.sleep(interval * 2)
+
+    asyncio.run(main())
+    return sent
+
+
+def test_first_update_is_sent_at_once():
+    assert run_limiter([(0, 1, 5, True)]) == [(1, 5, True)]
+
+
+def test_stopping_without_starting_is_not_sent():
+    assert run_limiter([(0, 1, 5, False)]) == []
+
+
+def test_toggling_is_coalesced():
+    # Only the latest state is sent once the interval is over
+    script = [(0, 1, 5, True), (0, 1, 5, False), (0, 1, 5, True), (0, 1, 5, False)]
+    assert run_limiter(script) == [(1, 5, True), (1, 5, False)]
+
+
+def test_toggling_back_within_the_interval_is_not_sent():
+    assert run_limiter([(0, 1, 5, True), (0, 1, 5, False), (0, 1, 5, True)]) == [(1, 5, True)]
+
+
+def test_repeats_within_the_interval_are_not_sent():
+    assert run_limiter([(0, 1, 5, True), (0, 1, 5, True)]) == [(1, 5, True)]
+
+
+def test_still_typing_is_refreshed_after_the_interval():
+    script = [(0, 1, 5, True), (0.06, 1, 5, True), (0, 1, 5, False), (0.12, 1, 5, False)]
+    assert run_limiter(script) == [(1, 5, True), (1, 5, True), (1, 5, False)]
+
+
+def test_chats_and_users_are_limited_separately():
+    script = [(0, 1, 5, True), (0, 1, 6, True), (0, 2, 5, True)]
+    assert run_limiter(script) == [(1, 5, True), (1, 6, True), (2, 5, True)]
+
+
+def test_forget_stops_typing():
+    sent = []
+
+    async def main():
+        limiter = TypingLimiter(lambda *args: sent.append(args), 0.05)
+        limiter.update(1, 5, True)
+        limiter.update(1, 6, True)
+        limiter.update(1, 6, False)
+        limiter.forget(1)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+    # The held back update for chat 6 is dropped with the rest
+    assert sent == [(1, 5, True), (1, 6, True), (1, 5, False), (1, 6, False)]
+
+
+def test_presence_tracker():
+    tracker = PresenceTracker(max_size=2)
+    assert tracker.get(1) == {"user_id": 1, "online": False, "last_seen": None}
+    assert tracker.set(1, True, 100) == {"user_id": 1, "online": True, "last_seen": 100}
+    assert tracker.is_online(1)
+    tracker.set(1, False, 200)
+    assert tracker.get(1) == {"user_id": 1, "online": False, "last_seen": 200}
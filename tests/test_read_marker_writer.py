@@ -0,0 +1,54 @@
+import asyncio
+
+import psycopg2
+
+from db_api import ReadMarkerWriter
+
+
+def test_markers_are_coalesced(db, fake_db):
+    writer = ReadMarkerWriter(db, interval=0.02)
+
+    async def main():
+        writer.mark(1, 10, 5)
+        writer.mark(1, 10, 7)
+        # Markers never move back
+        writer.mark(1, 10, 6)
+        writer.mark(2, 10, 3)
+        # None is the chat's last message, further than any ID
+        writer.mark(2, 10)
+        writer.mark(2, 10, 4)
+        writer.mark(1, 11, 2)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+    assert fake_db.recorded("mark_chats_as_read") == [[(1, 10, 7), (1, 11, 2), (2, 10, None)]]
+    assert writer.pending == {}
+
+
+def test_flush_one_user(db, fake_db):
+    writer = ReadMarkerWriter(db, interval=60)
+
+    async def main():
+        writer.mark(1, 10, 5)
+        writer.mark(1, 11, 6)
+        await writer.flush(10)
+
+    asyncio.run(main())
+    assert fake_db.recorded("mark_chats_as_read") == [[(1, 10, 5)]]
+    assert writer.pending == {(1, 11): 6}
+
+
+def test_failed_flush_is_retried(db, fake_db):
+    fake_db.errors["mark_chats_as_read"] = [psycopg2.OperationalError("connection lost")]
+    writer = ReadMarkerWriter(db, interval=0.02)
+
+    async def main():
+        writer.mark(1, 10, 5)
+        await writer.flush()
+        # Marked while the failed ones were being written, merged with them on the retry
+        writer.mark(1, 10, 8)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+    assert fake_db.recorded("mark_chats_as_read") == [[(1, 10, 8)]]
+    assert writer.pending == {}
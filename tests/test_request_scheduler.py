@@ -0,0 +1,144 @@
+import asyncio
+
+from sse_handling import Events, RequestScheduler
+
+
+async def drain(scheduler: RequestScheduler):
+    while scheduler.in_flight:
+        await asyncio.wait(list(scheduler.in_flight))
+
+
+def test_same_key_runs_in_order():
+    async def main():
+        scheduler = RequestScheduler()
+        order = []
+
+        def request(name: str, delay: float):
+            async def run():
+                await asyncio.sleep(delay)
+                order.append(name)
+            return run
+
+        # The first one is the slowest, the others still wait for it
+        await scheduler.submit(request("a1", 0.03), order_key="a")
+        await scheduler.submit(request("a2", 0.0), order_key="a")
+        await scheduler.submit(request("b1", 0.01), order_key="b")
+        await scheduler.submit(request("a3", 0.0), order_key="a")
+        await drain(scheduler)
+        return order
+
+    order = asyncio.run(main())
+    assert [name for name in order if name.startswith("a")] == ["a1", "a2", "a3"]
+    # A different key doesn't wait for the slow one
+    assert order.index("b1") < order.index("a1")
+
+
+def test_barrier_runs_alone():
+    async def main():
+        scheduler = RequestScheduler()
+        running = 0
+        log = []
+
+        def request(name: str, delay: float):
+            async def run():
+                nonlocal running
+                running += 1
+                log.append((name, running))
+                await asyncio.sleep(delay)
+                running -= 1
+            return run
+
+        await scheduler.submit(request("before1", 0.02))
+        await scheduler.submit(request("before2", 0.01))
+        await scheduler.submit(request("barrier", 0.01), barrier=True)
+        await scheduler.submit(request("after", 0.0))
+        await drain(scheduler)
+        return log
+
+    log = asyncio.run(main())
+    names = [name for name, _ in log]
+    assert names.index("barrier") > names.index("before1")
+    assert names.index("barrier") > names.index("before2")
+    assert names.index("after") > names.index("barrier")
+    assert dict(log)["barrier"] == 1
+    assert dict(log)["after"] == 1
+
+
+def test_in_flight_limit():
+    async def main():
+        scheduler = RequestScheduler(max_in_flight=2)
+        release = asyncio.Event()
+        running = 0
+        peak = 0
+
+        async def run():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await release.wait()
+            running -= 1
+
+        await scheduler.submit(run)
+        await scheduler.submit(run)
+        # The third one has to wait for a free slot
+        third = asyncio.ensure_future(scheduler.submit(run))
+        await asyncio.sleep(0.01)
+        assert not third.done()
+
+        release.set()
+        await third
+        await drain(scheduler)
+        return peak
+
+    assert asyncio.run(main()) == 2
+
+
+def test_failed_request_releases_its_key():
+    async def main():
+        scheduler = RequestScheduler()
+        ran = []
+
+        async def fail():
+            raise ValueError("boom")
+
+        async def run():
+            ran.append(True)
+
+        loop = asyncio.get_running_loop()
+        loop.set_exception_handler(lambda *_: None)
+        await scheduler.submit(fail, order_key="a")
+        await scheduler.submit(run, order_key="a")
+        await asyncio.sleep(0.01)
+        return ran, scheduler.tails
+
+    ran, tails = asyncio.run(main())
+    assert ran == [True]
+    assert tails == {}
+
+
+def test_tasks_are_held_until_done():
+    async def main():
+        scheduler = RequestScheduler()
+        release = asyncio.Event()
+
+        async def run():
+            await release.wait()
+
+        await scheduler.submit(run)
+        held = len(scheduler.tasks)
+        release.set()
+        await drain(scheduler)
+        await asyncio.sleep(0)
+        return held, len(scheduler.tasks)
+
+    assert asyncio.run(main()) == (1, 0)
+
+
+def test_order_key():
+    assert Events.Registry.order_key("LOAD_SINGLE_CHAT", {"chat_id": 4}) == ("chat_id", 4)
+    # Nothing to order by, rather than an error
+    assert Events.Registry.order_key("LOAD_SINGLE_CHAT", {"chat_id": [4]}) is None
+    assert Events.Registry.order_key("LOAD_SINGLE_CHAT", {"chat_id": {}}) is None
+    assert Events.Registry.order_key("LOAD_SINGLE_CHAT", [1, 2]) is None
+    assert Events.Registry.order_key("LOAD_SINGLE_CHAT", None) is None
+    assert Events.Registry.order_key("SEARCH_USERS", {"chat_id": 4}) is None
@@ -0,0 +1,60 @@
+import pytest
+
+import statements
+from statements import Statement
+
+from conftest import FakeConnection
+
+
+def test_placeholders_become_positional():
+    statement = Statement("s", "SELECT * FROM t WHERE a = %(a)s AND b = %(b)s OR a = %(a)s")
+    assert statement.params == ["a", "b"]
+    assert statement.prepare_sql == "PREPARE s AS SELECT * FROM t WHERE a = $1 AND b = $2 OR a = $1"
+    assert statement.execute_sql == "EXECUTE s (%(a)s, %(b)s)"
+
+
+def test_escaped_percent():
+    # %% is a literal % for psycopg2, PREPARE gets the query as is
+    statement = Statement("s", "SELECT * FROM t WHERE name LIKE 'a%%' AND tag %% %(query)s")
+    assert statement.prepare_sql == "PREPARE s AS SELECT * FROM t WHERE name LIKE 'a%' AND tag % $1"
+
+
+def test_no_params():
+    statement = Statement("s", "SELECT 1")
+    assert statement.params == []
+    assert statement.prepare_sql == "PREPARE s AS SELECT 1"
+    assert statement.execute_sql == "EXECUTE s"
+
+
+def test_register_twice(monkeypatch):
+    monkeypatch.setattr(statements, "STATEMENTS", {})
+    statements.register("twice", "SELECT 1")
+    with pytest.raises(ValueError):
+        statements.register("twice", "SELECT 2")
+
+
+def test_prepared_once_per_connection(monkeypatch):
+    monkeypatch.setattr(statements, "STATEMENTS", {})
+    monkeypatch.setattr(statements, "PREPARE_STATEMENTS", True)
+    statements.register("by_id", "SELECT * FROM t WHERE id = %(id)s")
+
+    first, second = FakeConnection(), FakeConnection()
+    for conn in (first, first, second):
+        with conn.cursor() as crsr:
+            statements.execute(crsr, "by_id", {"id": 1, "unused": 2})
+
+    assert first.executed == [("PREPARE by_id AS SELECT * FROM t WHERE id = $1", None),
+                              ("EXECUTE by_id (%(id)s)", {"id": 1, "unused": 2}),
+                              ("EXECUTE by_id (%(id)s)", {"id": 1, "unused": 2})]
+    assert second.executed[0] == ("PREPARE by_id AS SELECT * FROM t WHERE id = $1", None)
+
+
+def test_unprepared(monkeypatch):
+    monkeypatch.setattr(statements, "STATEMENTS", {})
+    monkeypatch.setattr(statements, "PREPARE_STATEMENTS", False)
+    statements.register("by_id", "SELECT * FROM t WHERE id = %(id)s")
+
+    conn = FakeConnection()
+    with conn.cursor() as crsr:
+        statements.execute(crsr, "by_id", {"id": 1})
+    assert conn.executed == [("SELECT * FROM t WHERE id = %(id)s", {"id": 1})]
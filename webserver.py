@@ -1,24 +1,41 @@
-import json
 import logging
+import signal
+import time
 from tornado import httputil
 from typing import *
 
 import tornado
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
 import tornado.websocket
 
-from db_api import Message
-from sse_handling import ServerSideEventHandler, Events
+import logs
+import loop_monitor
+import metrics
+import migrations
+import outbound
+import backplane
+import presence
+import codec
+from backplane import get_backplane
+from caches import membership, users as user_cache
+from db_api import AsyncDatabase, Message, ReadMarkerWriter, get_read_marker_writer
+from db_pool import get_pool, close_pool
+from sse_handling import ServerSideEventHandler, Events, RequestScheduler, current_request_id
 
 """
 OPCODES GUIDE
 -------------
-
+1 - Event: {"op": 1, "id"?, "data": {"event", "data"}}, answered with op 1 responses
+2 - New message push, server to client
+3 - Batch: {"op": 3, "id"?, "data": {"events": [{"event", "data"}, ...], "mode"?}}, run in one transaction
+4 - Ephemeral: typing and presence, both ways, handled in memory without the database (see presence.py)
 """
-stream_handler = logging.StreamHandler()
-LOGGER = logging.Logger('TwaddleLogger')
-LOGGER.addHandler(stream_handler)
-app_log = logging.getLogger('tornado.application')
-logging.getLogger('tornado.application').addHandler(stream_handler)
+# Order key shared by all requests sent without an ID
+LEGACY_ORDER_KEY = "legacy"
+
+LOGGER = logging.getLogger(__name__)
 
 
 class WSEvents:
@@ -56,7 +73,7 @@ class WSEvents:
         self.ws: TwaddleWSServer = ws
         self.db = self.ws.handler.events.db
 
-    @registry.register("LOGIN_USER")
+    @registry.register("LOGIN_USER", concurrent=True, barrier=True)
     async def login_set_active(self, event: str, data: dict):
         """
         Adds a user's WebSocket connection to the active WS's dicts
@@ -64,35 +81,32 @@ class WSEvents:
         :param data:
         :return:
         """
-        user = self.db.get_user_by_fuid(data.get("firebase_id"))
+        user = await self.db.get_user_by_fuid(data.get("firebase_id"))
         if user is None:
             return
         self.ws.set_active(user.user_id)
-        print(TwaddleWSServer.active_sockets)
-
-    @registry.register("LOAD_SINGLE_CHAT")
-    async def sc_mark_read(self, event: str, data: dict):
-        """
-        Mark the read chat as read
-        :param event:
-        :param data:
-        :return:
-        """
-        chat_id = data.get("chat_id")
-        self.db.mark_chat_as_read(chat_id, self.ws.user_id)
+        # Presence goes to the members of the user's chats, which have to be cached first
+        await self.db.load_user_membership(user.user_id)
+        self.ws.announce_presence(True)
+        LOGGER.info("User logged in", extra=logs.fields(user_id=user.user_id,
+                                                        active_sockets=len(TwaddleWSServer.active_sockets)))
 
-    @registry.register("MARK_AS_READ")
+    @registry.register("MARK_AS_READ", order_by="chat_id")
     async def mark_as_read(self, event: str, data: dict):
         """
-        Special event to mark chat as read
+        Special event to mark chat as read.
+        With "message_id", the chat is only read up to that message.
         :param event:
         :param data:
         :return:
         """
         chat_id = data.get("chat_id")
-        self.db.mark_chat_as_read(chat_id, self.ws.user_id)
+        message_id = data.get("message_id")
+        if message_id is not None:
+            message_id = int(message_id)
+        await self.db.mark_chat_as_read(chat_id, self.ws.user_id, message_id)
 
-    @registry.register("SEND_CHAT_MESSAGE")
+    @registry.register("SEND_CHAT_MESSAGE", order_by="chat_id")
     async def send_chat_message(self, event: str, data: dict):
         """
         Sends a chat message event to the other users in the chat
@@ -103,15 +117,16 @@ class WSEvents:
         chat_id = int(data.get("chat_id"))
         user_id = self.ws.user_id
         content = data.get("content")
-        msg = self.db.create_new_message(chat_id, user_id, content)
+        msg = await self.db.create_new_message(chat_id, user_id, content)
         if msg is None:
             return self._prepare_event_resp(event, False)
-        users = self.db.get_chat_user_ids(chat_id)
+        users = await self.db.get_chat_user_ids(chat_id)
         users.remove(user_id)
 
-        await self.ws.send_new_message(msg, tuple(users))
+        # Inside a batch, nobody hears of the message until it has been committed
+        await self.db.after_commit(self.ws.send_new_message, msg, tuple(users))
 
-        self.db.mark_chat_as_read(chat_id, user_id)
+        await self.db.mark_chat_as_read(chat_id, user_id, msg.message_id)
 
         return self._prepare_event_resp(event, True, msg.serialize())
 
@@ -137,6 +152,10 @@ class TwaddleWSServer(tornado.websocket.WebSocketHandler):
         self.handler = ServerSideEventHandler(self)
         self.events = WSEvents(self)
         self.user_id: int = 0
+        self.outbound = outbound.OutboundQueue(self)
+        # Picked in select_subprotocol
+        self.codec: codec.Codec = codec.JSON
+        self.scheduler = RequestScheduler()
 
     @property
     def active_sockets_key(self) -> str:
@@ -144,70 +163,364 @@ class TwaddleWSServer(tornado.websocket.WebSocketHandler):
             return ""
         return str(self.user_id)
 
+    def select_subprotocol(self, subprotocols: list[str]) -> str | None:
+        self.codec = codec.select_codec(subprotocols)
+        # Clients that didn't ask for a subprotocol get JSON without one
+        return self.codec.subprotocol if self.codec.subprotocol in subprotocols else None
+
     def open(self, *args: str, **kwargs: str):
-        LOGGER.info("New connection established!")
+        LOGGER.debug("New connection established", extra=logs.fields(codec=self.codec.name))
+        self.outbound.start()
+
+    def send(self, frame: str | bytes) -> bool:
+        """
+        Queue an encoded frame to be sent to this socket, without waiting for it to be written
+        :param frame: encoded frame
+        :return: whether the frame was queued
+        """
+        return self.outbound.put(frame)
 
     async def on_message(self, message: Union[str, bytes]):
-        print(f"Received data:\n{message}")
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            # Sizes only, frames carry user content
+            LOGGER.debug("Received frame", extra=logs.fields(sample="frame", user_id=self.user_id, size=len(message)))
+
+        try:
+            data = self.codec.decode(message)
+        except (ValueError, codec.CodecException):
+            LOGGER.warning("Dropping malformed %s frame", self.codec.name, extra=logs.fields(user_id=self.user_id))
+            metrics.errors.inc("decode")
+            return
 
-        data = json.loads(message)
         # If is a server event redirect to the event handler
         if data.get("op") == 1:
-            res_ls = await self.handler.handle(data)
-            for res in res_ls:
-                if res is None:
-                    continue
+            event = data.get("data").get("event")
+            if data.get("id") is None:
+                # Clients that don't tag their requests can't match responses up, keep them in order
+                order_key, barrier = LEGACY_ORDER_KEY, False
+            else:
+                order_key = Events.Registry.order_key(event, data.get("data").get("data"))
+                barrier = event in Events.Registry.barriers
+
+            # Waits while the connection has too many requests in flight, which stops us reading more
+            await self.scheduler.submit(lambda: self.process_request(data), order_key, barrier)
+
+        elif data.get("op") == 3:
+            # A batch may touch anything, so it runs alone
+            await self.scheduler.submit(lambda: self.process_request(data), barrier=True)
+
+        elif data.get("op") == 4:
+            # Never waits on anything, so it skips the scheduler
+            self.on_ephemeral(data.get("data") or {})
+
+    def on_ephemeral(self, data: dict) -> None:
+        """
+        Handle an op 4 frame from the client: typing indicators and presence requests
+        :param data: the frame's data
+        """
+        if self.user_id == 0:
+            return
 
-                # Sent the result/response back
-                print("SENDING")
-                print(res)
-                await self.write_message(json.dumps(res))
+        if data.get("type") == "typing":
+            chat_id = data.get("chat_id")
+            members = membership.peek_chat_members(chat_id) if type(chat_id) is int else None
+            if members is None or self.user_id not in members:
+                metrics.ephemeral.inc("dropped")
+                return
+            typing_limiter.update(self.user_id, chat_id, bool(data.get("typing")))
+
+        elif data.get("type") == "presence":
+            user_ids = data.get("user_ids")
+            if not isinstance(user_ids, list):
+                return
+            # Only the presence of people the user shares a chat with
+            contacts = presence.contacts(self.user_id)
+            user_ids = [user_id for user_id in user_ids[:presence.MAX_PRESENCE_USERS]
+                        if type(user_id) is int and user_id in contacts]
+            self.send(self.codec.encode(presence.presence_frame([presence.tracker.get(user_id)
+                                                                 for user_id in user_ids])))
+
+    def announce_presence(self, online: bool) -> None:
+        """
+        Record this socket's user coming online or going offline, and tell their contacts and the other processes
+        """
+        state = presence.tracker.set(self.user_id, online)
+        users = presence.contacts(self.user_id)
+        frame = presence.presence_frame([state])
+        encoded = {}
+        remote_users = TwaddleWSServer.deliver_local(users, frame, encoded)
+        metrics.ephemeral.inc("sent")
+        # Always published, every process keeps track of who is online
+        json_frame = encoded.get(codec.JSON.name) or codec.JSON.encode(frame)
+        get_backplane().publish("ephemeral", users=remote_users, frame=json_frame, presence=state)
+
+    @staticmethod
+    def send_typing(user_id: int, chat_id: int, is_typing: bool) -> None:
+        """
+        Tell the other members of a chat that a user started or stopped typing
+        """
+        members = membership.peek_chat_members(chat_id)
+        if members is None:
+            metrics.ephemeral.inc("dropped")
+            return
+        frame = presence.typing_frame(chat_id, user_id, is_typing)
+        encoded = {}
+        others = [member for member in members if member != user_id]
+        remote_users = TwaddleWSServer.deliver_local(others, frame, encoded)
+        metrics.ephemeral.inc("sent")
+        # Only members online in another process are worth a trip over the backplane
+        remote_users = [member for member in remote_users if presence.tracker.is_online(member)]
+        if remote_users:
+            json_frame = encoded.get(codec.JSON.name) or codec.JSON.encode(frame)
+            get_backplane().publish("ephemeral", users=remote_users, frame=json_frame)
+
+    async def process_request(self, data: dict):
+        """
+        Handle a single op 1 or op 3 request and send its responses, tagged with the request's ID
+        :param data: the received frame
+        """
+        request_id = data.get("id")
+        current_request_id.set(request_id)
+        event = (data.get("data") or {}).get("event")
+        try:
+            if data.get("op") == 3:
+                res_ls = [await self.handler.handle_batch(data)]
+            else:
+                res_ls = await self.handler.handle(data)
+        except Exception:
+            LOGGER.exception("Failed handling %s", event or "batch",
+                             extra=logs.fields(event=event, user_id=self.user_id, request_id=request_id))
+            metrics.errors.inc("batch" if data.get("op") == 3 else "event")
+            if data.get("op") == 3:
+                res_ls = [self.handler._prepare_batch_resp(False, (data.get("data") or {}).get("mode"), [], [])]
+            else:
+                res_ls = [WSEvents._prepare_event_resp(event, False)]
+
+        for res in res_ls:
+            if res is None:
+                continue
+            if request_id is not None:
+                res["id"] = request_id
+
+            # Sent the result/response back
+            self.send(self.codec.encode(res))
 
     @staticmethod
     async def send_new_message(msg: Message, users: tuple[int]):
         """
-        Send a message event to all users in a chat
+        Send a message event to all users in a chat.
+        The frame is encoded once per codec and queued on every recipient's socket, slow recipients don't hold anyone up.
         :param msg: Message object to send back
         :param users:
         :return:
         """
-        msg_srz = msg.serialize()
+        start = time.perf_counter()
+        frame = {
+            "op": 2,
+            "data": msg.serialize()
+        }
+        encoded = {}
+        remote_users = TwaddleWSServer.deliver_local(users, frame, encoded)
+        if remote_users:
+            # Recipients that aren't connected here may be connected to another process.
+            # Envelopes are JSON, so the JSON encoding is what gets passed along
+            json_frame = encoded.get(codec.JSON.name) or codec.JSON.encode(frame)
+            get_backplane().publish("deliver", users=remote_users, frame=json_frame, message_id=msg.message_id)
+        elapsed = time.perf_counter() - start
+        loop_monitor.event_latency.record("fan_out", elapsed)
+        metrics.fan_out_duration.observe(elapsed)
+
+    @staticmethod
+    def deliver_local(users: Iterable[int], frame: dict, encoded: dict[str, str | bytes] | None = None) -> list[int]:
+        """
+        Queue a frame on the sockets of the given users that are connected to this process
+        :param users: recipients
+        :param frame: frame to send
+        :param encoded: the frame already encoded, by codec name. Filled in as other codecs are needed.
+        :return: the users that aren't connected here
+        """
+        encoded = encoded if encoded is not None else {}
+        missing = []
         for user in users:
             instance = TwaddleWSServer.get_active_socket(user)
             if instance is None:
+                missing.append(user)
                 continue
-            await instance.write_message(json.dumps({
+            data = encoded.get(instance.codec.name)
+            if data is None:
+                data = encoded[instance.codec.name] = instance.codec.encode(frame)
+            instance.send(data)
+        return missing
+
+    @staticmethod
+    async def on_backplane_deliver(envelope: dict):
+        """
+        Deliver a push published by another process to our own sockets
+        :param envelope: "deliver" envelope, with users, frame and message_id
+        """
+        users = [user for user in envelope.get("users", ()) if TwaddleWSServer.get_active_socket(user) is not None]
+        if not users:
+            return
+
+        json_frame = envelope.get("frame")
+        if json_frame is None:
+            # Too large for the backplane, rebuild it from the message
+            msg = await AsyncDatabase().get_message(envelope.get("message_id"))
+            if msg is None:
+                return
+            TwaddleWSServer.deliver_local(users, {
                 "op": 2,
-                "data": msg_srz
-            }))
+                "data": msg.serialize()
+            })
+            return
+        TwaddleWSServer.deliver_local(users, codec.JSON.decode(json_frame), {codec.JSON.name: json_frame})
+
+    @staticmethod
+    def on_backplane_ephemeral(envelope: dict):
+        """
+        Deliver an op 4 frame published by another process to our own sockets, and note presence changes
+        :param envelope: "ephemeral" envelope, with users, frame and optionally presence
+        """
+        state = envelope.get("presence")
+        if state is not None:
+            presence.tracker.set(state["user_id"], state["online"], state["last_seen"])
+
+        json_frame = envelope.get("frame")
+        users = [user for user in envelope.get("users", ()) if TwaddleWSServer.get_active_socket(user) is not None]
+        # Never rebuilt when it was too large for the backplane, it's only ephemeral
+        if json_frame is None or not users:
+            return
+        TwaddleWSServer.deliver_local(users, codec.JSON.decode(json_frame), {codec.JSON.name: json_frame})
 
     def on_close(self) -> None:
-        if self.active_sockets_key is not None and self.active_sockets.get(self.active_sockets_key) is not None:
-            self.active_sockets.pop(self.active_sockets_key, None)
-        print("Web socket closed.")
+        self.outbound.close()
+        if self.user_id != 0:
+            # Don't leave the user's read markers waiting for the next flush
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                get_read_marker_writer(self.handler.events.db).flush, self.user_id
+            )
+            # Unless the user has already reconnected on another socket, which must keep getting their pushes
+            if self.get_active_socket(self.user_id) is self:
+                typing_limiter.forget(self.user_id)
+                self.announce_presence(False)
+                self.remove_active(self.user_id)
+        LOGGER.debug("Web socket closed", extra=logs.fields(user_id=self.user_id))
 
     def on_ping(self, data: bytes) -> None:
-        print(f"Ping called: {data.decode()}")
+        LOGGER.debug("Ping received", extra=logs.fields(sample="ping", user_id=self.user_id))
 
     def on_pong(self, data: bytes) -> None:
-        print(f"Ping response received: {data.decode()}")
+        LOGGER.debug("Pong received", extra=logs.fields(sample="ping", user_id=self.user_id))
+
+
+# Typing indicators from every socket of the process, rate limited per user and chat
+typing_limiter = presence.TypingLimiter(TwaddleWSServer.send_typing)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Serves this process's metrics in the Prometheus text format
+    """
 
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.REGISTRY.render())
+
+
+def register_gauges():
+    pool = get_pool()
+    metrics.REGISTRY.gauge("twaddle_active_sockets", "Logged in sockets connected to this process",
+                           lambda: len(TwaddleWSServer.active_sockets))
+    metrics.REGISTRY.gauge("twaddle_outbound_queued_frames", "Frames waiting in outbound queues",
+                           lambda: sum(len(ws.outbound) for ws in list(TwaddleWSServer.active_sockets.values())))
+    metrics.REGISTRY.gauge("twaddle_db_pool_in_use", "Pooled connections checked out", lambda: pool.in_use)
+    metrics.REGISTRY.gauge("twaddle_db_pool_waiting", "Threads waiting for a pooled connection",
+                           lambda: pool.waiting)
+    metrics.REGISTRY.gauge("twaddle_loop_blocked_seconds", "Total time the IOLoop was blocked",
+                           lambda: loop_monitor.loop_lag.total_blocked)
+
+
+def log_stats():
+    loop_monitor.log_summary(LOGGER)
+    LOGGER.info("DB pool: %s", get_pool().stats())
+    LOGGER.info("Membership cache: %s", membership.stats())
+    LOGGER.info("User cache: %s", user_cache.stats())
+    depth = sum(len(ws.outbound) for ws in TwaddleWSServer.active_sockets.values())
+    LOGGER.info("Outbound: queued=%d %s", depth, outbound.stats.summary())
+    LOGGER.info("Read markers: %s", ReadMarkerWriter.stats())
+    LOGGER.info("Presence: %s", presence.tracker.stats())
+
+
+def main(port: int, ip: str, workers: int = 1):
+    """
+    Start the server, and run it until stopped
+    :param port: port to listen on
+    :param ip: address to listen on
+    :param workers: number of processes sharing the listening socket, 0 for one per CPU core
+    """
+    logs.setup_logging()
+    migrations.migrate_on_startup()
+
+    if workers != 1:
+        # Bind before forking so all workers accept from the same socket.
+        # Nothing DB-related may survive the fork, every worker makes its own pool.
+        sockets = tornado.netutil.bind_sockets(port, address=ip)
+        close_pool()
+        tornado.process.fork_processes(workers)
+        # The log writer thread didn't survive the fork
+        logs.setup_logging()
 
-def main(port: int, ip: str):
     app = tornado.web.Application(
         [
-            ("/", TwaddleWSServer)
+            ("/", TwaddleWSServer),
+            ("/metrics", MetricsHandler)
         ],
         websocket_ping_interval=20,
         websocket_ping_timeout=120
     )
-    app.listen(port=port, address=ip)
 
-    LOGGER.info(f"Started server! Listening on\nws://{ip}:{port}/")
-    LOGGER.info(f"Loaded EVENTS: {Events.get_events()}")
+    if workers != 1:
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets(sockets)
+    else:
+        app.listen(port=port, address=ip)
+
+    LOGGER.info("Started server! Listening on ws://%s:%d/", ip, port)
+    LOGGER.info("Loaded EVENTS: %s", Events.get_events())
 
     ioloop = tornado.ioloop.IOLoop.current()
+
+    # With several workers, pushes have to go through Postgres to reach the other processes
+    bp = get_backplane(backplane.BACKPLANE or ("postgres" if workers != 1 else "memory"))
+    bp.on("deliver", TwaddleWSServer.on_backplane_deliver)
+    bp.on("ephemeral", TwaddleWSServer.on_backplane_ephemeral)
+    ioloop.add_callback(bp.start)
+
+    # Keep the other processes' membership and user caches in sync with ours.
+    # Changes can come from executor threads, add_callback hands them to the loop safely.
+    bp.on("membership", lambda env: membership.apply(env["chat_id"], env["user_ids"], env["joined"]))
+    membership.listeners.append(
+        lambda chat_id, user_ids, joined: ioloop.add_callback(
+            bp.publish, "membership", chat_id=chat_id, user_ids=list(user_ids), joined=joined
+        )
+    )
+    bp.on("user", lambda env: user_cache.invalidate(env["user_id"]))
+    user_cache.listeners.append(lambda user_id: ioloop.add_callback(bp.publish, "user", user_id=user_id))
+
+    register_gauges()
+
+    async def shutdown():
+        # Read markers still waiting in memory would be lost otherwise
+        await get_read_marker_writer(AsyncDatabase()).flush()
+        ioloop.stop()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        ioloop.asyncio_loop.add_signal_handler(sig, ioloop.add_callback, shutdown)
+
+    # Keep track of how long the loop gets blocked, and report it every minute
+    ioloop.add_callback(loop_monitor.loop_lag.start)
+    tornado.ioloop.PeriodicCallback(log_stats, 60_000).start()
+
     ioloop.start()
 
     return app
-